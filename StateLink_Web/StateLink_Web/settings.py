@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -69,6 +70,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     # Add other middleware here
     'django_ratelimit.middleware.RatelimitMiddleware',
+    'core.query_sampling.QuerySamplingMiddleware',
 ]
 
 ROOT_URLCONF = 'StateLink_Web.urls'
@@ -164,6 +166,37 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Add custom settings here
 
+# Business search backend (dotted path). Left unset, core.search picks
+# trigram indexes on PostgreSQL and an FTS5 table on SQLite.
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND')
+
+# In-process prefix index answering business autocomplete without the database.
+# Each worker builds its own copy in the background at startup, and autocomplete
+# uses the database until it's ready. Building stops once the index passes the
+# byte limit, leaving autocomplete on the database. Every MAX_AGE seconds the
+# index catches up with rows other processes changed, and every REBUILD_INTERVAL
+# seconds it's rebuilt, dropping rows they deleted.
+AUTOCOMPLETE_PREFIX_INDEX = os.getenv('AUTOCOMPLETE_PREFIX_INDEX', 'True') == 'True'
+AUTOCOMPLETE_PREFIX_INDEX_MAX_BYTES = int(os.getenv('AUTOCOMPLETE_PREFIX_INDEX_MAX_BYTES', 256 * 1024 * 1024))
+AUTOCOMPLETE_PREFIX_INDEX_MAX_AGE = int(os.getenv('AUTOCOMPLETE_PREFIX_INDEX_MAX_AGE', 300))
+AUTOCOMPLETE_PREFIX_INDEX_REBUILD_INTERVAL = int(os.getenv('AUTOCOMPLETE_PREFIX_INDEX_REBUILD_INTERVAL', 3600))
+
+# Business flags recomputed nightly by `manage.py recompute_business_flags`:
+# is_new covers businesses formed in the last NEW_BUSINESS_DAYS, and
+# missing_filing those older than FILING_INTERVAL_DAYS with no filing in that time.
+NEW_BUSINESS_DAYS = int(os.getenv('NEW_BUSINESS_DAYS', 30))
+FILING_INTERVAL_DAYS = int(os.getenv('FILING_INTERVAL_DAYS', 365))
+
+# Fraction of requests whose SELECTs are appended to QUERY_SAMPLE_LOG for
+# `manage.py index_advisor`; 0 turns sampling off. The log holds search
+# terms, so it lives outside the project and should be deleted once analysed.
+QUERY_SAMPLE_RATE = float(os.getenv('QUERY_SAMPLE_RATE', 0))
+QUERY_SAMPLE_LOG = os.getenv('QUERY_SAMPLE_LOG', os.path.join(tempfile.gettempdir(), 'statelink-query-samples.jsonl'))
+
+# Fill in every selected service's form on one page, submitted once
+# (core.views.CheckoutView), rather than a page per form.
+SINGLE_PAGE_CHECKOUT = os.getenv('SINGLE_PAGE_CHECKOUT', 'True') == 'True'
+
 # Rate limit settings
 RATELIMIT_ENABLE = True # Enable rate limiting
 RATELIMIT_USE_CACHE = "default" # Use the default cache
@@ -182,6 +215,20 @@ HEARTLAND_DEVELOPER_ID = os.getenv('HEARTLAND_DEVELOPER_ID')
 HEARTLAND_VERSION_NUMBER = os.getenv('HEARTLAND_VERSION_NUMBER')
 HEARTLAND_SERVICE_URL = os.getenv('HEARTLAND_SERVICE_URL')
 
+# Payment gateway client (core.payments). Seconds to connect to and then wait
+# on the gateway, keep-alive connections pooled per worker, and how many
+# unanswered charges in a row open the circuit breaker, failing charges
+# straight away for PAYMENT_GATEWAY_RESET_SECONDS before trying again.
+PAYMENT_GATEWAY_CONNECT_TIMEOUT = float(os.getenv('PAYMENT_GATEWAY_CONNECT_TIMEOUT', 3.05))
+PAYMENT_GATEWAY_READ_TIMEOUT = float(os.getenv('PAYMENT_GATEWAY_READ_TIMEOUT', 20))
+PAYMENT_GATEWAY_POOL_SIZE = int(os.getenv('PAYMENT_GATEWAY_POOL_SIZE', 2))
+PAYMENT_GATEWAY_FAILURE_THRESHOLD = int(os.getenv('PAYMENT_GATEWAY_FAILURE_THRESHOLD', 3))
+PAYMENT_GATEWAY_RESET_SECONDS = int(os.getenv('PAYMENT_GATEWAY_RESET_SECONDS', 30))
+# Seconds a payment may sit in PROCESSING before process_payments decides its
+# worker died mid-charge and marks it UNCONFIRMED for staff to check with the
+# gateway. Keep it well above the connect and read timeouts together.
+PAYMENT_PROCESSING_TIMEOUT = int(os.getenv('PAYMENT_PROCESSING_TIMEOUT', 300))
+
 # HEARTLAND_PUBLIC_KEY = "pkapi_cert_jKc1FtuyAydZhZfbB3"  # Replace with your public key
 # HEARTLAND_SECRET_KEY = "skapi_cert_MTyMAQBiHVEAewvIzXVFcmUd2UcyBge_eCpaASUp0A"  # Replace with your secret key
 # HEARTLAND_DEVELOPER_ID = "000000"  # Replace with your developer ID
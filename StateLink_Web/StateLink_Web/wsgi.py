@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'StateLink_Web.settings')
 
 application = get_wsgi_application()
+
+# Start building the autocomplete prefix index in the background, once per worker
+from core import prefix_index  # noqa: E402
+
+prefix_index.warm()
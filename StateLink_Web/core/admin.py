@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.utils.html import format_html_join
 from .models import (
     Business, 
     ComplianceRequest, 
@@ -6,18 +7,21 @@ from .models import (
     OperatingAgreementRequest,
     CorporateBylawsRequest,
     CertificateExistenceRequest,
-    LaborLawPosterRequest
+    LaborLawPosterRequest,
+    OrderItem,
+    Payment
 )
+from .pricing import Quote
 
 @admin.register(Business)
 class BusinessAdmin(admin.ModelAdmin):
     list_display = ('name', 'reference_id', 'business_type', 'state_code', 'status', 'date_formed')
     list_filter = ('business_type', 'state_code', 'status', 'is_new', 'missing_filing')
-    search_fields = ('name', 'reference_id')
+    search_fields = ('name', 'reference_id', 'registry_id')
     readonly_fields = ('created_at', 'updated_at')
     fieldsets = (
         ('Basic Information', {
-            'fields': ('name', 'reference_id', 'business_type', 'state_code')
+            'fields': ('name', 'reference_id', 'registry_id', 'business_type', 'state_code')
         }),
         ('Address Information', {
             'fields': ('address', 'address2', 'city', 'zip_code')
@@ -34,6 +38,11 @@ class BusinessAdmin(admin.ModelAdmin):
         }),
     )
 
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    extra = 0
+    fields = ('service', 'price', 'status', 'position')
+
 class FederalEINRequestInline(admin.StackedInline):
     model = FederalEINRequest
     extra = 0
@@ -142,8 +151,9 @@ class ComplianceRequestAdmin(admin.ModelAdmin):
     list_display = ('business', 'request_type', 'status', 'price', 'order_reference_number', 'created_at', 'unlimited_amendments')
     list_filter = ('request_type', 'status', 'unlimited_amendments')
     search_fields = ('business__name', 'business__reference_id', 'applicant_first_name', 'applicant_last_name', 'order_reference_number')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('created_at', 'updated_at', 'quote_summary', 'quoted_at')
     inlines = [
+        OrderItemInline,
         OperatingAgreementRequestInline,
         FederalEINRequestInline,
         CorporateBylawsRequestInline,
@@ -167,12 +177,26 @@ class ComplianceRequestAdmin(admin.ModelAdmin):
                 'client_signature_text'
             )
         }),
+        ('Quote', {
+            'fields': ('quote_summary', 'quoted_at')
+        }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
 
+    @admin.display(description='Quote')
+    def quote_summary(self, obj):
+        if not obj.quote_snapshot:
+            return '-'
+        quote = Quote.from_snapshot(obj.quote_snapshot)
+        lines = [(item.name, '', item.price) for item in quote.line_items + quote.add_ons]
+        if quote.show_discount:
+            lines.append(('Package discount', '-', quote.discount))
+        lines.append(('Total', '', quote.total))
+        return format_html_join('', '<div>{}: {}${}</div>', lines)
+
 # Register individual service request models for direct access
 @admin.register(FederalEINRequest)
 class FederalEINRequestAdmin(admin.ModelAdmin):
@@ -205,4 +229,31 @@ class CertificateExistenceRequestAdmin(admin.ModelAdmin):
 class LaborLawPosterRequestAdmin(admin.ModelAdmin):
     list_display = ('compliance_request', 'business_name', 'requestor_first_name', 'requestor_last_name')
     search_fields = ('business_name', 'requestor_first_name', 'requestor_last_name', 'business_reference_id')
-    fieldsets = LaborLawPosterRequestInline.fieldsets
\ No newline at end of file
+    fieldsets = LaborLawPosterRequestInline.fieldsets
+
+# Fulfillment queue: one row per ordered service
+@admin.register(OrderItem)
+class OrderItemAdmin(admin.ModelAdmin):
+    list_display = ('compliance_request', 'service', 'price', 'status', 'created_at')
+    list_filter = ('status', 'service')
+    list_select_related = ('compliance_request__business',)
+    search_fields = ('compliance_request__business__name', 'compliance_request__order_reference_number')
+    ordering = ('created_at',)
+    readonly_fields = ('created_at', 'updated_at')
+
+# Charges made by `manage.py process_payments`; Unconfirmed ones need checking at the gateway
+@admin.register(Payment)
+class PaymentAdmin(admin.ModelAdmin):
+    list_display = ('order_reference', 'compliance_request', 'amount', 'status', 'attempts', 'created_at')
+    list_filter = ('status',)
+    list_select_related = ('compliance_request__business',)
+    search_fields = ('order_reference', 'transaction_id', 'compliance_request__business__name')
+    ordering = ('-created_at',)
+    exclude = ('token',)
+    readonly_fields = (
+        'compliance_request', 'idempotency_key', 'order_reference', 'amount', 'postal_code', 'status', 'attempts',
+        'transaction_id', 'response_code', 'response_message', 'created_at', 'updated_at',
+    )
+
+    def has_add_permission(self, request):
+        return False
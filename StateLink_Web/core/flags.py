@@ -0,0 +1,61 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Business
+
+logger = logging.getLogger(__name__)
+
+
+def flag_conditions(today):
+    """The Q each derived Business flag should match on today"""
+    new_since = today - timedelta(days=getattr(settings, 'NEW_BUSINESS_DAYS', 30))
+    filed_since = today - timedelta(days=getattr(settings, 'FILING_INTERVAL_DAYS', 365))
+    return {
+        'is_new': Q(date_formed__gte=new_since),
+        'missing_filing': Q(date_formed__lt=filed_since) & (
+            Q(last_filing_date__isnull=True) | Q(last_filing_date__lt=filed_since)
+        ),
+    }
+
+
+def pk_ranges(chunk_size):
+    """Yield (after, upto) primary-key bounds covering Business in chunks of chunk_size rows"""
+    after = None
+    while True:
+        chunk = Business.objects.order_by('pk')
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        upto = chunk.values_list('pk', flat=True)[chunk_size - 1:chunk_size].first()
+        if upto is None:
+            last = chunk.values_list('pk', flat=True).last()
+            if last is not None:
+                yield after, last
+            return
+        yield after, upto
+        after = upto
+
+
+def recompute_flags(today=None, chunk_size=10000):
+    """
+    Bring is_new and missing_filing in line with date_formed and
+    last_filing_date. Each primary-key chunk gets one UPDATE per flag and
+    direction, touching only the rows that flip, so locks stay short and
+    unchanged rows aren't written. updated_at is left alone since the flags
+    are derived. Returns {flag: {'set': n, 'cleared': n}}.
+    """
+    today = today or timezone.localdate()
+    conditions = flag_conditions(today)
+    flipped = {flag: {'set': 0, 'cleared': 0} for flag in conditions}
+    for after, upto in pk_ranges(chunk_size):
+        chunk = Business.objects.filter(pk__lte=upto)
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        for flag, condition in conditions.items():
+            flipped[flag]['set'] += chunk.filter(condition, **{flag: False}).update(**{flag: True})
+            flipped[flag]['cleared'] += chunk.filter(~condition, **{flag: True}).update(**{flag: False})
+    logger.info("Recomputed business flags for %s: %s", today, flipped)
+    return flipped
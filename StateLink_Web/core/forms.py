@@ -12,17 +12,8 @@ class BusinessSearchForm(forms.Form):
     )
 
 class ComplianceRequestForm(forms.ModelForm):
-    COMPLIANCE_SERVICES = [
-        ('OPERATING_AGREEMENT', 'Operating Agreement - $249.95'),
-        ('FEDERAL_EIN', 'Federal EIN Application - $149.95'),
-        ('LABOR_LAW_POSTER', 'Labor Law Poster - $79.95'),
-        ('CORPORATE_BYLAWS', 'Corporate Bylaws - $249.95'),
-        ('ANNUAL_REPORT', 'Annual Report - $399.95'),
-        ('CERTIFICATE_EXISTENCE', 'Certificate of Existence - $79.95'),
-    ]
-
+    # The choices are the services offered to the business, set per form by the view
     services = forms.MultipleChoiceField(
-        choices=COMPLIANCE_SERVICES,
         widget=forms.CheckboxSelectMultiple(attrs={
             'class': 'form-check-input'
         }),
@@ -47,8 +38,9 @@ class ComplianceRequestForm(forms.ModelForm):
             raise forms.ValidationError('Please select at least one service.')
         return services
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, service_choices=(), **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields['services'].choices = service_choices
         # The field is always present, but template JS will show/hide it based on service selection
 
 class BusinessRegistrationForm(forms.ModelForm):
@@ -0,0 +1,64 @@
+from .search import get_search_backend
+
+# Longer queries are truncated so the edit-distance work per candidate stays bounded
+MAX_QUERY_LENGTH = 64
+# Candidate rows fetched from the search backend for reranking
+CANDIDATE_LIMIT = 50
+
+
+def normalise(value):
+    return ' '.join((value or '').casefold().split())
+
+
+def max_distance_for(query):
+    """Allow roughly one typo per five characters, up to three"""
+    return min(3, max(1, len(query) // 5))
+
+
+def prefix_edit_distance(query, target, max_distance):
+    """
+    Edit distance (insertions, deletions, substitutions and adjacent
+    transpositions) from query to the closest prefix of target, so a
+    partially typed name still scores against the full one. Only a band of
+    width 2 * max_distance + 1 is evaluated, and max_distance + 1 is returned
+    as soon as the distance is known to exceed max_distance.
+    """
+    over = max_distance + 1
+    target = target[:len(query) + max_distance]
+    before_previous = None
+    previous = list(range(len(target) + 1))
+    for i, query_char in enumerate(query, start=1):
+        current = [over] * (len(target) + 1)
+        current[0] = i
+        low = max(1, i - max_distance)
+        high = min(len(target), i + max_distance)
+        for j in range(low, high + 1):
+            cost = 0 if target[j - 1] == query_char else 1
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (before_previous and j > 1 and query_char == target[j - 2]
+                    and query[i - 2] == target[j - 1]):
+                distance = min(distance, before_previous[j - 2] + 1)
+            current[j] = min(distance, over)
+        if min(current[max(0, low - 1):high + 1]) > max_distance:
+            return over
+        before_previous, previous = previous, current
+    return min(previous)
+
+
+def suggest(query, limit=5):
+    """
+    "Did you mean" suggestions for a query that found nothing: n-gram
+    candidates from the search backend, reranked by prefix edit distance.
+    Returns up to limit (reference_id, name, state_code) tuples, closest first.
+    """
+    query = normalise(query)[:MAX_QUERY_LENGTH]
+    if len(query) < 3:
+        return []
+    max_distance = max_distance_for(query)
+    scored = []
+    for reference_id, name, state_code in get_search_backend().fuzzy_candidates(query, CANDIDATE_LIMIT):
+        distance = prefix_edit_distance(query, normalise(name), max_distance)
+        if distance <= max_distance:
+            scored.append((distance, name, reference_id, state_code))
+    scored.sort()
+    return [(reference_id, name, state_code) for _distance, name, reference_id, state_code in scored[:limit]]
@@ -0,0 +1,431 @@
+"""
+Index suggestions from sampled queries (see core.query_sampling).
+
+Samples are grouped by shape, the SQL with literals, placeholders and IN
+lists normalised, so one ORM query called with different arguments is one
+group. The slowest sample of each group is EXPLAINed, and a group whose
+plan scans or sorts a whole table yields a candidate index on that table
+from the query's WHERE and ORDER BY columns:
+
+- columns compared with = or IN come first, then one range or ordering
+  column, the order a B-tree can serve them in;
+- IS NULL tests and bare boolean columns become the index condition,
+  making it a partial index;
+- where the database supports it and the query reads only a few other
+  columns, those are INCLUDEd so the index covers the query.
+
+Candidates an existing index already leads with are dropped, and one that
+is a prefix of another on the same table is folded into it. A candidate's
+estimated benefit is the sampled time of the queries it would serve; when
+verified, it is built inside a rolled-back transaction and the benefit is
+the measured saving instead.
+
+Only SQL as Django's compiler writes it ("table"."column" references,
+AND-ed conditions) is understood; other queries get no suggestions.
+"""
+import json
+import logging
+import re
+import time
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Index, Q
+
+logger = logging.getLogger(__name__)
+
+# Statements worth indexing for; inserts only get slower
+INDEXABLE_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE')
+# Columns a candidate index may have, and columns it may INCLUDE
+MAX_FIELDS = 4
+MAX_INCLUDE = 3
+# Characters of a query shape shown in reports
+SHAPE_PREVIEW = 160
+# Verified candidates saving less than this share of their queries' time are noise
+MIN_SAVING = 0.05
+
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<![\w\"])-?\d+(?:\.\d+)?(?![\w\"])|%s|\?")
+IN_LIST_RE = re.compile(r'IN \(\?(?:, \?)*\)')
+WHITESPACE_RE = re.compile(r'\s+')
+
+COLUMN = r'"(?P<table>\w+)"\."(?P<column>\w+)"'
+EQUALITY_RE = re.compile(COLUMN + r' (?:= |IN \()')
+RANGE_RE = re.compile(COLUMN + r' (?:[<>]=? |BETWEEN )')
+NULL_RE = re.compile(COLUMN + r' IS (?P<negated>NOT )?NULL')
+FLAG_RE = re.compile(r'(?:^|\(|AND )(?P<negated>NOT )?' + COLUMN + r'(?=\)|$| AND )')
+ORDER_RE = re.compile(COLUMN + r'(?: (?P<direction>ASC|DESC))?')
+MAIN_TABLE_RE = re.compile(r'^(?:SELECT .*? FROM|UPDATE|DELETE FROM) "(\w+)"')
+CLAUSE_END_RE = re.compile(r' (?:GROUP BY|HAVING|ORDER BY|LIMIT|OFFSET|RETURNING) ')
+
+
+def query_shape(sql):
+    """sql with literals and placeholders as ? and IN lists as IN (...)"""
+    shape = LITERAL_RE.sub('?', WHITESPACE_RE.sub(' ', sql).strip())
+    return IN_LIST_RE.sub('IN (...)', shape)
+
+
+def preview(shape):
+    """shape shortened for a report, eliding a long SELECT list first"""
+    if shape.startswith('SELECT ') and ' FROM ' in shape:
+        select, rest = shape[len('SELECT '):].split(' FROM ', 1)
+        if len(select) > 40:
+            shape = f'SELECT ... FROM {rest}'
+    return shape if len(shape) <= SHAPE_PREVIEW else shape[:SHAPE_PREVIEW - 3] + '...'
+
+
+class QueryGroup:
+    """Sampled queries of one shape, with the slowest as the example to EXPLAIN"""
+
+    def __init__(self, alias, shape):
+        self.alias = alias
+        self.shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.example = None
+        self.plan = None
+
+    def add(self, sample):
+        self.count += 1
+        self.total_ms += sample['ms']
+        if self.example is None or sample['ms'] > self.example['ms']:
+            self.example = sample
+
+
+def load_groups(lines):
+    """Group sample log lines by database and shape, skipping ones that can't use an index"""
+    groups = {}
+    for line_number, line in enumerate(lines, 1):
+        try:
+            sample = json.loads(line)
+            sql = sample['sql']
+            key = (sample['alias'], query_shape(sql))
+            sample['ms'] = float(sample['ms'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Skipping malformed query sample on line %s", line_number)
+            continue
+        if not key[1].startswith(INDEXABLE_STATEMENTS):
+            continue
+        if key not in groups:
+            groups[key] = QueryGroup(*key)
+        groups[key].add(sample)
+    return sorted(groups.values(), key=lambda group: -group.total_ms)
+
+
+def outer_query(sql):
+    """sql with parenthesised subqueries blanked out, leaving only the outer query's clauses"""
+    result = []
+    depth = 0
+    subquery_depth = None
+    for position, char in enumerate(sql):
+        if char == '(':
+            depth += 1
+            if subquery_depth is None and sql.startswith('SELECT ', position + 1):
+                subquery_depth = depth
+                result.append('(')
+        if subquery_depth is None:
+            result.append(char)
+        if char == ')':
+            if depth == subquery_depth:
+                subquery_depth = None
+                result.append(')')
+            depth -= 1
+    return ''.join(result)
+
+
+class QueryColumns:
+    """The columns of one table a Django-generated query filters and orders on"""
+
+    def __init__(self, sql):
+        sql = outer_query(WHITESPACE_RE.sub(' ', sql).strip())
+        match = MAIN_TABLE_RE.match(sql)
+        self.table = match.group(1) if match else None
+        self.select = []
+        self.equality = []
+        self.range = []
+        self.conditions = []
+        self.ordering = []
+        self.understood = self.table is not None
+        if not self.understood:
+            return
+
+        if sql.startswith('SELECT '):
+            select = sql[len('SELECT '):sql.index(' FROM ')]
+            self.select = [m['column'] for m in re.finditer(COLUMN, select) if m['table'] == self.table]
+            if self.select and len(self.select) != select.count(',') + 1:
+                self.select = []
+
+        where = ''
+        if ' WHERE ' in sql:
+            where = sql[sql.index(' WHERE ') + len(' WHERE '):]
+            end = CLAUSE_END_RE.search(where)
+            where = where[:end.start()] if end else where
+        # An index serves one branch of an OR at best; don't guess which
+        if ' OR ' in where:
+            self.understood = False
+            return
+        for m in NULL_RE.finditer(where):
+            if m['table'] == self.table:
+                self.conditions.append((m['column'], 'isnull', not m['negated']))
+        for m in FLAG_RE.finditer(where):
+            if m['table'] == self.table:
+                self.conditions.append((m['column'], 'exact', not m['negated']))
+        for m in EQUALITY_RE.finditer(where):
+            if m['table'] == self.table and not where[:m.start()].endswith('NOT ('):
+                self._add(self.equality, m['column'])
+        for m in RANGE_RE.finditer(where):
+            if m['table'] == self.table:
+                self._add(self.range, m['column'])
+
+        if ' ORDER BY ' in sql:
+            order_by = sql[sql.index(' ORDER BY ') + len(' ORDER BY '):]
+            end = CLAUSE_END_RE.search(order_by)
+            terms = (order_by[:end.start()] if end else order_by).split(', ')
+            for term in terms:
+                m = ORDER_RE.fullmatch(term.strip())
+                if not m or m['table'] != self.table:
+                    self.ordering = []
+                    break
+                self.ordering.append((m['column'], m['direction'] == 'DESC'))
+
+    @staticmethod
+    def _add(columns, column):
+        if column not in columns:
+            columns.append(column)
+
+
+class Plan:
+    """What EXPLAIN says a query does: the tables it reads in full and whether it sorts"""
+
+    def __init__(self, lines, scans, sorts, cost=None):
+        self.lines = lines
+        self.scans = scans
+        self.sorts = sorts
+        self.cost = cost
+
+    def needs_index(self, table, ordered):
+        return table in self.scans or (ordered and self.sorts)
+
+    def __str__(self):
+        return '; '.join(self.lines)
+
+
+def explain(connection, sql, params):
+    """EXPLAIN sql on connection as a Plan, or None where the backend isn't supported"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            lines = [row[-1] for row in cursor.fetchall()]
+            scans = {line.split()[1] for line in lines if line.startswith('SCAN ') and ' USING ' not in line}
+            sorts = any('TEMP B-TREE' in line for line in lines)
+            return Plan(lines, scans, sorts)
+        if connection.vendor == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            document = cursor.fetchone()[0]
+            root = (json.loads(document) if isinstance(document, str) else document)[0]['Plan']
+            lines, scans, sorts = [], set(), False
+            nodes = [root]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend(node.get('Plans', ()))
+                relation = node.get('Relation Name')
+                lines.append(f"{node['Node Type']} {relation}" if relation else node['Node Type'])
+                if node['Node Type'] == 'Seq Scan':
+                    scans.add(relation)
+                sorts = sorts or node['Node Type'] in ('Sort', 'Incremental Sort')
+            return Plan(lines, scans, sorts, root['Total Cost'])
+    return None
+
+
+def time_query(connection, sql, params, repeat=3):
+    """Best of repeat runs of a SELECT, in milliseconds"""
+    best = None
+    with connection.cursor() as cursor:
+        for _run in range(repeat):
+            started = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Candidate:
+    """A proposed index and the query groups it would serve"""
+
+    def __init__(self, model, fields, condition=None, include=()):
+        self.model = model
+        self.fields = fields
+        self.condition = condition
+        self.include = include
+        self.groups = []
+        self.measured_ms = None
+
+    @property
+    def columns(self):
+        return [self.model._meta.get_field(field.lstrip('-')).column for field in self.fields]
+
+    @property
+    def estimated_ms(self):
+        if self.measured_ms is not None:
+            return self.measured_ms
+        return sum(group.total_ms for group in self.groups)
+
+    def index(self):
+        index = Index(fields=self.fields, condition=self.condition, include=self.include, name='placeholder')
+        index.set_name_with_model(self.model)
+        return index
+
+    def absorbs(self, other):
+        # A wider index serves every query a prefix of it does
+        return (
+            other.model is self.model and other.condition == self.condition
+            and self.fields[:len(other.fields)] == other.fields
+        )
+
+
+def candidate_for(group, connection):
+    """The index that would serve group's example query, or None"""
+    columns = QueryColumns(group.example['sql'])
+    model = models_by_table().get(columns.table)
+    if not columns.understood or model is None:
+        return None
+    fields_by_column = {field.column: field for field in model._meta.concrete_fields}
+    if any(column not in fields_by_column for column, *_ in columns.conditions + columns.ordering):
+        return None
+    if any(column not in fields_by_column for column in columns.equality + columns.range + columns.select):
+        return None
+    condition_columns = {column for column, _lookup, _value in columns.conditions}
+    equality = [column for column in columns.equality if column not in condition_columns]
+    # Equality on a unique column is already served by its unique index
+    if any(fields_by_column[column].unique for column in equality):
+        return None
+
+    fields = [fields_by_column[column].name for column in equality]
+    ordering = [(fields_by_column[column].name, descending) for column, descending in columns.ordering]
+    if columns.range:
+        fields.append(fields_by_column[columns.range[0]].name)
+        # Ordering by the range column can still come from the index
+        if ordering and ordering[0][0] == fields[-1]:
+            ordering = ordering[1:]
+        else:
+            ordering = []
+    mixed = len({descending for _field, descending in ordering}) > 1
+    for field, descending in ordering:
+        if field not in fields:
+            fields.append(f'-{field}' if mixed and descending else field)
+    fields = fields[:MAX_FIELDS]
+    if not fields or fields == [model._meta.pk.name]:
+        return None
+
+    condition = None
+    for column, lookup, value in columns.conditions:
+        name = fields_by_column[column].name
+        term = Q(**{f'{name}__{lookup}' if lookup != 'exact' else name: value})
+        condition = term if condition is None else condition & term
+
+    include = ()
+    if connection.features.supports_covering_indexes and columns.select:
+        indexed = {field.lstrip('-') for field in fields}
+        rest = [fields_by_column[column].name for column in columns.select]
+        rest = [name for name in rest if name not in indexed]
+        if len(rest) <= MAX_INCLUDE:
+            include = tuple(rest)
+    return Candidate(model, fields, condition, include)
+
+
+def models_by_table():
+    return {model._meta.db_table: model for model in apps.get_models()}
+
+
+def existing_indexes(connection, table):
+    """Column lists of table's current indexes, including unique constraints and the primary key"""
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    return [
+        (constraint['columns'], constraint['unique'] or constraint['primary_key'])
+        for constraint in constraints.values()
+        if constraint['index'] or constraint['unique'] or constraint['primary_key']
+    ]
+
+
+def already_indexed(candidate, indexes):
+    columns = candidate.columns
+    for index_columns, unique in indexes:
+        if index_columns[:len(columns)] == columns:
+            return True
+        if unique and columns[:len(index_columns)] == index_columns:
+            return True
+    return False
+
+
+def advise(connection, groups, verify=False):
+    """
+    Candidates for the groups sampled on connection, most beneficial first.
+    Each group's plan is left on group.plan. With verify, each candidate is
+    built in a rolled-back transaction and its measured_ms set.
+    """
+    candidates = []
+    indexes = {}
+    for group in groups:
+        if group.alias != connection.alias:
+            continue
+        sql, params = group.example['sql'], group.example['params']
+        try:
+            group.plan = explain(connection, sql, params)
+        except Exception as error:
+            # Usually a table or column that has since been migrated away
+            logger.info("Couldn't EXPLAIN %s: %s", preview(group.shape), error)
+            continue
+        candidate = candidate_for(group, connection)
+        if candidate is None or group.plan is None:
+            continue
+        table = candidate.model._meta.db_table
+        ordered = ' ORDER BY ' in outer_query(sql)
+        if not group.plan.needs_index(table, ordered):
+            continue
+        if table not in indexes:
+            indexes[table] = existing_indexes(connection, table)
+        if already_indexed(candidate, indexes[table]):
+            continue
+        candidate.groups.append(group)
+        candidates.append(candidate)
+
+    merged = []
+    for candidate in sorted(candidates, key=lambda candidate: -len(candidate.fields)):
+        for wider in merged:
+            if wider.absorbs(candidate):
+                wider.groups.extend(candidate.groups)
+                break
+        else:
+            merged.append(candidate)
+    # Index names hash table and fields only, so keep one candidate per field list
+    unique = {}
+    for candidate in sorted(merged, key=lambda candidate: -candidate.estimated_ms):
+        unique.setdefault((candidate.model, tuple(candidate.fields)), candidate)
+    merged = list(unique.values())
+
+    if verify:
+        served_ms = {candidate: candidate.estimated_ms for candidate in merged}
+        for candidate in merged:
+            candidate.measured_ms = measure(connection, candidate)
+        merged = [candidate for candidate in merged if candidate.measured_ms >= served_ms[candidate] * MIN_SAVING]
+    return sorted(merged, key=lambda candidate: -candidate.estimated_ms)
+
+
+def measure(connection, candidate):
+    """Sampled milliseconds candidate saves, timed with and without it in a rolled-back transaction"""
+    editor = connection.schema_editor(collect_sql=True)
+    statement = str(candidate.index().create_sql(candidate.model, editor))
+    selects = [group for group in candidate.groups if group.shape.startswith('SELECT')]
+    saved = 0.0
+    with transaction.atomic(using=connection.alias):
+        before = [time_query(connection, group.example['sql'], group.example['params']) for group in selects]
+        with connection.cursor() as cursor:
+            cursor.execute(statement)
+        for group, before_ms in zip(selects, before):
+            after_ms = time_query(connection, group.example['sql'], group.example['params'])
+            # Scale the example's saving to the group's sampled time
+            if before_ms > 0:
+                saved += group.total_ms * max(0.0, 1 - after_ms / before_ms)
+        transaction.set_rollback(True, using=connection.alias)
+    return saved
@@ -0,0 +1,587 @@
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import re
+import time
+from datetime import date, datetime
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Business, ReferenceIdSequence, normalise_business_name
+from .reference_ids import ReferenceIdAllocator
+from .signals import businesses_loaded
+from .staging import table_swap_for_connection
+
+logger = logging.getLogger(__name__)
+
+# Business columns a registry file can supply, in load order. Rows are
+# matched to businesses on (state_code, registry_id); new businesses are
+# given an allocated reference_id.
+IMPORT_FIELDS = (
+    'registry_id', 'name', 'business_type', 'address', 'address2', 'city',
+    'state_code', 'zip_code', 'registered_agent', 'date_formed',
+    'last_filing_date', 'status',
+)
+REQUIRED_FIELDS = ('registry_id', 'name', 'business_type', 'address', 'city', 'zip_code', 'date_formed', 'status')
+DATE_FIELDS = ('date_formed', 'last_filing_date')
+# Registry content compared between imports; registry_id is the match key
+HASHED_FIELDS = IMPORT_FIELDS[1:]
+# Columns written for every new or changed row; created_at is only set on
+# insert, and new rows have no id until the database assigns one
+WRITE_FIELDS = ('id', 'reference_id') + IMPORT_FIELDS + ('search_key', 'content_hash', 'removed_at', 'updated_at')
+
+# ISO dates (YYYY-MM-DD or YYYYMMDD) are parsed directly; these are tried after
+DATE_FORMATS = ('%m/%d/%Y',)
+
+# Registry spellings of Business.BUSINESS_TYPES
+BUSINESS_TYPE_ALIASES = {
+    'LLC': 'LLC',
+    'LIMITED LIABILITY COMPANY': 'LLC',
+    'CORP': 'CORP',
+    'CORPORATION': 'CORP',
+    'BUSINESS CORPORATION': 'CORP',
+}
+
+# Registry spellings of Business.STATUSES, compared uppercased with
+# punctuation collapsed to single spaces; anything else is OTHER
+STATUS_ALIASES = {
+    'ACTIVE': Business.ACTIVE,
+    'CURRENT ACTIVE': Business.ACTIVE,
+    'IN EXISTENCE': Business.ACTIVE,
+    'GOOD STANDING': Business.ACTIVE,
+    'INACTIVE': Business.INACTIVE,
+    'DISSOLVED': Business.DISSOLVED,
+    'ADMIN DISSOLVED': Business.DISSOLVED,
+    'ADMINISTRATIVELY DISSOLVED': Business.DISSOLVED,
+    'REVOKED': Business.REVOKED,
+    'SUSPENDED': Business.SUSPENDED,
+    'FORFEITED': Business.SUSPENDED,
+    'WITHDRAWN': Business.WITHDRAWN,
+    'MERGED': Business.MERGED,
+}
+
+
+MAX_LENGTHS = {
+    field: Business._meta.get_field(field).max_length
+    for field in IMPORT_FIELDS
+    if Business._meta.get_field(field).max_length
+}
+
+
+# Changed reference IDs passed on with businesses_loaded; larger loads send None
+CHANGED_IDS_LIMIT = 10000
+
+
+class IngestError(Exception):
+    """An import that can't go ahead"""
+
+
+class RowError(IngestError, ValueError):
+    """A registry row that can't be loaded"""
+
+
+def open_text(path, encoding='utf-8'):
+    """Open a registry file for streaming, transparently un-gzipping .gz files"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding=encoding, newline='')
+    return open(path, encoding=encoding, newline='')
+
+
+def read_csv(stream):
+    """Yield (line_number, raw_row) for a CSV file whose header names Business fields"""
+    reader = csv.DictReader(stream)
+    missing = set(REQUIRED_FIELDS) - set(reader.fieldnames or ())
+    if missing:
+        raise RowError(f"CSV header is missing {', '.join(sorted(missing))}")
+    for row in reader:
+        yield reader.line_num, row
+
+
+def load_layout(path):
+    """Read a fixed-width layout: a JSON object mapping field name to [start, end) columns"""
+    with open(path) as layout_file:
+        layout = json.load(layout_file)
+    unknown = set(layout) - set(IMPORT_FIELDS)
+    if unknown:
+        raise RowError(f"Layout names unknown fields: {', '.join(sorted(unknown))}")
+    return {field: slice(start, end) for field, (start, end) in layout.items()}
+
+
+def read_fixed_width(stream, layout):
+    """Yield (line_number, raw_row) for a fixed-width file sliced by layout"""
+    for line_number, line in enumerate(stream, start=1):
+        line = line.rstrip('\r\n')
+        if line.strip():
+            yield line_number, {field: line[columns] for field, columns in layout.items()}
+
+
+def read_records(stream, layout=None):
+    """Records from a fixed-width file when a layout is given, else from a CSV file"""
+    if layout is not None:
+        return read_fixed_width(stream, layout)
+    return read_csv(stream)
+
+
+@functools.lru_cache(maxsize=256)
+def status_code(value):
+    """The Business.STATUSES code for a registry's status text; registries use only a handful"""
+    return STATUS_ALIASES.get(' '.join(re.split(r'[\W_]+', value.upper())).strip(), Business.OTHER)
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    raise RowError(f"unrecognised date {value!r}")
+
+
+def clean_row(raw, default_state=None):
+    """
+    Validate one raw registry row and return the Business column values,
+    including the derived search_key and content_hash. Raises RowError for
+    unusable rows.
+    """
+    row = {}
+    for field in IMPORT_FIELDS:
+        value = (raw.get(field) or '').strip()
+        row[field] = value or None
+    if default_state and not row['state_code']:
+        row['state_code'] = default_state
+
+    missing = [field for field in REQUIRED_FIELDS if not row[field]]
+    if missing:
+        raise RowError(f"missing {', '.join(missing)}")
+
+    business_type = BUSINESS_TYPE_ALIASES.get(row['business_type'].upper())
+    if business_type is None:
+        raise RowError(f"unknown business type {row['business_type']!r}")
+    row['business_type'] = business_type
+    row['status'] = status_code(row['status'])
+
+    state_code = (row['state_code'] or '').upper()
+    if len(state_code) != 2 or not state_code.isalpha():
+        raise RowError(f"invalid state code {row['state_code']!r}")
+    row['state_code'] = state_code
+
+    for field in DATE_FIELDS:
+        if row[field]:
+            row[field] = parse_date(row[field])
+
+    for field, max_length in MAX_LENGTHS.items():
+        if row[field] and len(row[field]) > max_length:
+            raise RowError(f"{field} is longer than {max_length} characters")
+
+    row['content_hash'] = content_hash(row)
+    row['search_key'] = normalise_business_name(row['name'])
+    return row
+
+
+def content_hash(values):
+    """SHA-1 over the HASHED_FIELDS of a cleaned row or a Business's field values"""
+    payload = '\x1f'.join('' if values[field] is None else str(values[field]) for field in HASHED_FIELDS)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+# Django defaults aren't database defaults, so raw inserts spell them out
+INSERT_ONLY_FIELDS = ('created_at', 'is_new', 'missing_filing')
+# Columns an upsert never changes on an existing row
+KEY_FIELDS = ('id', 'reference_id')
+
+
+def _insert_values(rows, columns):
+    """Yield rows as database-ready parameter lists, filling in insert-only defaults"""
+    ops = connection.ops
+    now = ops.adapt_datetimefield_value(timezone.now())
+    defaults = {'updated_at': now, 'created_at': now, 'removed_at': None, 'is_new': False, 'missing_filing': False}
+    for row in rows:
+        values = {**defaults, **row}
+        for field in DATE_FIELDS:
+            values[field] = ops.adapt_datefield_value(values[field])
+        yield [values[column] for column in columns]
+
+
+class BulkCreateWriter:
+    """Upserts batches with INSERT ... ON CONFLICT through bulk_create"""
+
+    def write(self, rows):
+        Business.objects.bulk_create(
+            [Business(**row) for row in rows],
+            update_conflicts=True,
+            unique_fields=['id'],
+            update_fields=[field for field in WRITE_FIELDS if field not in KEY_FIELDS],
+        )
+
+
+class PostgresCopyWriter:
+    """
+    Streams each batch into a temporary table with COPY, then upserts it into
+    table in one INSERT ... SELECT ... ON CONFLICT statement.
+    """
+    copy_table = 'core_business_import'
+
+    def __init__(self, table='core_business'):
+        self.table = table
+
+    def write(self, rows):
+        columns = WRITE_FIELDS + INSERT_ONLY_FIELDS
+        column_list = ', '.join(columns)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for values in _insert_values(rows, columns):
+            writer.writerow([_copy_value(value) for value in values])
+        buffer.seek(0)
+
+        with connection.cursor() as cursor:
+            # Without the live table's NOT NULL constraints, so new rows can leave id empty
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE IF NOT EXISTS {self.copy_table} ON COMMIT DELETE ROWS '
+                f'AS SELECT {column_list} FROM core_business WITH NO DATA'
+            )
+            cursor.copy_expert(
+                f"COPY {self.copy_table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer,
+            )
+            values = ', '.join(
+                f"COALESCE(id, nextval(pg_get_serial_sequence('{self.table}', 'id')))" if column == 'id' else column
+                for column in columns
+            )
+            cursor.execute(
+                f'INSERT INTO {self.table} ({column_list}) '
+                f'SELECT {values} FROM {self.copy_table} '
+                f'ON CONFLICT (id) DO UPDATE SET {_upsert_assignments()}'
+            )
+
+
+class SQLiteUpsertWriter:
+    """
+    Upserts each batch with one executemany() of INSERT ... ON CONFLICT,
+    skipping the per-field work bulk_create does for every row and its
+    999-parameter statement limit. New rows' NULL ids are numbered by SQLite.
+    """
+
+    def __init__(self, table='core_business'):
+        self.table = table
+
+    def write(self, rows):
+        columns = WRITE_FIELDS + INSERT_ONLY_FIELDS
+        placeholders = ', '.join(['%s'] * len(columns))
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {self.table} ({", ".join(columns)}) VALUES ({placeholders}) '
+                f'ON CONFLICT (id) DO UPDATE SET {_upsert_assignments()}',
+                list(_insert_values(rows, columns)),
+            )
+
+
+def _upsert_assignments():
+    return ', '.join(f'{column} = excluded.{column}' for column in WRITE_FIELDS if column not in KEY_FIELDS)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return value
+
+
+def writer_for_connection(table='core_business'):
+    if connection.vendor == 'postgresql':
+        return PostgresCopyWriter(table)
+    if connection.vendor == 'sqlite':
+        return SQLiteUpsertWriter(table)
+    return BulkCreateWriter()
+
+
+class SeenReferenceIds:
+    """
+    Temporary table of the reference IDs a full registry file listed, so the
+    businesses it no longer lists can be found with one anti-join instead of
+    holding millions of IDs in memory.
+    """
+    table = 'core_business_import_seen'
+
+    def __init__(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE IF NOT EXISTS {self.table} '
+                f'(reference_id varchar(255) PRIMARY KEY)'
+            )
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def add(self, reference_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {self.table} (reference_id) VALUES (%s) ON CONFLICT DO NOTHING',
+                [(reference_id,) for reference_id in reference_ids],
+            )
+
+    def missing(self, state_codes):
+        """Listed businesses in state_codes that the file didn't mention"""
+        return Business.objects.filter(state_code__in=state_codes, removed_at__isnull=True).exclude(
+            reference_id__in=RawSQL(f'SELECT reference_id FROM {self.table}', [])
+        )
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.rows = 0
+        self.errors = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        # Rows a reload wrote to its staging table, whether changed or not
+        self.loaded = 0
+        self.changed_ids = []
+        self.state_codes = set()
+
+    @property
+    def written(self):
+        return self.inserted + self.updated
+
+    def record_changes(self, reference_ids):
+        if self.changed_ids is not None:
+            self.changed_ids.extend(reference_ids)
+            if len(self.changed_ids) > CHANGED_IDS_LIMIT:
+                self.changed_ids = None
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def reference_id_allocator(block_size):
+    return ReferenceIdAllocator(ReferenceIdSequence.reserve, block_size)
+
+
+def changed_rows(rows, allocate):
+    """
+    Give each row of a cleaned batch, keyed by (state_code, registry_id),
+    the id and reference ID of the business it matches, or no id and a new
+    reference ID from allocate(), and split the batch into (new rows,
+    changed rows): rows whose content hash differs from the stored one, or
+    whose business was soft-deleted, count as changed.
+    """
+    # Excluding blank registry IDs lets the partial unique index serve the lookup
+    stored = {
+        (state_code, registry_id): (pk, reference_id, stored_hash, removed_at)
+        for state_code, registry_id, pk, reference_id, stored_hash, removed_at in Business.objects.filter(
+            state_code__in={state_code for state_code, _registry_id in rows},
+            registry_id__in=[registry_id for _state_code, registry_id in rows],
+        ).exclude(registry_id='').values_list('state_code', 'registry_id', 'pk', 'reference_id', 'content_hash', 'removed_at')
+    }
+    new, changed = [], []
+    for key, row in rows.items():
+        if key not in stored:
+            row['id'] = None
+            row['reference_id'] = allocate()
+            new.append(row)
+            continue
+        row['id'], row['reference_id'], stored_hash, removed_at = stored[key]
+        if (stored_hash, removed_at) != (row['content_hash'], None):
+            changed.append(row)
+    return new, changed
+
+
+def write_changes(rows, writer, stats, allocate, seen=None):
+    """Write the new and changed rows of one cleaned batch in a transaction, counting them in stats"""
+    # Matched outside the write transaction, so reserving a block of
+    # reference IDs doesn't hold the sequence row for the whole batch
+    new, changed = changed_rows(rows, allocate)
+    with transaction.atomic():
+        if new or changed:
+            writer.write(new + changed)
+        if seen:
+            seen.add(row['reference_id'] for row in rows.values())
+    stats.inserted += len(new)
+    stats.updated += len(changed)
+    stats.unchanged += len(rows) - len(new) - len(changed)
+    stats.record_changes(row['reference_id'] for row in new + changed)
+
+
+def remove_missing(seen, state_codes, stats, max_removed_fraction):
+    """Soft-delete the businesses in state_codes that a full file no longer lists"""
+    missing = seen.missing(state_codes)
+    count = missing.count()
+    if not count:
+        return
+    listed = count + stats.written + stats.unchanged
+    if count > max_removed_fraction * listed:
+        raise IngestError(
+            f"The file would remove {count} of {listed} businesses in {', '.join(sorted(state_codes))}; "
+            f"refusing in case it is truncated"
+        )
+    now = timezone.now()
+    reference_ids = list(missing.values_list('reference_id', flat=True))
+    for chunk in batched(reference_ids, 5000):
+        with transaction.atomic():
+            stats.removed += Business.objects.filter(reference_id__in=chunk).update(removed_at=now, updated_at=now)
+        stats.record_changes(chunk)
+
+
+def clean_batches(records, stats, batch_size=5000, default_state=None, max_errors=100, on_error=None):
+    """
+    Validate (line_number, raw_row) records and yield them in batches of up
+    to batch_size cleaned rows keyed by (state_code, registry_id), so later rows win when
+    a batch repeats one. Gives up with IngestError after max_errors bad rows.
+    """
+    for batch in batched(records, batch_size):
+        rows = {}
+        for line_number, raw in batch:
+            stats.rows += 1
+            try:
+                row = clean_row(raw, default_state)
+            except RowError as error:
+                stats.errors += 1
+                if on_error:
+                    on_error(line_number, error)
+                if stats.errors > max_errors:
+                    raise IngestError(f"Stopped after {stats.errors} invalid rows")
+                continue
+            rows[row['state_code'], row['registry_id']] = row
+            stats.state_codes.add(row['state_code'])
+        yield rows
+
+
+def log_stats(stats):
+    logger.info(
+        "Imported %s rows in %.1fs (%.0f rows/sec): %s inserted, %s updated, %s unchanged, "
+        "%s removed, %s invalid%s",
+        stats.rows, stats.elapsed, stats.rows_per_second, stats.inserted, stats.updated,
+        stats.unchanged, stats.removed, stats.errors,
+        f"; {stats.loaded} loaded into staging" if stats.loaded else "",
+    )
+
+
+def import_rows(records, writer=None, batch_size=5000, default_state=None, max_errors=100,
+                full=False, max_removed_fraction=0.1, on_error=None, on_batch=None):
+    """
+    Validate (line_number, raw_row) records in batches of batch_size and
+    write only the rows that are new or whose content hash changed, each
+    batch in its own transaction, holding at most one batch in memory.
+
+    With full=True the file is taken to list every business in the states it
+    covers, and listed businesses it leaves out are soft-deleted, unless
+    that would remove more than max_removed_fraction of them.
+
+    Sends businesses_loaded when anything changed and returns ImportStats.
+    """
+    writer = writer or writer_for_connection()
+    allocate = reference_id_allocator(batch_size)
+    stats = ImportStats()
+    seen = SeenReferenceIds() if full else None
+    try:
+        for rows in clean_batches(records, stats, batch_size, default_state, max_errors, on_error):
+            if rows:
+                write_changes(rows, writer, stats, allocate, seen)
+            if on_batch:
+                on_batch(stats)
+        if seen and stats.state_codes:
+            remove_missing(seen, stats.state_codes, stats, max_removed_fraction)
+    finally:
+        if seen:
+            seen.drop()
+
+    log_stats(stats)
+    if stats.written or stats.removed:
+        businesses_loaded.send(sender=Business, reference_ids=stats.changed_ids)
+    return stats
+
+
+def reload_rows(records, batch_size=5000, default_state=None, max_errors=100,
+                max_removed_fraction=0.1, on_error=None, on_batch=None):
+    """
+    Full reload of the states a file covers without touching the live table
+    until the end: rows are loaded into a staging copy of core_business,
+    businesses from other states and ones still referenced elsewhere are
+    carried over, the staging table is indexed and checked, and then swapped
+    in atomically (see core.staging). Refuses, leaving the live table as it
+    was, if the file would remove more than max_removed_fraction of the
+    listed businesses or leave a reference dangling.
+
+    Writes to the live table only wait while staging catches up with the
+    rows written since they were carried over, and the swap. Ones to
+    businesses the file lists are replaced by its rows.
+
+    Every valid row is counted as loaded; inserted, updated and unchanged
+    compare it with the live table. Sends businesses_loaded and returns
+    ImportStats.
+    """
+    swap = table_swap_for_connection()
+    if swap is None:
+        raise IngestError(f"Staging reloads aren't supported on {connection.vendor}")
+    allocate = reference_id_allocator(batch_size)
+    stats = ImportStats()
+    swap.create_staging()
+    try:
+        writer = writer_for_connection(swap.staging_table)
+        for rows in clean_batches(records, stats, batch_size, default_state, max_errors, on_error):
+            if rows:
+                # Matched against the live table so businesses keep their reference IDs
+                new, changed = changed_rows(rows, allocate)
+                with transaction.atomic():
+                    writer.write(list(rows.values()))
+                stats.loaded += len(rows)
+                stats.inserted += len(new)
+                stats.updated += len(changed)
+                stats.unchanged += len(rows) - len(new) - len(changed)
+            if on_batch:
+                on_batch(stats)
+        if not stats.state_codes:
+            raise IngestError("The file has no valid rows to reload")
+
+        carried_at = timezone.now()
+        swap.carry_over(stats.state_codes)
+        stats.removed, listed = swap.count_removed(stats.state_codes)
+        if stats.removed > max_removed_fraction * listed:
+            raise IngestError(
+                f"The file would remove {stats.removed} of {listed} businesses in "
+                f"{', '.join(sorted(stats.state_codes))}; refusing in case it is truncated"
+            )
+        swap.create_indexes()
+
+        # Only catching up with the rows written meanwhile holds writes up
+        with swap.writes_held():
+            swap.carry_over(stats.state_codes, since=carried_at)
+            dangling = swap.count_dangling()
+            if dangling:
+                raise IngestError(f"{dangling} references would point at missing businesses")
+            swap.swap()
+    except BaseException:
+        swap.drop_staging()
+        raise
+    swap.validate()
+
+    log_stats(stats)
+    businesses_loaded.send(sender=Business, reference_ids=None)
+    return stats
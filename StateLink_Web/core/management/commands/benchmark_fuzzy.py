@@ -0,0 +1,57 @@
+import random
+import statistics
+import string
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import fuzzy
+from core.models import Business
+
+
+def add_typo(name, rng):
+    """Apply one random deletion, insertion, substitution or transposition"""
+    if len(name) < 4:
+        return name
+    position = rng.randrange(1, len(name) - 1)
+    operation = rng.choice(('delete', 'insert', 'substitute', 'transpose'))
+    if operation == 'delete':
+        return name[:position] + name[position + 1:]
+    if operation == 'insert':
+        return name[:position] + rng.choice(string.ascii_lowercase) + name[position:]
+    if operation == 'substitute':
+        return name[:position] + rng.choice(string.ascii_lowercase) + name[position + 1:]
+    return name[:position - 1] + name[position] + name[position - 1] + name[position + 1:]
+
+
+class Command(BaseCommand):
+    help = "Time fuzzy business-name suggestions for misspelled names sampled from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200, help="Number of misspelled names to look up.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for sampling and typos.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        total = Business.objects.count()
+        if not total:
+            raise CommandError("No businesses to benchmark against.")
+        names = list(Business.objects.order_by('?').values_list('name', flat=True)[:options['queries']])
+
+        timings = []
+        hits = 0
+        for name in names:
+            query = add_typo(name, rng)
+            started = time.perf_counter()
+            suggestions = fuzzy.suggest(query)
+            timings.append((time.perf_counter() - started) * 1000)
+            if any(suggested_name == name for _reference_id, suggested_name, _state_code in suggestions):
+                hits += 1
+
+        timings.sort()
+        self.stdout.write(f"Businesses:  {total}")
+        self.stdout.write(f"Queries:     {len(timings)}")
+        self.stdout.write(f"Found:       {hits / len(timings):.1%} of misspelled names suggested back")
+        self.stdout.write(f"Median:      {statistics.median(timings):.2f} ms")
+        self.stdout.write(f"95th pct:    {timings[min(len(timings) - 1, int(len(timings) * 0.95))]:.2f} ms")
+        self.stdout.write(f"Max:         {timings[-1]:.2f} ms")
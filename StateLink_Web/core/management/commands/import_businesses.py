@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import ingest
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a state business registry file into Business, writing only "
+        "new and changed rows in large batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Registry file to load; .gz files are decompressed on the fly.")
+        parser.add_argument(
+            '--format', choices=('csv', 'fixed'), default='csv',
+            help="csv files need a header row naming Business fields; fixed needs --layout.",
+        )
+        parser.add_argument('--layout', help="JSON file mapping each field to its [start, end) columns.")
+        parser.add_argument('--state', help="State code for rows that don't carry one.")
+        parser.add_argument('--encoding', default='utf-8')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--max-errors', type=int, default=100, help="Abort after this many invalid rows.")
+        parser.add_argument('--progress-every', type=int, default=100000, help="Report progress every N rows.")
+        parser.add_argument(
+            '--full', action='store_true',
+            help="The file lists every business in its states; soft-delete the ones it leaves out.",
+        )
+        parser.add_argument(
+            '--reload', action='store_true',
+            help="Like --full, but load into a staging table and swap it in once complete.",
+        )
+        parser.add_argument(
+            '--max-removed-fraction', type=float, default=0.1,
+            help="With --full or --reload, refuse to remove more than this fraction of a state's businesses.",
+        )
+
+    def handle(self, *args, **options):
+        if options['format'] == 'fixed' and not options['layout']:
+            raise CommandError("--format fixed needs --layout.")
+        if options['full'] and options['reload']:
+            raise CommandError("--full and --reload can't be combined.")
+        next_report = options['progress_every']
+
+        def on_error(line_number, error):
+            self.stderr.write(f"Line {line_number}: {error}")
+
+        def on_batch(stats):
+            nonlocal next_report
+            if stats.rows >= next_report:
+                self.stdout.write(f"{stats.rows} rows, {stats.rows_per_second:.0f} rows/sec")
+                next_report += options['progress_every']
+
+        try:
+            with ingest.open_text(options['path'], options['encoding']) as stream:
+                layout = ingest.load_layout(options['layout']) if options['format'] == 'fixed' else None
+                records = ingest.read_records(stream, layout)
+                load_options = {
+                    'batch_size': options['batch_size'],
+                    'default_state': options['state'],
+                    'max_errors': options['max_errors'],
+                    'max_removed_fraction': options['max_removed_fraction'],
+                    'on_error': on_error,
+                    'on_batch': on_batch,
+                }
+                if options['reload']:
+                    stats = ingest.reload_rows(records, **load_options)
+                else:
+                    stats = ingest.import_rows(records, full=options['full'], **load_options)
+        except (OSError, ingest.IngestError) as error:
+            raise CommandError(str(error))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Read {stats.rows} rows in {stats.elapsed:.1f}s ({stats.rows_per_second:.0f} rows/sec): "
+            f"{stats.inserted} inserted, {stats.updated} updated, {stats.unchanged} unchanged, "
+            f"{stats.removed} removed, {stats.errors} invalid"
+            + (f"; {stats.loaded} loaded into staging" if stats.loaded else "")
+        ))
@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core import pipeline
+
+
+class Command(BaseCommand):
+    help = (
+        "Import several state registry files at once: each file is parsed in "
+        "its own worker process and a single writer loads the changes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'sources', nargs='+', metavar='STATE=PATH',
+            help="State code and registry file, e.g. NC=nc.csv.gz. CSV unless a --layout is given for the state.",
+        )
+        parser.add_argument(
+            '--layout', action='append', default=[], metavar='STATE=PATH',
+            help="Fixed-width layout JSON for a state's file. May be repeated.",
+        )
+        parser.add_argument('--workers', type=int, help="Worker processes; defaults to one per file, up to the CPU count.")
+        parser.add_argument('--encoding', default='utf-8')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--max-errors', type=int, default=100, help="Fail a state after this many invalid rows.")
+        parser.add_argument('--progress-every', type=int, default=100000, help="Report progress every N rows per state.")
+        parser.add_argument(
+            '--full', action='store_true',
+            help="Each file lists every business in its state; soft-delete the ones it leaves out.",
+        )
+        parser.add_argument(
+            '--max-removed-fraction', type=float, default=0.1,
+            help="With --full, refuse to remove more than this fraction of a state's businesses.",
+        )
+
+    def parse_pairs(self, values, option):
+        pairs = {}
+        for value in values:
+            state, separator, path = value.partition('=')
+            if not separator or len(state) != 2 or not path:
+                raise CommandError(f"{option} expects STATE=PATH, got {value!r}.")
+            if state.upper() in pairs:
+                raise CommandError(f"{state.upper()} is given more than once.")
+            pairs[state.upper()] = path
+        return pairs
+
+    def handle(self, *args, **options):
+        paths = self.parse_pairs(options['sources'], 'sources')
+        layouts = self.parse_pairs(options['layout'], '--layout')
+        unknown = set(layouts) - set(paths)
+        if unknown:
+            raise CommandError(f"--layout given for states with no file: {', '.join(sorted(unknown))}.")
+        sources = [
+            pipeline.StateSource(state, path, layouts.get(state), options['encoding'])
+            for state, path in paths.items()
+        ]
+        next_report = {state: options['progress_every'] for state in paths}
+
+        def on_error(state, message):
+            self.stderr.write(f"{state}: {message}")
+
+        def on_batch(metrics):
+            if metrics.loaded_rows >= next_report[metrics.state]:
+                self.stdout.write(
+                    f"{metrics.state}: {metrics.loaded_rows} rows, "
+                    f"writing at {metrics.write_rows_per_second:.0f} rows/sec"
+                )
+                next_report[metrics.state] += options['progress_every']
+
+        metrics = pipeline.import_states(
+            sources,
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            max_errors=options['max_errors'],
+            full=options['full'],
+            max_removed_fraction=options['max_removed_fraction'],
+            on_error=on_error,
+            on_batch=on_batch,
+        )
+
+        failed = []
+        for state, state_metrics in metrics.items():
+            writes = state_metrics.writes
+            self.stdout.write(
+                f"{state}: {writes.rows} rows, parsed at {state_metrics.parse_rows_per_second:.0f} rows/sec "
+                f"({state_metrics.blocked_seconds:.1f}s waiting on the writer), written at "
+                f"{state_metrics.write_rows_per_second:.0f} rows/sec: {writes.inserted} inserted, "
+                f"{writes.updated} updated, {writes.unchanged} unchanged, {writes.removed} removed, "
+                f"{writes.errors} invalid"
+            )
+            if state_metrics.error:
+                failed.append(f"{state}: {state_metrics.error}")
+        if failed:
+            raise CommandError("Some states failed to load:\n" + "\n".join(failed))
@@ -0,0 +1,114 @@
+import os
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations import AddIndex, Migration
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+
+from core import index_advisor
+
+
+class Command(BaseCommand):
+    help = (
+        "Propose indexes for the queries sampled by QUERY_SAMPLE_RATE, EXPLAINing the slowest "
+        "of each shape, and print (or write) a migration adding them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', help="Query sample log to read. Defaults to QUERY_SAMPLE_LOG.")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help="Database whose queries to analyse.")
+        parser.add_argument('--top', type=int, default=10, help="Most indexes to propose.")
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="Build each proposed index in a rolled-back transaction and time the queries with it. "
+                 "Building blocks writes to the table meanwhile.",
+        )
+        parser.add_argument('--write', action='store_true', help="Write the migration into the app instead of printing it.")
+        parser.add_argument('--name', default='index_advisor', help="Name of the migration.")
+        parser.add_argument(
+            '--concurrently', action='store_true',
+            help="Build the indexes with CREATE INDEX CONCURRENTLY (PostgreSQL only).",
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if options['concurrently'] and connection.vendor != 'postgresql':
+            raise CommandError("--concurrently needs PostgreSQL.")
+        path = options['log'] or settings.QUERY_SAMPLE_LOG
+        try:
+            with open(path, encoding='utf-8') as log:
+                groups = index_advisor.load_groups(log)
+        except FileNotFoundError:
+            raise CommandError(f"No query samples at {path}; set QUERY_SAMPLE_RATE to collect some.")
+
+        candidates = index_advisor.advise(connection, groups, options['verify'])[:options['top']]
+        sampled_ms = sum(group.total_ms for group in groups if group.alias == connection.alias)
+        sampled = sum(group.count for group in groups if group.alias == connection.alias)
+        self.stdout.write(f"{sampled} sampled queries of {len(groups)} shapes, {sampled_ms:.0f} ms in total.")
+        if not candidates:
+            self.stdout.write("No indexes to propose.")
+            return
+
+        for number, candidate in enumerate(candidates, 1):
+            self.report(number, candidate, sampled_ms, options['verify'])
+        self.write_migrations(candidates, options)
+
+    def report(self, number, candidate, sampled_ms, verified):
+        model = candidate.model
+        self.stdout.write('')
+        self.stdout.write(f"{number}. {model._meta.label} ({', '.join(candidate.fields)})")
+        if candidate.condition is not None:
+            self.stdout.write(f"   partial: {candidate.condition}")
+        if candidate.include:
+            self.stdout.write(f"   include: {', '.join(candidate.include)}")
+        queries = sum(group.count for group in candidate.groups)
+        share = candidate.estimated_ms / sampled_ms if sampled_ms else 0
+        kind = "measured saving" if verified else "sampled time served, at most"
+        self.stdout.write(f"   benefit: {candidate.estimated_ms:.0f} ms ({share:.1%}) over {queries} queries, {kind}")
+        for group in candidate.groups:
+            self.stdout.write(f"   query:   {index_advisor.preview(group.shape)}")
+            self.stdout.write(f"   plan:    {group.plan}")
+
+    def write_migrations(self, candidates, options):
+        by_app = defaultdict(list)
+        for candidate in candidates:
+            by_app[candidate.model._meta.app_label].append(candidate)
+
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        for app_label, app_candidates in by_app.items():
+            leaves = loader.graph.leaf_nodes(app_label)
+            number = MigrationAutodetector.parse_number(leaves[-1][1]) + 1 if leaves else 1
+            migration = Migration(f"{number:04d}_{options['name']}", app_label)
+            migration.dependencies = leaves
+            operation = AddIndex
+            if options['concurrently']:
+                from django.contrib.postgres.operations import AddIndexConcurrently as operation
+            migration.operations = [
+                operation(model_name=candidate.model._meta.model_name, index=candidate.index())
+                for candidate in app_candidates
+            ]
+            writer = MigrationWriter(migration)
+            source = writer.as_string()
+            if options['concurrently']:
+                source = source.replace(
+                    'class Migration(migrations.Migration):\n',
+                    'class Migration(migrations.Migration):\n\n    atomic = False\n', 1,
+                )
+
+            self.stdout.write('')
+            if options['write']:
+                with open(writer.path, 'w', encoding='utf-8') as migration_file:
+                    migration_file.write(source)
+                self.stdout.write(f"Wrote {os.path.relpath(writer.path)}")
+            else:
+                self.stdout.write(f"# {os.path.relpath(writer.path)}")
+                self.stdout.write(source)
+
+            # Otherwise the next makemigrations drops the indexes again
+            self.stdout.write("Add to the models' Meta.indexes:")
+            for candidate in app_candidates:
+                self.stdout.write(f"    {candidate.model.__name__}: {MigrationWriter.serialize(candidate.index())[0]},")
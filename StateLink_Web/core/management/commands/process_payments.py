@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core import payments
+
+
+class Command(BaseCommand):
+    help = (
+        "Charge the payments queued by the payment page, oldest first. Runs until stopped; "
+        "start one or more alongside the web workers. Payments a dead worker left processing are "
+        "marked unconfirmed after PAYMENT_PROCESSING_TIMEOUT seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+
+    def handle(self, *args, **options):
+        while True:
+            # Long-running, so drop connections the database has timed out
+            close_old_connections()
+            payments.reap_stalled()
+            payment = payments.claim_next()
+            if payment is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+            payments.process(payment)
+            self.stdout.write(f"{payment.order_reference}: {payment.get_status_display()}")
@@ -0,0 +1,25 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.flags import recompute_flags
+
+
+class Command(BaseCommand):
+    help = "Recompute Business.is_new and Business.missing_filing from their dates. Run nightly."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Recompute as of this YYYY-MM-DD instead of today.")
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Rows per primary-key range.")
+
+    def handle(self, *args, **options):
+        try:
+            today = date.fromisoformat(options['date']) if options['date'] else None
+        except ValueError:
+            raise CommandError(f"--date must be YYYY-MM-DD, got {options['date']!r}.")
+        started = time.monotonic()
+        flipped = recompute_flags(today, options['chunk_size'])
+        for flag, counts in flipped.items():
+            self.stdout.write(f"{flag}: {counts['set']} set, {counts['cleared']} cleared")
+        self.stdout.write(self.style.SUCCESS(f"Done in {time.monotonic() - started:.1f}s"))
@@ -0,0 +1,85 @@
+from django.db import migrations
+
+# The search index as core.search's backends defined it for this migration,
+# copied here so later changes to core.search don't change what it does.
+# Later migrations that rebuild core_business reinstall it from here.
+FTS_TABLE = 'core_business_fts'
+
+TRIGRAM_INDEXES = {
+    'core_business_name_trgm': 'name',
+    'core_business_ref_trgm': 'reference_id',
+}
+
+
+def install_sqlite(schema_editor):
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"name, reference_id, content='core_business', content_rowid='rowid', "
+        f"tokenize='trigram')"
+    )
+    schema_editor.execute(
+        f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON core_business BEGIN '
+        f'INSERT INTO {FTS_TABLE}(rowid, name, reference_id) '
+        f'VALUES (new.rowid, new.name, new.reference_id); END'
+    )
+    schema_editor.execute(
+        f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON core_business BEGIN '
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, reference_id) "
+        f"VALUES ('delete', old.rowid, old.name, old.reference_id); END"
+    )
+    schema_editor.execute(
+        f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name, reference_id '
+        f'ON core_business BEGIN '
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, reference_id) "
+        f"VALUES ('delete', old.rowid, old.name, old.reference_id); "
+        f'INSERT INTO {FTS_TABLE}(rowid, name, reference_id) '
+        f'VALUES (new.rowid, new.name, new.reference_id); END'
+    )
+    schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def uninstall_sqlite(schema_editor):
+    for suffix in ('ai', 'ad', 'au'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}')
+    schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def install_postgresql(schema_editor):
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for index_name, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {index_name} ON core_business '
+            f'USING gin (UPPER({column}) gin_trgm_ops)'
+        )
+
+
+def uninstall_postgresql(schema_editor):
+    for index_name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {index_name}')
+
+
+INSTALL = {'sqlite': install_sqlite, 'postgresql': install_postgresql}
+UNINSTALL = {'sqlite': uninstall_sqlite, 'postgresql': uninstall_postgresql}
+
+
+def install_search_index(apps, schema_editor):
+    # Other databases search with plain icontains lookups
+    install = INSTALL.get(schema_editor.connection.vendor)
+    if install is not None:
+        install(schema_editor)
+
+
+def uninstall_search_index(apps, schema_editor):
+    uninstall = UNINSTALL.get(schema_editor.connection.vendor)
+    if uninstall is not None:
+        uninstall(schema_editor)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0013_remove_compliancerequest_order_reference_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
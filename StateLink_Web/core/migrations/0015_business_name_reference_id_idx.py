@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-17 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_business_search_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='business',
+            name='core_busine_name_b3e876_idx',
+        ),
+        migrations.AddIndex(
+            model_name='business',
+            index=models.Index(fields=['name', 'reference_id'], name='core_busine_name_461746_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.0.6 on 2026-10-17 12:43
+
+import importlib
+import re
+
+from django.db import migrations, models
+
+install_search_index = importlib.import_module('core.migrations.0014_business_search_index').install_search_index
+
+BATCH_SIZE = 5000
+
+# core.models.normalise_business_name as it was when this migration was
+# written, so changing it later doesn't change what the backfill wrote
+ENTITY_SUFFIXES = {
+    'co', 'company', 'corp', 'corporation', 'inc', 'incorporated', 'limited',
+    'llc', 'llp', 'lp', 'ltd', 'pa', 'pc', 'pllc',
+}
+
+
+def normalise_business_name(value):
+    value = (value or '').casefold().replace('&', ' and ')
+    value = re.sub(r"[.'\u2019]", '', value)
+    words = re.sub(r'[\W_]+', ' ', value).split()
+    while len(words) > 1 and words[-1] in ENTITY_SUFFIXES:
+        words.pop()
+    return ' '.join(words)
+
+
+def backfill_search_key(apps, schema_editor):
+    Business = apps.get_model('core', 'Business')
+    last_pk = None
+    while True:
+        batch = Business.objects.order_by('pk').only('pk', 'name')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        for business in batch:
+            business.search_key = normalise_business_name(business.name)
+        Business.objects.bulk_update(batch, ['search_key'], batch_size=BATCH_SIZE)
+        last_pk = batch[-1].pk
+
+
+def reinstall_search_index(apps, schema_editor):
+    # SQLite adds the column by rebuilding core_business, which drops the
+    # FTS triggers and renumbers rowids; installing again restores both
+    install_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_business_name_reference_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='business',
+            name='search_key',
+            field=models.CharField(blank=True, default='', editable=False, help_text='normalise_business_name(name), set on save. Bulk loaders must set it themselves.', max_length=255, verbose_name='Search Key'),
+        ),
+        migrations.RunPython(reinstall_search_index, migrations.RunPython.noop),
+        migrations.RunPython(backfill_search_key, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='business',
+            index=models.Index(fields=['search_key', 'reference_id'], name='core_business_search_key_idx', opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+        ),
+    ]
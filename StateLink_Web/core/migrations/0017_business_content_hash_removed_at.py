@@ -0,0 +1,67 @@
+# Generated by Django 5.0.6 on 2026-10-17 12:57
+
+import hashlib
+import importlib
+
+from django.db import migrations, models
+
+install_search_index = importlib.import_module('core.migrations.0014_business_search_index').install_search_index
+
+BATCH_SIZE = 5000
+
+# core.ingest's hashed fields and content_hash as they were when this
+# migration was written; 0018 rehashes with the fields it changed to
+IMPORT_FIELDS = (
+    'reference_id', 'name', 'business_type', 'address', 'address2', 'city',
+    'state_code', 'zip_code', 'registered_agent', 'date_formed',
+    'last_filing_date', 'status',
+)
+
+
+def content_hash(values):
+    payload = '\x1f'.join('' if values[field] is None else str(values[field]) for field in IMPORT_FIELDS)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def backfill_content_hash(apps, schema_editor):
+    # Hash current rows so the first delta import only touches real changes
+    Business = apps.get_model('core', 'Business')
+    last_pk = None
+    while True:
+        batch = Business.objects.order_by('pk').only(*IMPORT_FIELDS)
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        for business in batch:
+            business.content_hash = content_hash(business.__dict__)
+        Business.objects.bulk_update(batch, ['content_hash'], batch_size=BATCH_SIZE)
+        last_pk = batch[-1].pk
+
+
+def reinstall_search_index(apps, schema_editor):
+    # Adding a NOT NULL column rebuilds core_business on SQLite; see 0016
+    install_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_business_search_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='business',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Hash of the registry fields as last imported, used to skip unchanged rows.', max_length=40, verbose_name='Content Hash'),
+        ),
+        migrations.AddField(
+            model_name='business',
+            name='removed_at',
+            field=models.DateTimeField(blank=True, help_text='When the business disappeared from its state registry file. Removed businesses are hidden from search.', null=True, verbose_name='Removed At'),
+        ),
+        migrations.RunPython(reinstall_search_index, migrations.RunPython.noop),
+        migrations.RunPython(backfill_content_hash, migrations.RunPython.noop),
+    ]
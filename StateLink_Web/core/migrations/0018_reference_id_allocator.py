@@ -0,0 +1,117 @@
+# Generated by Django 5.0.6 on 2026-10-17 13:13
+
+import hashlib
+import importlib
+import re
+
+import core.models
+from django.db import migrations, models
+
+install_search_index = importlib.import_module('core.migrations.0014_business_search_index').install_search_index
+
+BATCH_SIZE = 5000
+
+# core.ingest's content hash and core.reference_ids.normalise as they were
+# for this migration, copied so later changes to them don't change what it does
+HASHED_FIELDS = (
+    'name', 'business_type', 'address', 'address2', 'city', 'state_code', 'zip_code',
+    'registered_agent', 'date_formed', 'last_filing_date', 'status',
+)
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+BASE = len(ALPHABET)
+REFERENCE_ID_RE = re.compile(rf'^[{ALPHABET}]{{9}}$')
+LEGACY_REFERENCE_ID_RE = re.compile(r'^[0-9a-f]{8}$')
+LOOKALIKES = str.maketrans('OIL', '011')
+SEPARATORS_RE = re.compile(r'[\s-]+')
+
+
+def content_hash(values):
+    payload = '\x1f'.join('' if values[field] is None else str(values[field]) for field in HASHED_FIELDS)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def check_character(payload):
+    total = 0
+    factor = 2
+    for char in reversed(payload):
+        addend = factor * ALPHABET.index(char)
+        total += addend // BASE + addend % BASE
+        factor = 3 - factor
+    return ALPHABET[-total % BASE]
+
+
+def normalise(value):
+    value = SEPARATORS_RE.sub('', value or '')
+    if LEGACY_REFERENCE_ID_RE.match(value.lower()):
+        return value.lower()
+    value = value.upper().translate(LOOKALIKES)
+    if REFERENCE_ID_RE.match(value) and check_character(value[:-1]) == value[-1]:
+        return value
+    return None
+
+
+def backfill_registry_id(apps, schema_editor):
+    # Imports used to store the registry's identifier as the reference ID;
+    # anything not shaped like one of our IDs came from a registry file.
+    # Their content hash no longer covers the identifier either.
+    Business = apps.get_model('core', 'Business')
+    last_pk = None
+    while True:
+        batch = Business.objects.order_by('pk').only('reference_id', *HASHED_FIELDS)
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        imported = [business for business in batch if normalise(business.reference_id) != business.reference_id]
+        for business in imported:
+            business.registry_id = business.reference_id
+            business.content_hash = content_hash(business.__dict__)
+        Business.objects.bulk_update(imported, ['registry_id', 'content_hash'], batch_size=BATCH_SIZE)
+        last_pk = batch[-1].pk
+
+
+def create_business_sequence(apps, schema_editor):
+    ReferenceIdSequence = apps.get_model('core', 'ReferenceIdSequence')
+    ReferenceIdSequence.objects.get_or_create(name='business')
+
+
+def reinstall_search_index(apps, schema_editor):
+    # Adding a NOT NULL column rebuilds core_business on SQLite; see 0016
+    install_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_business_content_hash_removed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceIdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('next_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='business',
+            name='registry_id',
+            field=models.CharField(blank=True, default='', help_text="The state registry's own identifier, which imports match rows on.", max_length=64, verbose_name='Registry ID'),
+        ),
+        migrations.AlterField(
+            model_name='business',
+            name='reference_id',
+            field=models.CharField(default=core.models.allocate_reference_id, help_text='The unique identifier for the business entity.', max_length=255, primary_key=True, serialize=False, verbose_name='Reference ID'),
+        ),
+        migrations.AddConstraint(
+            model_name='business',
+            constraint=models.UniqueConstraint(condition=models.Q(('registry_id', ''), _negated=True), fields=('state_code', 'registry_id'), name='core_business_registry_id_uniq'),
+        ),
+        migrations.RunPython(create_business_sequence, migrations.RunPython.noop),
+        migrations.RunPython(backfill_registry_id, migrations.RunPython.noop),
+        migrations.RunPython(reinstall_search_index, migrations.RunPython.noop),
+    ]
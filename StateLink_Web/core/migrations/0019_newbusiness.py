@@ -0,0 +1,215 @@
+# Generated by Django 5.0.6 on 2026-10-17 14:02
+#
+# First half of moving core_business to an integer primary key. This
+# migration isn't atomic and only creates and fills a new table, so it can
+# run while the site is up: the copy commits every BATCH_SIZE rows and the
+# live table is only read. 0020 copies whatever changed in the meantime and
+# swaps the new table in.
+
+import importlib
+import re
+
+import core.models
+from django.db import migrations, models, transaction
+from django.db.models import F
+
+allocator = importlib.import_module('core.migrations.0018_reference_id_allocator')
+content_hash = allocator.content_hash
+normalise = allocator.normalise
+
+BATCH_SIZE = 5000
+
+# core.ingest.status_code and core.reference_ids.encode as they were when
+# this migration was written, so later changes to them don't change what it does
+STATUS_ALIASES = {
+    'ACTIVE': 1,
+    'CURRENT ACTIVE': 1,
+    'IN EXISTENCE': 1,
+    'GOOD STANDING': 1,
+    'INACTIVE': 2,
+    'DISSOLVED': 3,
+    'ADMIN DISSOLVED': 3,
+    'ADMINISTRATIVELY DISSOLVED': 3,
+    'REVOKED': 4,
+    'SUSPENDED': 5,
+    'FORFEITED': 5,
+    'WITHDRAWN': 6,
+    'MERGED': 7,
+}
+OTHER_STATUS = 99
+
+PAYLOAD_LENGTH = 8
+CAPACITY = allocator.BASE ** PAYLOAD_LENGTH
+MULTIPLIERS = (0x5DEECE66D, 0x2545F4914F)
+SHIFT = 20
+XOR = 0x3A5C96F0E1
+
+
+def status_code(value):
+    return STATUS_ALIASES.get(' '.join(re.split(r'[\W_]+', value.upper())).strip(), OTHER_STATUS)
+
+
+def encode(number):
+    number = (number * MULTIPLIERS[0]) % CAPACITY
+    number ^= number >> SHIFT
+    number = ((number * MULTIPLIERS[1]) % CAPACITY) ^ XOR
+    chars = []
+    for _position in range(PAYLOAD_LENGTH):
+        number, digit = divmod(number, allocator.BASE)
+        chars.append(allocator.ALPHABET[digit])
+    payload = ''.join(reversed(chars))
+    return payload + allocator.check_character(payload)
+
+# core_newbusiness columns filled from core_business
+COPIED_FIELDS = (
+    'reference_id', 'registry_id', 'name', 'business_type', 'address', 'address2', 'city',
+    'state_code', 'zip_code', 'registered_agent', 'date_formed', 'last_filing_date', 'status',
+    'is_new', 'missing_filing', 'created_at', 'updated_at', 'search_key', 'content_hash', 'removed_at',
+)
+DATE_FIELDS = ('date_formed', 'last_filing_date')
+DATETIME_FIELDS = ('created_at', 'updated_at', 'removed_at')
+
+
+def reassign_reference_ids(apps, schema_editor):
+    # The new column is only as wide as an allocated ID. Rows whose ID isn't
+    # one (0018 kept those values in registry_id) get a freshly allocated ID,
+    # along with the compliance requests pointing at them.
+    Business = apps.get_model('core', 'Business')
+    ComplianceRequest = apps.get_model('core', 'ComplianceRequest')
+    ReferenceIdSequence = apps.get_model('core', 'ReferenceIdSequence')
+    ReferenceIdSequence.objects.get_or_create(name='business')
+
+    last_pk = None
+    while True:
+        batch = Business.objects.order_by('pk').values_list('pk', flat=True)
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1]
+        odd = [reference_id for reference_id in batch if normalise(reference_id) != reference_id]
+        if not odd:
+            continue
+        with transaction.atomic():
+            sequence = ReferenceIdSequence.objects.filter(name='business')
+            sequence.update(next_value=F('next_value') + len(odd))
+            end = sequence.values_list('next_value', flat=True).get()
+            for number, reference_id in zip(range(end - len(odd), end), odd):
+                Business.objects.filter(pk=reference_id).update(reference_id=encode(number))
+                ComplianceRequest.objects.filter(business_id=reference_id).update(business_id=encode(number))
+
+
+def copy_rows(connection, businesses):
+    """Upsert the given core_business rows into core_newbusiness by reference_id"""
+    ops = connection.ops
+    rows = []
+    for values in businesses.values(*COPIED_FIELDS):
+        values['status'] = status_code(values['status'])
+        if values['content_hash']:
+            values['content_hash'] = content_hash(values)
+        for field in DATE_FIELDS:
+            values[field] = ops.adapt_datefield_value(values[field])
+        for field in DATETIME_FIELDS:
+            values[field] = ops.adapt_datetimefield_value(values[field])
+        rows.append([values[field] for field in COPIED_FIELDS])
+    assignments = ', '.join(f'{field} = excluded.{field}' for field in COPIED_FIELDS if field != 'reference_id')
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO core_newbusiness ({", ".join(COPIED_FIELDS)}) '
+            f'VALUES ({", ".join(["%s"] * len(COPIED_FIELDS))}) '
+            f'ON CONFLICT (reference_id) DO UPDATE SET {assignments}',
+            rows,
+        )
+
+
+def copy_businesses(apps, schema_editor):
+    Business = apps.get_model('core', 'Business')
+    last_pk = None
+    while True:
+        batch = Business.objects.order_by('pk').values_list('pk', flat=True)
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic():
+            copy_rows(schema_editor.connection, Business.objects.filter(pk__in=batch))
+        last_pk = batch[-1]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('core', '0018_reference_id_allocator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NewBusiness',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(help_text='The legal name of the business entity.', max_length=255, verbose_name='Business Name')),
+                ('reference_id', models.CharField(default=core.models.allocate_reference_id, help_text='The unique identifier for the business entity, as printed on letters.', max_length=9, unique=True, verbose_name='Reference ID')),
+                ('registry_id', models.CharField(blank=True, default='', help_text="The state registry's own identifier, which imports match rows on.", max_length=64, verbose_name='Registry ID')),
+                ('business_type', models.CharField(choices=[('CORP', 'Corporation'), ('LLC', 'Limited Liability Company')], help_text='Type of business entity.', max_length=10, verbose_name='Business Type')),
+                ('address', models.TextField(help_text='Main business address line 1.', verbose_name='Primary Address')),
+                ('address2', models.TextField(blank=True, help_text='Optional second line of the address.', null=True, verbose_name='Secondary Address')),
+                ('city', models.CharField(help_text='City where the business is located.', max_length=100, verbose_name='City')),
+                ('state_code', models.CharField(choices=[('NC', 'North Carolina')], help_text='Two-letter abbreviation for the U.S. state.', max_length=2, verbose_name='State Code')),
+                ('zip_code', models.CharField(help_text='ZIP or postal code for the business address.', max_length=10, verbose_name='ZIP Code')),
+                ('registered_agent', models.CharField(blank=True, help_text='Registered agent of the business.', max_length=255, null=True, verbose_name='Registered Agent')),
+                ('date_formed', models.DateField(help_text='Date the business was legally formed/incorporated.', verbose_name='Date Formed')),
+                ('last_filing_date', models.DateField(blank=True, help_text='Date of the last annual report or filing.', null=True, verbose_name='Last Filing Date')),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Active'), (2, 'Inactive'), (3, 'Dissolved'), (4, 'Revoked'), (5, 'Suspended'), (6, 'Withdrawn'), (7, 'Merged'), (99, 'Other')], help_text='Current status of the business (e.g., Active, Dissolved).', verbose_name='Status')),
+                ('is_new', models.BooleanField(default=False, help_text='Flag for businesses formed in the last 30 days.')),
+                ('missing_filing', models.BooleanField(default=False, help_text='True if the business has missed a required filing.')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('search_key', models.CharField(blank=True, default='', editable=False, help_text='normalise_business_name(name), set on save. Bulk loaders must set it themselves.', max_length=255, verbose_name='Search Key')),
+                ('content_hash', models.CharField(blank=True, default='', editable=False, help_text='Hash of the registry fields as last imported, used to skip unchanged rows.', max_length=40, verbose_name='Content Hash')),
+                ('removed_at', models.DateTimeField(blank=True, help_text='When the business disappeared from its state registry file. Removed businesses are hidden from search.', null=True, verbose_name='Removed At')),
+            ],
+            options={
+                'verbose_name': 'Business',
+                'verbose_name_plural': 'Businesses',
+            },
+        ),
+        migrations.RunPython(reassign_reference_ids, migrations.RunPython.noop),
+        migrations.RunPython(copy_businesses, migrations.RunPython.noop),
+        # Indexes are built once the table is full; nothing reads it yet
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['state_code'], name='core_business_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['status'], name='core_business_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['is_new'], name='core_business_is_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['missing_filing'], name='core_business_missing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['name', 'id'], name='core_business_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['business_type'], name='core_business_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newbusiness',
+            index=models.Index(fields=['search_key', 'id'], name='core_business_key_idx', opclasses=['varchar_pattern_ops', 'int4_ops']),
+        ),
+        migrations.AddConstraint(
+            model_name='newbusiness',
+            constraint=models.UniqueConstraint(condition=models.Q(('registry_id', ''), _negated=True), fields=('state_code', 'registry_id'), name='core_business_registry_uniq'),
+        ),
+    ]
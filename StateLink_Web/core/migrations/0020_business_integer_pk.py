@@ -0,0 +1,100 @@
+# Generated by Django 5.0.6 on 2026-10-17 14:02
+#
+# Second half of moving core_business to an integer primary key (see 0019).
+# Runs in one transaction: writes to core_business are blocked while the
+# rows that changed since 0019's copy are brought across, compliance
+# requests are pointed at the new ids, and core_newbusiness replaces
+# core_business. Reads continue until the swap itself.
+
+import importlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+
+copy_rows = importlib.import_module('core.migrations.0019_newbusiness').copy_rows
+install_search_index = importlib.import_module('core.migrations.0014_business_search_index').install_search_index
+
+BATCH_SIZE = 5000
+
+
+def catch_up(apps, schema_editor):
+    Business = apps.get_model('core', 'Business')
+    NewBusiness = apps.get_model('core', 'NewBusiness')
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('LOCK TABLE core_business IN EXCLUSIVE MODE')
+        # On SQLite this first write takes the database write lock
+        cursor.execute('DELETE FROM core_newbusiness WHERE reference_id NOT IN (SELECT reference_id FROM core_business)')
+
+    # Imports bump updated_at; the nightly flag recompute deliberately doesn't
+    copied = NewBusiness.objects.filter(
+        reference_id=OuterRef('reference_id'),
+        updated_at=OuterRef('updated_at'),
+        is_new=OuterRef('is_new'),
+        missing_filing=OuterRef('missing_filing'),
+    )
+    stale = list(Business.objects.exclude(Exists(copied)).values_list('pk', flat=True))
+    for start in range(0, len(stale), BATCH_SIZE):
+        copy_rows(connection, Business.objects.filter(pk__in=stale[start:start + BATCH_SIZE]))
+
+
+def point_requests_at_new_ids(apps, schema_editor):
+    ComplianceRequest = apps.get_model('core', 'ComplianceRequest')
+    NewBusiness = apps.get_model('core', 'NewBusiness')
+    ComplianceRequest.objects.update(new_business_id=Subquery(
+        NewBusiness.objects.filter(reference_id=OuterRef('business_id')).values('id')[:1]
+    ))
+
+
+def reinstall_search_index(apps, schema_editor):
+    # The search index and its triggers went with the old table
+    install_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_newbusiness'),
+    ]
+
+    operations = [
+        migrations.RunPython(catch_up, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='compliancerequest',
+            name='new_business',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.newbusiness'),
+        ),
+        migrations.RunPython(point_requests_at_new_ids, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='compliancerequest',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='compliancerequest',
+            name='business',
+        ),
+        migrations.DeleteModel(
+            name='Business',
+        ),
+        migrations.RenameModel(
+            old_name='NewBusiness',
+            new_name='Business',
+        ),
+        migrations.RenameField(
+            model_name='compliancerequest',
+            old_name='new_business',
+            new_name='business',
+        ),
+        migrations.AlterField(
+            model_name='compliancerequest',
+            name='business',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compliance_requests', to='core.business'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='compliancerequest',
+            unique_together={('business', 'request_type')},
+        ),
+        migrations.RunPython(reinstall_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-17 13:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_business_integer_pk'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='compliancerequest',
+            index=models.Index(fields=['status', 'created_at'], name='core_request_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='compliancerequest',
+            index=models.Index(fields=['order_reference_number'], name='core_request_order_ref_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-17 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_compliancerequest_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compliancerequest',
+            name='quote_snapshot',
+            field=models.JSONField(blank=True, editable=False, help_text='The priced cart as shown for payment: line items, discount, add-ons and total.', null=True),
+        ),
+        migrations.AddField(
+            model_name='compliancerequest',
+            name='quoted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Quoted At'),
+        ),
+    ]
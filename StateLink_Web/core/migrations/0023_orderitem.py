@@ -0,0 +1,94 @@
+# Generated by Django 5.0.6 on 2026-10-17 13:43
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# Service rows that show a service's form was filled in, in line item order
+SERVICE_MODELS = (
+    ('FEDERAL_EIN', 'FederalEINRequest'),
+    ('OPERATING_AGREEMENT', 'OperatingAgreementRequest'),
+    ('CORPORATE_BYLAWS', 'CorporateBylawsRequest'),
+    ('LABOR_LAW_POSTER', 'LaborLawPosterRequest'),
+    ('CERTIFICATE_EXISTENCE', 'CertificateExistenceRequest'),
+)
+BUNDLED = ('LABOR_LAW_POSTER', 'CERTIFICATE_EXISTENCE')
+# Prices when items were introduced
+PRICES = {
+    'FEDERAL_EIN': Decimal('149.95'),
+    'OPERATING_AGREEMENT': Decimal('249.95'),
+    'CORPORATE_BYLAWS': Decimal('249.95'),
+    'LABOR_LAW_POSTER_CERT': Decimal('149.95'),
+    'LABOR_LAW_POSTER': Decimal('99.95'),
+    'CERTIFICATE_EXISTENCE': Decimal('99.95'),
+}
+ITEM_STATUSES = {'PAID': 'PAID', 'COMPLETED': 'COMPLETED'}
+
+
+def create_order_items(apps, schema_editor):
+    # Each filled-in service form becomes an item. A request part way through
+    # the wizard also gets a pending item for the service it was on; the
+    # services after that were only held in the customer's session.
+    ComplianceRequest = apps.get_model('core', 'ComplianceRequest')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    filled = {}
+    for service, model_name in SERVICE_MODELS:
+        rows = apps.get_model('core', model_name).objects.exclude(compliance_request=None)
+        for request_id in rows.values_list('compliance_request_id', flat=True):
+            filled.setdefault(request_id, []).append(service)
+
+    items = []
+    requests = ComplianceRequest.objects.values_list('id', 'status', 'request_type')
+    for request_id, status, request_type in requests.iterator():
+        services = filled.get(request_id, [])
+        paid = status in ITEM_STATUSES
+        if all(service in services for service in BUNDLED):
+            services = [service for service in services if service not in BUNDLED] + ['LABOR_LAW_POSTER_CERT']
+        elif request_type == 'LABOR_LAW_POSTER_CERT' and not paid:
+            # Only the first half of the bundle is in
+            services = [service for service in services if service not in BUNDLED]
+        pending = not paid and request_type in PRICES and request_type not in services
+        for position, service in enumerate(services + [request_type] * pending):
+            items.append(OrderItem(
+                compliance_request_id=request_id, service=service, position=position, price=PRICES[service],
+                status='PENDING' if service not in services else ITEM_STATUSES.get(status, 'SUBMITTED'),
+            ))
+        if len(items) >= BATCH_SIZE:
+            OrderItem.objects.bulk_create(items)
+            items = []
+    OrderItem.objects.bulk_create(items)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_compliancerequest_quote_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service', models.CharField(choices=[('OPERATING_AGREEMENT', 'Operating Agreement'), ('CORPORATE_BYLAWS', 'Corporate Bylaws'), ('FEDERAL_EIN', 'Federal EIN Application'), ('LABOR_LAW_POSTER_CERT', 'Labor Law Posters & Certificate of Existence'), ('LABOR_LAW_POSTER', 'Labor Law Posters'), ('CERTIFICATE_EXISTENCE', 'Certificate of Existence'), ('ANNUAL_REPORT', 'Annual Report')], max_length=25)),
+                ('position', models.PositiveSmallIntegerField(default=0, help_text='Where the service comes in the order form.')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('SUBMITTED', 'Submitted'), ('PAID', 'Paid'), ('IN_PROGRESS', 'In Progress'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled')], default='PENDING', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('compliance_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='core.compliancerequest')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='core_orderitem_queue_idx'), models.Index(fields=['service', 'status'], name='core_orderitem_service_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('compliance_request', 'service'), name='core_orderitem_service_uniq'),
+        ),
+        migrations.RunPython(create_order_items, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.6 on 2026-10-17 13:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_orderitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=150, unique=True)),
+                ('order_reference', models.CharField(max_length=100)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('token', models.CharField(blank=True, max_length=255)),
+                ('postal_code', models.CharField(blank=True, max_length=20)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('PROCESSING', 'Processing'), ('PAID', 'Paid'), ('DECLINED', 'Declined'), ('FAILED', 'Failed'), ('UNCONFIRMED', 'Unconfirmed')], default='QUEUED', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('transaction_id', models.CharField(blank=True, max_length=50)),
+                ('response_code', models.CharField(blank=True, max_length=10)),
+                ('response_message', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('compliance_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payments', to='core.compliancerequest')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='core_payment_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-17 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_payment'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='business',
+            index=models.Index(fields=['updated_at'], name='core_business_updated_idx'),
+        ),
+    ]
@@ -1,11 +1,52 @@
-from django.db import models
-from decimal import Decimal
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import F, Q
+import re
 import uuid
 
+from . import reference_ids
+
+# Shape of the reference IDs printed on mailed letters
+REFERENCE_ID_RE = reference_ids.REFERENCE_ID_RE
+
+# Sequence numbers each process reserves at a time for Business defaults
+REFERENCE_ID_BLOCK_SIZE = 20
+
 def generate_reference_id():
-    """Generate a unique 8-character reference ID"""
+    """
+    Legacy random 8-character reference ID. Kept because early migrations
+    refer to it; new businesses get allocate_reference_id().
+    """
     return str(uuid.uuid4())[:8]
 
+def normalise_reference_id(value):
+    """Return value as a canonical reference ID, or None if it isn't shaped like one"""
+    return reference_ids.normalise(value)
+
+def allocate_reference_id():
+    """Next reference ID from this process's reserved block"""
+    return _allocator()
+
+# Trailing words dropped from business names when building the search key,
+# compared after punctuation is removed (so "L.L.C." is "llc")
+ENTITY_SUFFIXES = {
+    'co', 'company', 'corp', 'corporation', 'inc', 'incorporated', 'limited',
+    'llc', 'llp', 'lp', 'ltd', 'pa', 'pc', 'pllc',
+}
+
+def normalise_business_name(value):
+    """
+    Search key for a business name or query: casefolded, "&" spelled out,
+    punctuation removed and trailing entity suffixes dropped, so
+    "Acme Technologies, L.L.C." and "acme technologies llc" share a key.
+    """
+    value = (value or '').casefold().replace('&', ' and ')
+    # Dots and apostrophes join their neighbours; other punctuation separates words
+    value = re.sub(r"[.'\u2019]", '', value)
+    words = re.sub(r'[\W_]+', ' ', value).split()
+    while len(words) > 1 and words[-1] in ENTITY_SUFFIXES:
+        words.pop()
+    return ' '.join(words)
+
 # Create your models here.
 class Business(models.Model):
     """
@@ -24,18 +65,47 @@ class Business(models.Model):
         ('NC', 'North Carolina'),
         # Add more states as needed
     ]
-    
+
+    # Registry statuses, stored as small codes; importers map the spellings
+    # each registry uses onto these
+    ACTIVE = 1
+    INACTIVE = 2
+    DISSOLVED = 3
+    REVOKED = 4
+    SUSPENDED = 5
+    WITHDRAWN = 6
+    MERGED = 7
+    OTHER = 99
+    STATUSES = [
+        (ACTIVE, 'Active'),
+        (INACTIVE, 'Inactive'),
+        (DISSOLVED, 'Dissolved'),
+        (REVOKED, 'Revoked'),
+        (SUSPENDED, 'Suspended'),
+        (WITHDRAWN, 'Withdrawn'),
+        (MERGED, 'Merged'),
+        (OTHER, 'Other'),
+    ]
+
+    id = models.AutoField(primary_key=True)
     name = models.CharField(
         max_length=255,
         verbose_name="Business Name",
         help_text="The legal name of the business entity."
     )
     reference_id = models.CharField(
-        primary_key=True,
-        max_length=255,
+        unique=True,
+        max_length=reference_ids.LENGTH,
         verbose_name="Reference ID",
-        help_text="The unique identifier for the business entity.",
-        default=generate_reference_id
+        help_text="The unique identifier for the business entity, as printed on letters.",
+        default=allocate_reference_id
+    )
+    registry_id = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        verbose_name="Registry ID",
+        help_text="The state registry's own identifier, which imports match rows on."
     )
     business_type = models.CharField(
         max_length=10,
@@ -86,8 +156,8 @@ class Business(models.Model):
         verbose_name="Last Filing Date",
         help_text="Date of the last annual report or filing."
     )
-    status = models.CharField(
-        max_length=50,
+    status = models.PositiveSmallIntegerField(
+        choices=STATUSES,
         verbose_name="Status",
         help_text="Current status of the business (e.g., Active, Dissolved)."
     )
@@ -107,16 +177,55 @@ class Business(models.Model):
         auto_now=True,
         verbose_name="Updated At"
     )
+    search_key = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        editable=False,
+        verbose_name="Search Key",
+        help_text="normalise_business_name(name), set on save. Bulk loaders must set it themselves."
+    )
+    content_hash = models.CharField(
+        max_length=40,
+        blank=True,
+        default='',
+        editable=False,
+        verbose_name="Content Hash",
+        help_text="Hash of the registry fields as last imported, used to skip unchanged rows."
+    )
+    removed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name="Removed At",
+        help_text="When the business disappeared from its state registry file. Removed businesses are hidden from search."
+    )
 
     class Meta:
+        # reference_id is indexed by its unique constraint. Names ending in
+        # id break ties in keyset pagination.
         indexes = [
-            models.Index(fields=["state_code"]),
-            models.Index(fields=["status"]),
-            models.Index(fields=["is_new"]),
-            models.Index(fields=["missing_filing"]),
-            models.Index(fields=["name"]),
-            models.Index(fields=["reference_id"]),
-            models.Index(fields=["business_type"]),
+            models.Index(fields=["state_code"], name="core_business_state_idx"),
+            models.Index(fields=["status"], name="core_business_status_idx"),
+            models.Index(fields=["is_new"], name="core_business_is_new_idx"),
+            models.Index(fields=["missing_filing"], name="core_business_missing_idx"),
+            models.Index(fields=["name", "id"], name="core_business_name_idx"),
+            models.Index(fields=["business_type"], name="core_business_type_idx"),
+            # The autocomplete prefix index catches up on recently changed rows
+            models.Index(fields=["updated_at"], name="core_business_updated_idx"),
+            # Pattern opclasses let PostgreSQL answer LIKE 'key%' from the index;
+            # other databases ignore them
+            models.Index(
+                fields=["search_key", "id"],
+                name="core_business_key_idx",
+                opclasses=["varchar_pattern_ops", "int4_ops"],
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["state_code", "registry_id"],
+                condition=~Q(registry_id=''),
+                name="core_business_registry_uniq",
+            ),
         ]
         verbose_name = "Business"
         verbose_name_plural = "Businesses"
@@ -124,6 +233,70 @@ class Business(models.Model):
     def __str__(self):
         return f"{self.name} ({self.get_business_type_display()}) - {self.state_code}"
 
+    def save(self, *args, **kwargs):
+        self.search_key = normalise_business_name(self.name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'name' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'search_key'}
+        super().save(*args, **kwargs)
+
+
+class ReferenceIdSequence(models.Model):
+    """Counter that reference ID allocators reserve blocks of sequence numbers from"""
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField(default=0)
+
+    BUSINESS = 'business'
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+    @classmethod
+    def reserve(cls, count, name=BUSINESS):
+        """
+        Reserve the next count sequence numbers and return an iterator over
+        them. The increment locks the counter row until the surrounding
+        transaction commits, so reserve outside long-running transactions.
+
+        Inside one, the numbers are only reserved once it commits. Until
+        then only this thread's connection gets them, and only while the
+        marker row written along with the increment is there. If the
+        transaction (or the savepoint reserving them) rolls back, the marker
+        goes with it and the iterator stops early, since the counter will
+        hand the same numbers out again.
+        """
+        reserving = connections[DEFAULT_DB_ALIAS]
+        marker = f'{name}:{uuid.uuid4().hex}' if reserving.in_atomic_block else None
+        committed = False
+
+        def confirm():
+            nonlocal committed
+            committed = True
+            if marker:
+                cls.objects.filter(name=marker).delete()
+
+        with transaction.atomic():
+            if not cls.objects.filter(name=name).update(next_value=F('next_value') + count):
+                cls.objects.get_or_create(name=name)
+                cls.objects.filter(name=name).update(next_value=F('next_value') + count)
+            end = cls.objects.filter(name=name).values_list('next_value', flat=True).get()
+            if marker:
+                cls.objects.create(name=marker, next_value=end)
+            transaction.on_commit(confirm)
+
+        def numbers():
+            for number in range(end - count, end):
+                if not committed and (
+                    connections[DEFAULT_DB_ALIAS] is not reserving or not cls.objects.filter(name=marker).exists()
+                ):
+                    return
+                yield number
+
+        return numbers()
+
+
+_allocator = reference_ids.ReferenceIdAllocator(ReferenceIdSequence.reserve, REFERENCE_ID_BLOCK_SIZE)
+
 
 # Service Request Models
 class FederalEINRequest(models.Model):
@@ -320,19 +493,10 @@ class ComplianceRequest(models.Model):
         ('PAID', 'Paid'),
     ]
 
-    # Service prices mapping
-    SERVICE_PRICES = {
-        'ANNUAL_REPORT': Decimal('399.95'),
-        'OPERATING_AGREEMENT': Decimal('249.95'),
-        'CORPORATE_BYLAWS': Decimal('249.95'),
-        'FEDERAL_EIN': Decimal('149.95'),
-        'LABOR_LAW_POSTER': Decimal('74.98'),  # Bundled price
-        'CERTIFICATE_EXISTENCE': Decimal('74.98'),  # Bundled price
-    }
-    
     business = models.ForeignKey(Business, on_delete=models.CASCADE, related_name='compliance_requests')
     request_type = models.CharField(max_length=25, choices=REQUEST_TYPES)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    # What was charged, set when the payment settles; core.pricing prices the order from services.SERVICES
     price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -353,15 +517,123 @@ class ComplianceRequest(models.Model):
         default=False,
         help_text="If true, the client has selected unlimited amendments add-on."
     )
-    
-    def save(self, *args, **kwargs):
-        # Set the price based on request type when saving
-        if not self.price:
-            self.price = self.SERVICE_PRICES.get(self.request_type, Decimal('0'))
-        super().save(*args, **kwargs)
+
+    # Written by core.pricing when the customer reaches the payment page
+    quote_snapshot = models.JSONField(
+        null=True, blank=True, editable=False,
+        help_text="The priced cart as shown for payment: line items, discount, add-ons and total."
+    )
+    quoted_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Quoted At")
     
     def __str__(self):
         return f"{self.business.name} - {self.get_request_type_display()} Request"
 
     class Meta:
-        unique_together = ('business', 'request_type')
\ No newline at end of file
+        unique_together = ('business', 'request_type')
+        # Found by `manage.py index_advisor`: the admin filters on status,
+        # and orders are looked up by their reference number
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="core_request_status_idx"),
+            models.Index(fields=["order_reference_number"], name="core_request_order_ref_idx"),
+        ]
+
+class OrderItem(models.Model):
+    """One service ordered on a compliance request, priced when it was selected"""
+    SERVICE_CHOICES = [
+        ('OPERATING_AGREEMENT', 'Operating Agreement'),
+        ('CORPORATE_BYLAWS', 'Corporate Bylaws'),
+        ('FEDERAL_EIN', 'Federal EIN Application'),
+        ('LABOR_LAW_POSTER_CERT', 'Labor Law Posters & Certificate of Existence'),
+        ('LABOR_LAW_POSTER', 'Labor Law Posters'),
+        ('CERTIFICATE_EXISTENCE', 'Certificate of Existence'),
+        ('ANNUAL_REPORT', 'Annual Report'),
+    ]
+
+    # Waiting for the customer's service form, then for payment, then for fulfillment
+    PENDING = 'PENDING'
+    SUBMITTED = 'SUBMITTED'
+    PAID = 'PAID'
+    IN_PROGRESS = 'IN_PROGRESS'
+    COMPLETED = 'COMPLETED'
+    CANCELLED = 'CANCELLED'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SUBMITTED, 'Submitted'),
+        (PAID, 'Paid'),
+        (IN_PROGRESS, 'In Progress'),
+        (COMPLETED, 'Completed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    compliance_request = models.ForeignKey(ComplianceRequest, on_delete=models.CASCADE, related_name='items')
+    service = models.CharField(max_length=25, choices=SERVICE_CHOICES)
+    position = models.PositiveSmallIntegerField(default=0, help_text="Where the service comes in the order form.")
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.get_service_display()} for {self.compliance_request_id}"
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['compliance_request', 'service'], name='core_orderitem_service_uniq'),
+        ]
+        # Fulfillment works through items by status, oldest first; revenue
+        # reports group by service
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='core_orderitem_queue_idx'),
+            models.Index(fields=['service', 'status'], name='core_orderitem_service_idx'),
+        ]
+
+
+class Payment(models.Model):
+    """
+    A card charge for a compliance request. The payment page queues it and
+    `manage.py process_payments` charges it. idempotency_key comes from the
+    request and its order reference, so a resubmitted payment form finds
+    the charge already queued instead of making another.
+    """
+    QUEUED = 'QUEUED'
+    PROCESSING = 'PROCESSING'
+    PAID = 'PAID'
+    DECLINED = 'DECLINED'
+    FAILED = 'FAILED'
+    UNCONFIRMED = 'UNCONFIRMED'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (PROCESSING, 'Processing'),
+        (PAID, 'Paid'),
+        (DECLINED, 'Declined'),
+        (FAILED, 'Failed'),
+        # Sent to the gateway but no answer came back; check it there before charging again
+        (UNCONFIRMED, 'Unconfirmed'),
+    ]
+    # Settled without charging the card, so the customer may try again
+    RETRYABLE = (DECLINED, FAILED)
+
+    compliance_request = models.ForeignKey(ComplianceRequest, on_delete=models.CASCADE, related_name='payments')
+    idempotency_key = models.CharField(max_length=150, unique=True)
+    order_reference = models.CharField(max_length=100)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # Single-use token from the hosted card form, cleared once charged
+    token = models.CharField(max_length=255, blank=True)
+    postal_code = models.CharField(max_length=20, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    transaction_id = models.CharField(max_length=50, blank=True)
+    response_code = models.CharField(max_length=10, blank=True)
+    response_message = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.order_reference} ({self.get_status_display()})"
+
+    class Meta:
+        # process_payments takes queued payments oldest first
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='core_payment_queue_idx'),
+        ]
@@ -0,0 +1,299 @@
+"""
+Card charges through the Heartland Portico gateway.
+
+The GlobalPayments SDK keeps its configuration in a process-wide
+ServicesContainer, so it's configured once per process on the first
+charge instead of on every payment POST. The SDK sends every request
+through one module-level urllib3 PoolManager, but never passes it a
+timeout; configure_gateway() swaps in a pool with PAYMENT_GATEWAY_*
+connect and read timeouts and no retries, which keeps its connections to
+the gateway alive between charges.
+
+A circuit breaker guards the gateway. After
+PAYMENT_GATEWAY_FAILURE_THRESHOLD charges in a row fail to get an answer
+(timeouts, refused connections, HTTP errors), charges fail immediately
+with GatewayUnavailable for PAYMENT_GATEWAY_RESET_SECONDS, then one charge
+is let through to see whether the gateway is back. A slow gateway then
+costs a worker one timeout rather than holding every worker until it
+recovers. Declines are answers, and don't count as failures.
+
+Charges don't run in the web request. The payment page queues a Payment
+with submit() and sends the browser to a page polling its status, while
+`manage.py process_payments` claims queued payments and charge()s them,
+so a slow gateway holds up that worker rather than the web workers. A
+payment is keyed by its compliance request and order reference; posting
+the form again finds the queued or settled payment rather than charging
+twice.
+
+A worker that dies mid-charge leaves its payment PROCESSING. Once it has
+been so for PAYMENT_PROCESSING_TIMEOUT seconds, reap_stalled() marks it
+UNCONFIRMED: the charge may have gone through, so it isn't queued again.
+"""
+import datetime
+import logging
+import threading
+import time
+
+import certifi
+import urllib3
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from globalpayments.api import PorticoConfig, ServicesContainer
+from globalpayments.api import gateways
+from globalpayments.api.builders import Address
+from globalpayments.api.entities.exceptions import GatewayException
+from globalpayments.api.payment_methods import CreditCardData
+
+from .models import ComplianceRequest, OrderItem, Payment
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayUnavailable(Exception):
+    """The circuit breaker is open; the charge wasn't attempted"""
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures; at threshold it opens and calls fail fast
+    until reset_seconds have passed, when a single trial call is let
+    through. The trial succeeding closes it, failing opens it again.
+    """
+
+    def __init__(self, threshold, reset_seconds, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        """Raise GatewayUnavailable unless a call may go ahead now"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or self.clock() - self.opened_at < self.reset_seconds:
+                raise GatewayUnavailable("Payment gateway unavailable")
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Payment gateway recovered; closing circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error("Payment gateway failed %d times in a row; opening circuit breaker", self.failures)
+                self.opened_at = self.clock()
+
+
+breaker = CircuitBreaker(settings.PAYMENT_GATEWAY_FAILURE_THRESHOLD, settings.PAYMENT_GATEWAY_RESET_SECONDS)
+
+_configured = False
+_configure_lock = threading.Lock()
+
+# Whether this thread's current charge has sent a request to the gateway
+_sent = threading.local()
+
+
+class GatewayPool(urllib3.PoolManager):
+    """The SDK's connection pool, noting when a charge's request goes out"""
+
+    def urlopen(self, *args, **kwargs):
+        _sent.value = True
+        return super().urlopen(*args, **kwargs)
+
+
+def configure_gateway():
+    """Configure the SDK and its connection pool, once per process"""
+    global _configured
+    if _configured:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        timeout = urllib3.Timeout(
+            connect=settings.PAYMENT_GATEWAY_CONNECT_TIMEOUT, read=settings.PAYMENT_GATEWAY_READ_TIMEOUT,
+        )
+        # The SDK calls gateways.HTTP.request() without a timeout, so the pool supplies it.
+        # A charge isn't idempotent, so never retry one. This relies on the
+        # SDK version pinned in requirements.txt; the tests check it still applies.
+        gateways.HTTP = GatewayPool(
+            maxsize=settings.PAYMENT_GATEWAY_POOL_SIZE,
+            timeout=timeout,
+            retries=False,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where(),
+        )
+
+        config = PorticoConfig()
+        config.secret_api_key = settings.HEARTLAND_SECRET_KEY
+        config.developer_id = settings.HEARTLAND_DEVELOPER_ID
+        config.version_number = settings.HEARTLAND_VERSION_NUMBER
+        config.service_url = settings.HEARTLAND_SERVICE_URL
+        # The SDK's own setting, in milliseconds; its HTTP calls ignore it
+        config.timeout = int((settings.PAYMENT_GATEWAY_CONNECT_TIMEOUT + settings.PAYMENT_GATEWAY_READ_TIMEOUT) * 1000)
+        ServicesContainer.configure(config)
+        _configured = True
+
+
+def is_gateway_failure(exc):
+    """
+    Whether exc means the gateway didn't answer. GatewayExceptions for
+    responses it did give carry its response code: a rejected token, say,
+    is the gateway working.
+    """
+    return not (isinstance(exc, GatewayException) and exc.response_code is not None)
+
+
+def charge(token, amount, postal_code):
+    """
+    Charge amount (a Decimal, in USD) to the tokenised card. Returns the
+    SDK's Transaction, declines included; raises GatewayUnavailable when
+    the breaker is open and the SDK's ApiException when the charge fails.
+    """
+    _sent.value = False
+    configure_gateway()
+    breaker.before_call()
+
+    card = CreditCardData()
+    card.token = token
+    address = Address()
+    address.postal_code = postal_code
+    try:
+        response = card.charge(amount=str(amount)).with_currency('USD').with_address(address).execute()
+    except Exception as exc:
+        if is_gateway_failure(exc):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return response
+
+
+def may_have_charged(exc):
+    """
+    Whether the charge() that just raised exc in this thread could still
+    have gone through: its request was sent, but no answer came back.
+    Anything raised before the request went out, failing to connect
+    included, means it never left.
+    """
+    if not getattr(_sent, 'value', False) or not is_gateway_failure(exc):
+        return False
+    return not isinstance(getattr(exc, 'inner_exception', None), urllib3.exceptions.ConnectTimeoutError)
+
+
+def idempotency_key(compliance_request_id, order_reference):
+    return f'{compliance_request_id}:{order_reference}'
+
+
+def submit(compliance_request, order_reference, amount, token, postal_code):
+    """
+    Queue a charge of amount for compliance_request and return its Payment.
+    If the order already has one queued, being charged or settled, that's
+    returned as it is; a declined or failed one is queued again with the
+    new card.
+    """
+    key = idempotency_key(compliance_request.pk, order_reference)
+    payment, created = Payment.objects.get_or_create(idempotency_key=key, defaults={
+        'compliance_request': compliance_request,
+        'order_reference': order_reference,
+        'amount': amount,
+        'token': token,
+        'postal_code': postal_code or '',
+    })
+    if not created and payment.status in Payment.RETRYABLE:
+        retry = {
+            'status': Payment.QUEUED, 'amount': amount, 'token': token, 'postal_code': postal_code or '',
+            'response_code': '', 'response_message': '', 'updated_at': timezone.now(),
+        }
+        if Payment.objects.filter(pk=payment.pk, status__in=Payment.RETRYABLE).update(**retry):
+            for field, value in retry.items():
+                setattr(payment, field, value)
+        else:
+            payment.refresh_from_db()
+    return payment
+
+
+def claim_next():
+    """Mark the oldest queued payment as processing and return it, or None if none are queued"""
+    while True:
+        payment = Payment.objects.filter(status=Payment.QUEUED).order_by('created_at').first()
+        if payment is None:
+            return None
+        # Another process_payments may have claimed it first
+        claimed = Payment.objects.filter(pk=payment.pk, status=Payment.QUEUED).update(
+            status=Payment.PROCESSING, attempts=F('attempts') + 1, updated_at=timezone.now(),
+        )
+        if claimed:
+            payment.status = Payment.PROCESSING
+            payment.attempts += 1
+            return payment
+
+
+def reap_stalled():
+    """
+    Mark payments left PROCESSING for longer than PAYMENT_PROCESSING_TIMEOUT
+    as UNCONFIRMED, their worker having died mid-charge. Returns how many.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.PAYMENT_PROCESSING_TIMEOUT)
+    reaped = Payment.objects.filter(status=Payment.PROCESSING, updated_at__lt=cutoff).update(
+        status=Payment.UNCONFIRMED, token='', response_message='Stopped while charging; check the gateway',
+        updated_at=timezone.now(),
+    )
+    if reaped:
+        logger.error("Marked %d stalled payments unconfirmed", reaped)
+    return reaped
+
+
+def process(payment):
+    """Charge a claimed payment and record how it settled; paying it marks its request and items paid"""
+    payment.transaction_id = payment.response_code = ''
+    try:
+        response = charge(payment.token, payment.amount, payment.postal_code)
+    except GatewayUnavailable:
+        payment.status = Payment.FAILED
+        payment.response_message = 'Payment gateway unavailable'
+    except Exception as exc:
+        logger.exception("Charging payment %s failed", payment.order_reference)
+        payment.status = Payment.UNCONFIRMED if may_have_charged(exc) else Payment.FAILED
+        payment.response_code = getattr(exc, 'response_code', None) or ''
+        payment.response_message = str(exc)[:255]
+    else:
+        payment.status = Payment.PAID if response.response_code == '00' else Payment.DECLINED
+        payment.transaction_id = response.transaction_id or ''
+        payment.response_code = response.response_code or ''
+        payment.response_message = (response.response_message or '')[:255]
+    logger.info("Payment %s: %s %s %s", payment.order_reference, payment.status, payment.response_code, payment.response_message)
+
+    # The token is single-use either way
+    payment.token = ''
+    with transaction.atomic():
+        payment.save(update_fields=[
+            'status', 'token', 'transaction_id', 'response_code', 'response_message', 'updated_at',
+        ])
+        if payment.status == Payment.PAID:
+            ComplianceRequest.objects.filter(pk=payment.compliance_request_id).update(
+                status='PAID', price=payment.amount, order_reference_number=payment.order_reference,
+                updated_at=timezone.now(),
+            )
+            OrderItem.objects.filter(compliance_request_id=payment.compliance_request_id).update(
+                status=OrderItem.PAID, updated_at=timezone.now(),
+            )
+    return payment
@@ -0,0 +1,206 @@
+"""
+Parallel ingest of several state registry files.
+
+Each file is parsed and validated in its own worker process; cleaned
+batches come back to the parent over one bounded queue and are written by
+a single writer, so the database sees one connection doing ordered batch
+writes while parsing scales with cores. When the writer falls behind the
+queue fills up and workers block on it, which keeps memory bounded.
+
+This module is imported by worker processes before Django is set up, so
+anything touching models is imported inside the functions that need it.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Batches the writer may fall behind by before workers block
+QUEUE_BATCHES_PER_WORKER = 2
+
+# Queue set in each worker by _init_worker
+_batches = None
+
+
+class StateSource:
+    """One registry file and how to read it"""
+
+    def __init__(self, state, path, layout_path=None, encoding='utf-8'):
+        self.state = state
+        self.path = path
+        self.layout_path = layout_path
+        self.encoding = encoding
+
+
+class StateMetrics:
+    """Per-state throughput: parsing in the worker and writing in the parent"""
+
+    def __init__(self, state):
+        from .ingest import ImportStats
+
+        self.state = state
+        self.writes = ImportStats()
+        self.parse_rows = 0
+        self.loaded_rows = 0
+        self.parse_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.write_seconds = 0.0
+        self.error = None
+
+    @property
+    def parse_rows_per_second(self):
+        busy = self.parse_seconds - self.blocked_seconds
+        return self.parse_rows / busy if busy > 0 else 0
+
+    @property
+    def write_rows_per_second(self):
+        return self.loaded_rows / self.write_seconds if self.write_seconds else 0
+
+
+def _init_worker(batches):
+    global _batches
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+    _batches = batches
+
+
+def parse_source(source, batch_size, max_errors):
+    """
+    Worker: stream source, putting ('batch', state, rows) messages on the
+    queue and ('row_error', state, message) for invalid rows, then always a
+    final ('finished', state, result) where result is (rows, errors,
+    seconds, seconds blocked on the queue) or an error message.
+    """
+    from . import ingest
+
+    started = time.monotonic()
+    blocked = 0.0
+    stats = ingest.ImportStats()
+
+    def on_error(line_number, error):
+        _batches.put(('row_error', source.state, f"{source.path} line {line_number}: {error}"))
+
+    try:
+        layout = ingest.load_layout(source.layout_path) if source.layout_path else None
+        with ingest.open_text(source.path, source.encoding) as stream:
+            records = ingest.read_records(stream, layout)
+            for rows in ingest.clean_batches(records, stats, batch_size, source.state, max_errors, on_error):
+                # Each file is its state's partition; rows for other states would
+                # escape that state's --full bookkeeping
+                for state_code, registry_id in [key for key in rows if key[0] != source.state]:
+                    stats.errors += 1
+                    del rows[state_code, registry_id]
+                    _batches.put((
+                        'row_error', source.state,
+                        f"{source.path}: {registry_id} is in {state_code}, not {source.state}",
+                    ))
+                    if stats.errors > max_errors:
+                        raise ingest.IngestError(f"Stopped after {stats.errors} invalid rows")
+                if rows:
+                    waiting = time.monotonic()
+                    _batches.put(('batch', source.state, rows))
+                    blocked += time.monotonic() - waiting
+    except (OSError, ingest.IngestError) as error:
+        _batches.put(('finished', source.state, str(error)))
+    else:
+        _batches.put(('finished', source.state, (stats.rows, stats.errors, time.monotonic() - started, blocked)))
+
+
+def import_states(sources, workers=None, batch_size=5000, max_errors=100, full=False,
+                  max_removed_fraction=0.1, on_error=None, on_batch=None):
+    """
+    Import sources concurrently and return {state: StateMetrics}. A state
+    whose file fails is reported in its metrics' error and skipped when
+    removing missing businesses; the other states still load.
+    """
+    from . import ingest
+    from .models import Business
+    from .signals import businesses_loaded
+
+    workers = workers or min(len(sources), os.cpu_count() or 1)
+    metrics = {source.state: StateMetrics(source.state) for source in sources}
+    writer = ingest.writer_for_connection()
+    allocate = ingest.reference_id_allocator(batch_size)
+    seen = None
+
+    # Forked workers must not inherit the parent's database connections, so
+    # the parent only connects again once the workers have started
+    connections.close_all()
+    batches = multiprocessing.Queue(maxsize=workers * QUEUE_BATCHES_PER_WORKER)
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(batches,)) as executor:
+            futures = {
+                executor.submit(parse_source, source, batch_size, max_errors): source.state
+                for source in sources
+            }
+            if full:
+                seen = ingest.SeenReferenceIds()
+            running = set(metrics)
+            while running:
+                try:
+                    kind, state, payload = batches.get(timeout=1)
+                except queue.Empty:
+                    # A worker that died can't send its final message
+                    for future, state in futures.items():
+                        if state in running and future.done() and future.exception():
+                            metrics[state].error = str(future.exception())
+                            running.discard(state)
+                    continue
+                state_metrics = metrics[state]
+                if kind == 'row_error':
+                    if on_error:
+                        on_error(state, payload)
+                elif kind == 'finished':
+                    running.discard(state)
+                    if isinstance(payload, str):
+                        state_metrics.error = payload
+                    else:
+                        rows, errors, state_metrics.parse_seconds, state_metrics.blocked_seconds = payload
+                        state_metrics.parse_rows = state_metrics.writes.rows = rows
+                        state_metrics.writes.errors = errors
+                else:
+                    started = time.monotonic()
+                    ingest.write_changes(payload, writer, state_metrics.writes, allocate, seen)
+                    state_metrics.write_seconds += time.monotonic() - started
+                    state_metrics.loaded_rows += len(payload)
+                    if on_batch:
+                        on_batch(state_metrics)
+
+        for state_metrics in metrics.values():
+            if seen and state_metrics.error is None:
+                try:
+                    ingest.remove_missing(seen, {state_metrics.state}, state_metrics.writes, max_removed_fraction)
+                except ingest.IngestError as error:
+                    state_metrics.error = str(error)
+    finally:
+        if seen:
+            seen.drop()
+
+    changed_ids = []
+    for state_metrics in metrics.values():
+        writes = state_metrics.writes
+        logger.info(
+            "%s: %s rows, parsed at %.0f rows/sec, written at %.0f rows/sec: %s inserted, "
+            "%s updated, %s unchanged, %s removed, %s invalid%s",
+            state_metrics.state, writes.rows, state_metrics.parse_rows_per_second,
+            state_metrics.write_rows_per_second, writes.inserted, writes.updated, writes.unchanged,
+            writes.removed, writes.errors, f"; failed: {state_metrics.error}" if state_metrics.error else "",
+        )
+        if changed_ids is not None and writes.changed_ids is not None:
+            changed_ids.extend(writes.changed_ids)
+        else:
+            changed_ids = None
+    if changed_ids is not None and len(changed_ids) > ingest.CHANGED_IDS_LIMIT:
+        changed_ids = None
+    if any(state_metrics.writes.written or state_metrics.writes.removed for state_metrics in metrics.values()):
+        businesses_loaded.send(sender=Business, reference_ids=changed_ids)
+    return metrics
@@ -0,0 +1,404 @@
+import heapq
+import logging
+import threading
+import time
+from array import array
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .models import Business
+from .search import listed_businesses
+
+logger = logging.getLogger(__name__)
+
+# Separates the fields of a packed business record
+RECORD_SEPARATOR = '\x1f'
+
+# Catching up re-reads rows changed this long before the last sync, so rows
+# written by transactions that committed late aren't missed
+CATCH_UP_OVERLAP = timedelta(seconds=60)
+
+
+class IndexTooLarge(Exception):
+    """The index passed its byte limit while loading; businesses is how many it had read"""
+
+    def __init__(self, businesses):
+        super().__init__(businesses)
+        self.businesses = businesses
+
+
+def normalise_key(value):
+    """Casefold a name or reference ID into its index key"""
+    return ' '.join((value or '').casefold().split()).encode('utf-8')
+
+
+class PrefixIndex:
+    """
+    Compact sorted prefix index over business names and reference IDs.
+
+    The bulk of the index is an immutable snapshot: every key is packed into
+    one bytes blob addressed through an offset array, and every business is
+    packed as a "reference_id<US>name<US>state_code" record in a second blob.
+    Writes after the snapshot was taken go to a small sorted delta and mark
+    the business as stale in the snapshot; once the delta grows past
+    compact_threshold the two are merged back into a fresh snapshot.
+    """
+    compact_threshold = 5000
+
+    def __init__(self, rows=(), max_bytes=None):
+        self._lock = threading.RLock()
+        self._delta_keys = []
+        self._delta_records = {}
+        self._stale = set()
+        self._load_snapshot(rows, max_bytes)
+
+    def _load_snapshot(self, rows, max_bytes=None):
+        """
+        Pack rows into the snapshot. With max_bytes, raises IndexTooLarge as
+        soon as the packed size would pass it, rather than after reading
+        every row.
+        """
+        records = bytearray()
+        record_offsets = array('I', [0])
+        entries = []
+        key_bytes = 0
+        for slot, (reference_id, name, state_code) in enumerate(rows):
+            records += RECORD_SEPARATOR.join(
+                (reference_id, name, state_code or '')
+            ).encode('utf-8')
+            record_offsets.append(len(records))
+            name_key, reference_key = normalise_key(name), normalise_key(reference_id)
+            entries.append((name_key, slot))
+            entries.append((reference_key, slot))
+            if max_bytes is not None:
+                # What stats() will count: the two blobs and three offset arrays
+                key_bytes += len(name_key) + len(reference_key)
+                if len(records) + key_bytes + 4 * len(record_offsets) + 8 * len(entries) > max_bytes:
+                    raise IndexTooLarge(slot + 1)
+        entries.sort()
+
+        keys = bytearray()
+        key_offsets = array('I', [0])
+        key_slots = array('I')
+        for key, slot in entries:
+            keys += key
+            key_offsets.append(len(keys))
+            key_slots.append(slot)
+
+        self._keys = bytes(keys)
+        self._key_offsets = key_offsets
+        self._key_slots = key_slots
+        self._records = bytes(records)
+        self._record_offsets = record_offsets
+
+    def _key(self, position):
+        return self._keys[self._key_offsets[position]:self._key_offsets[position + 1]]
+
+    def _record(self, slot):
+        record = self._records[self._record_offsets[slot]:self._record_offsets[slot + 1]]
+        return tuple(record.decode('utf-8').split(RECORD_SEPARATOR))
+
+    def _bisect(self, prefix):
+        low, high = 0, len(self._key_slots)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _snapshot_matches(self, prefix):
+        position = self._bisect(prefix)
+        while position < len(self._key_slots):
+            key = self._key(position)
+            if not key.startswith(prefix):
+                return
+            record = self._record(self._key_slots[position])
+            if record[0] not in self._stale:
+                yield key, record
+            position += 1
+
+    def _delta_matches(self, prefix):
+        position = self._bisect_delta(prefix)
+        while position < len(self._delta_keys):
+            key, reference_id = self._delta_keys[position]
+            if not key.startswith(prefix):
+                return
+            name, state_code = self._delta_records[reference_id]
+            yield key, (reference_id, name, state_code)
+            position += 1
+
+    def _bisect_delta(self, prefix):
+        low, high = 0, len(self._delta_keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self._delta_keys[middle][0] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, query, limit=10):
+        """Return up to limit (reference_id, name, state_code) tuples whose name or reference ID starts with query"""
+        prefix = normalise_key(query)
+        if not prefix:
+            return []
+        results = []
+        seen = set()
+        with self._lock:
+            matches = heapq.merge(
+                self._snapshot_matches(prefix),
+                self._delta_matches(prefix),
+                key=lambda match: match[0],
+            )
+            for _key, record in matches:
+                if record[0] in seen:
+                    continue
+                seen.add(record[0])
+                results.append(record)
+                if len(results) >= limit:
+                    break
+        return results
+
+    def upsert(self, reference_id, name, state_code):
+        with self._lock:
+            self._discard_delta(reference_id)
+            self._stale.add(reference_id)
+            self._delta_records[reference_id] = (name, state_code or '')
+            for key in (normalise_key(name), normalise_key(reference_id)):
+                self._insert_delta((key, reference_id))
+            if len(self._delta_records) > self.compact_threshold:
+                self.compact()
+
+    def remove(self, reference_id):
+        with self._lock:
+            self._discard_delta(reference_id)
+            self._stale.add(reference_id)
+
+    def _insert_delta(self, entry):
+        position = self._bisect_delta(entry[0])
+        while position < len(self._delta_keys) and self._delta_keys[position] < entry:
+            position += 1
+        self._delta_keys.insert(position, entry)
+
+    def _discard_delta(self, reference_id):
+        if reference_id in self._delta_records:
+            self._delta_keys = [entry for entry in self._delta_keys if entry[1] != reference_id]
+            del self._delta_records[reference_id]
+
+    def records(self):
+        """Iterate over the live (reference_id, name, state_code) records"""
+        for slot in range(len(self._record_offsets) - 1):
+            record = self._record(slot)
+            if record[0] not in self._stale:
+                yield record
+        for reference_id, (name, state_code) in self._delta_records.items():
+            yield reference_id, name, state_code
+
+    def compact(self):
+        """Fold the delta back into a fresh packed snapshot"""
+        with self._lock:
+            rows = list(self.records())
+            self._delta_keys = []
+            self._delta_records = {}
+            self._stale = set()
+            self._load_snapshot(rows)
+
+    def stats(self):
+        """Approximate memory footprint of the index"""
+        snapshot_bytes = (
+            len(self._keys) + len(self._records)
+            + self._key_offsets.itemsize * len(self._key_offsets)
+            + self._key_slots.itemsize * len(self._key_slots)
+            + self._record_offsets.itemsize * len(self._record_offsets)
+        )
+        # Delta entries are ordinary Python objects; ~200 bytes each is a fair estimate
+        delta_bytes = 200 * (len(self._delta_keys) + len(self._delta_records) + len(self._stale))
+        businesses = len(self._record_offsets) - 1
+        total_bytes = snapshot_bytes + delta_bytes
+        return {
+            'businesses': businesses,
+            'pending_changes': len(self._delta_records) + len(self._stale),
+            'keys': len(self._key_slots) + len(self._delta_keys),
+            'bytes': total_bytes,
+            'bytes_per_million_businesses': int(total_bytes * 1_000_000 / businesses) if businesses else 0,
+        }
+
+
+# The process-wide index, the database time it's up to date with, and the
+# monotonic times it was last built and last built or caught up. Requests
+# never build it: one background thread at a time does.
+_index = None
+_synced_at = None
+_built_at = 0
+_checked_at = 0
+_too_large = False
+_busy = False
+_state_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'AUTOCOMPLETE_PREFIX_INDEX', True)
+
+
+def build_index():
+    """Load every business into a fresh index and make it the process-wide one"""
+    global _index, _synced_at, _built_at, _checked_at, _too_large
+    started = time.monotonic()
+    synced_at = timezone.now()
+    max_bytes = getattr(settings, 'AUTOCOMPLETE_PREFIX_INDEX_MAX_BYTES', 256 * 1024 * 1024)
+    rows = listed_businesses().values_list('reference_id', 'name', 'state_code').iterator(chunk_size=10000)
+    try:
+        index = PrefixIndex(rows, max_bytes=max_bytes)
+    except IndexTooLarge as error:
+        logger.warning(
+            "Prefix index passed the %s byte limit after %s businesses; "
+            "autocomplete will query the database instead",
+            max_bytes, error.businesses,
+        )
+        with _state_lock:
+            _index, _too_large = None, True
+        return None
+    stats = index.stats()
+    logger.info(
+        "Built prefix index: %s businesses, %s bytes (%s bytes per million businesses) in %.2fs",
+        stats['businesses'], stats['bytes'], stats['bytes_per_million_businesses'],
+        time.monotonic() - started,
+    )
+    with _state_lock:
+        _index, _synced_at, _too_large = index, synced_at, False
+        _built_at = _checked_at = time.monotonic()
+    return index
+
+
+def catch_up():
+    """
+    Apply the rows changed since the index was last synced, which is how
+    other processes' writes reach this one. Many changes, as after an
+    import, rebuild the index instead. Rows other processes deleted outright
+    leave nothing to catch up with, so it's also rebuilt every
+    AUTOCOMPLETE_PREFIX_INDEX_REBUILD_INTERVAL seconds.
+    """
+    global _synced_at, _checked_at
+    index = _index
+    if index is None:
+        return
+    rebuild_interval = getattr(settings, 'AUTOCOMPLETE_PREFIX_INDEX_REBUILD_INTERVAL', 3600)
+    if rebuild_interval and time.monotonic() - _built_at > rebuild_interval:
+        build_index()
+        return
+    synced_at = timezone.now()
+    rows = list(Business.objects.filter(updated_at__gte=_synced_at - CATCH_UP_OVERLAP).values_list(
+        'reference_id', 'name', 'state_code', 'removed_at'
+    )[:PrefixIndex.compact_threshold + 1])
+    if len(rows) > PrefixIndex.compact_threshold:
+        build_index()
+        return
+    for reference_id, name, state_code, removed_at in rows:
+        if removed_at is None:
+            index.upsert(reference_id, name, state_code)
+        else:
+            index.remove(reference_id)
+    with _state_lock:
+        _synced_at, _checked_at = synced_at, time.monotonic()
+
+
+def _run(job):
+    global _busy
+    try:
+        job()
+    except DatabaseError:
+        logger.exception("Prefix index %s failed", job.__name__)
+    finally:
+        with _state_lock:
+            _busy = False
+
+
+def _start(job):
+    """Run job on a background thread unless one is already running"""
+    global _busy
+    with _state_lock:
+        if _busy:
+            return
+        _busy = True
+    threading.Thread(target=_run, args=(job,), name='prefix-index', daemon=True).start()
+
+
+def schedule_rebuild():
+    """Rebuild the index on a background thread, serving the old one meanwhile"""
+    _start(build_index)
+
+
+def warm():
+    """Start building the index when a worker starts; until it's ready autocomplete uses the database"""
+    if is_enabled():
+        schedule_rebuild()
+
+
+def lookup(query, limit=10):
+    """
+    Prefix-match query against the in-process index.
+    Returns None when the index is disabled, too large or not built yet.
+    """
+    if not is_enabled():
+        return None
+    index = _index
+    if index is None:
+        if not _too_large:
+            # Normally already under way from warm()
+            schedule_rebuild()
+        return None
+    max_age = getattr(settings, 'AUTOCOMPLETE_PREFIX_INDEX_MAX_AGE', 300)
+    if max_age and time.monotonic() - _checked_at > max_age:
+        _start(catch_up)
+    return index.lookup(query, limit)
+
+
+# The hooks below apply a write once its transaction commits, so a rolled
+# back write never reaches the index
+
+def business_saved(business, using=None):
+    if business.removed_at is not None:
+        business_deleted(business, using)
+        return
+    reference_id, name, state_code = business.reference_id, business.name, business.state_code
+
+    def apply():
+        if _index is not None:
+            _index.upsert(reference_id, name, state_code)
+    transaction.on_commit(apply, using=using)
+
+
+def business_deleted(business, using=None):
+    reference_id = business.reference_id
+
+    def apply():
+        if _index is not None:
+            _index.remove(reference_id)
+    transaction.on_commit(apply, using=using)
+
+
+def businesses_loaded(reference_ids=None, using=None):
+    transaction.on_commit(lambda: _apply_load(reference_ids), using=using)
+
+
+def _apply_load(reference_ids):
+    """Apply a bulk load: refresh the given rows, or rebuild when the set is large or unknown"""
+    if _index is None:
+        return
+    if reference_ids is None or len(reference_ids) > PrefixIndex.compact_threshold:
+        schedule_rebuild()
+        return
+    reference_ids = set(reference_ids)
+    rows = listed_businesses().filter(reference_id__in=reference_ids).values_list(
+        'reference_id', 'name', 'state_code'
+    )
+    for reference_id, name, state_code in rows:
+        reference_ids.discard(reference_id)
+        _index.upsert(reference_id, name, state_code)
+    for reference_id in reference_ids:
+        _index.remove(reference_id)
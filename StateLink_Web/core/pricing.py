@@ -0,0 +1,161 @@
+"""
+Prices a compliance request's cart.
+
+A request's order is its OrderItem rows, one per selected service, each
+priced from services.SERVICES when it was selected. quote() reads them in
+one query and returns an immutable Quote with the package discount and
+add-ons applied.
+
+When the customer reaches the payment page the quote is stored on the
+request as a snapshot, stamped with PRICING_VERSION. The charge, the
+confirmation page, the receipt and the admin read the snapshot back from
+the request row rather than pricing the cart again. Changing the cart
+before payment discards the snapshot; once paid it is kept as charged.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.utils import timezone
+
+from .models import ComplianceRequest, OrderItem
+from .services import SERVICES
+
+# Bump when prices or discount rules change, so snapshots say which rules priced them
+PRICING_VERSION = 1
+
+# Ordering every service for the business type takes PACKAGE_DISCOUNT off
+PACKAGE_DISCOUNT = Decimal('49.90')
+PACKAGES = {
+    'CORP': frozenset({'FEDERAL_EIN', 'CORPORATE_BYLAWS', 'LABOR_LAW_POSTER_CERT'}),
+    'LLC': frozenset({'FEDERAL_EIN', 'OPERATING_AGREEMENT', 'LABOR_LAW_POSTER_CERT'}),
+}
+
+UNLIMITED_AMENDMENTS = ('UNLIMITED_AMENDMENTS', 'Unlimited Amendments', Decimal('39.95'))
+
+
+LineItem = namedtuple('LineItem', 'code name price')
+
+
+class CartLocked(Exception):
+    """The request has been paid for, so its order can't change"""
+
+
+class UnknownService(Exception):
+    """A service code that isn't in services.SERVICES"""
+
+
+class Quote(namedtuple('Quote', 'services line_items subtotal discount add_ons total')):
+    """
+    What a request costs: services is the frozenset of services ordered,
+    line_items and add_ons are tuples of LineItem, and total is subtotal
+    less discount plus the add-ons.
+    """
+    __slots__ = ()
+
+    @property
+    def show_discount(self):
+        return self.discount > 0
+
+    @property
+    def add_ons_total(self):
+        return sum((item.price for item in self.add_ons), Decimal('0.00'))
+
+    def snapshot(self):
+        """The quote as JSON-serialisable data for ComplianceRequest.quote_snapshot"""
+        return {
+            'version': PRICING_VERSION,
+            'services': sorted(self.services),
+            'line_items': [[item.code, item.name, str(item.price)] for item in self.line_items],
+            'subtotal': str(self.subtotal),
+            'discount': str(self.discount),
+            'add_ons': [[item.code, item.name, str(item.price)] for item in self.add_ons],
+            'total': str(self.total),
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(
+            frozenset(snapshot['services']),
+            tuple(LineItem(code, name, Decimal(price)) for code, name, price in snapshot['line_items']),
+            Decimal(snapshot['subtotal']),
+            Decimal(snapshot['discount']),
+            tuple(LineItem(code, name, Decimal(price)) for code, name, price in snapshot['add_ons']),
+            Decimal(snapshot['total']),
+        )
+
+
+def quote(compliance_request):
+    """Price compliance_request's order items; with its business already loaded this is one query"""
+    line_items = tuple(
+        LineItem(item.service, SERVICES[item.service].name if item.service in SERVICES else item.get_service_display(), item.price)
+        for item in compliance_request.items.all()
+    )
+    services = frozenset(item.code for item in line_items)
+    subtotal = sum((item.price for item in line_items), Decimal('0.00'))
+
+    package = PACKAGES.get(compliance_request.business.business_type)
+    discount = PACKAGE_DISCOUNT if package and package <= services else Decimal('0.00')
+    add_ons = (LineItem(*UNLIMITED_AMENDMENTS),) if compliance_request.unlimited_amendments else ()
+    total = subtotal - discount + sum((item.price for item in add_ons), Decimal('0.00'))
+    return Quote(services, line_items, subtotal, discount, add_ons, total)
+
+
+def select_services(compliance_request, services):
+    """
+    Make compliance_request's order the given services, in that order.
+    Newly selected services are priced now; items already on the order
+    keep their price and status, and ones no longer selected are removed.
+    Raises CartLocked once the request is paid, and UnknownService, before
+    changing anything, for a code that isn't in SERVICES.
+    """
+    if compliance_request.status == 'PAID':
+        raise CartLocked(f"Compliance request {compliance_request.pk} is already paid")
+    unknown = [service for service in services if service not in SERVICES]
+    if unknown:
+        raise UnknownService(f"Unknown services: {', '.join(unknown)}")
+    items = {item.service: item for item in compliance_request.items.all()}
+    compliance_request.items.exclude(service__in=services).delete()
+    added = []
+    moved = []
+    for position, service in enumerate(services):
+        item = items.get(service)
+        if item is None:
+            added.append(OrderItem(
+                compliance_request=compliance_request, service=service, position=position, price=SERVICES[service].price,
+            ))
+        elif item.position != position:
+            item.position = position
+            moved.append(item)
+    OrderItem.objects.bulk_create(added)
+    OrderItem.objects.bulk_update(moved, ['position'])
+
+
+def snapshot_quote(compliance_request):
+    """
+    The Quote stored on compliance_request, pricing the cart and storing it
+    first if there is none. The first snapshot stored wins, so concurrent
+    payment pages can't leave the request priced two ways.
+    """
+    if compliance_request.quote_snapshot is None:
+        fresh = quote(compliance_request)
+        quoted_at = timezone.now()
+        stored = ComplianceRequest.objects.filter(pk=compliance_request.pk, quote_snapshot__isnull=True).update(
+            quote_snapshot=fresh.snapshot(), quoted_at=quoted_at,
+        )
+        if stored:
+            compliance_request.quote_snapshot, compliance_request.quoted_at = fresh.snapshot(), quoted_at
+        else:
+            compliance_request.refresh_from_db(fields=['quote_snapshot', 'quoted_at'])
+    return Quote.from_snapshot(compliance_request.quote_snapshot)
+
+
+def discard_quote(compliance_request):
+    """
+    Drop compliance_request's snapshot after its cart changes. Returns the
+    fields changed, for the caller to save; paid requests keep theirs.
+    """
+    if compliance_request.status == 'PAID':
+        return []
+    compliance_request.quote_snapshot = None
+    compliance_request.quoted_at = None
+    return ['quote_snapshot', 'quoted_at']
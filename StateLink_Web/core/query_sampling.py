@@ -0,0 +1,89 @@
+"""
+Samples the SQL that requests run, for `manage.py index_advisor`.
+
+QuerySamplingMiddleware picks QUERY_SAMPLE_RATE of requests and wraps them
+in a QuerySampler, a database execute wrapper that times every SELECT the
+request runs. When the request finishes its statements are appended to
+QUERY_SAMPLE_LOG as JSON lines, one write per request so concurrent
+workers don't interleave. With the rate at 0 the middleware removes itself
+at startup and costs nothing.
+
+Only SELECTs are recorded: writes carry what customers submit, card tokens
+and contact details among it, as their parameters. SELECT parameters are
+logged so the advisor can EXPLAIN real queries; they include search terms,
+so the log is created readable by its owner only and kept out of the
+project directory by default.
+"""
+import contextlib
+import json
+import logging
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QuerySampler:
+    """Execute wrapper collecting {alias, sql, params, ms} for each SELECT run through it"""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            # executemany batches are bulk writes, which indexes only slow down
+            if not many and sql.lstrip()[:7].upper() == 'SELECT ':
+                self.queries.append({
+                    'alias': self.alias,
+                    'sql': sql,
+                    'params': list(params or ()),
+                    'ms': round((time.perf_counter() - started) * 1000, 3),
+                })
+
+
+def write_samples(path, queries):
+    """Append queries to the sample log at path"""
+    if not queries:
+        return
+    lines = ''.join(json.dumps(query, default=str) + '\n' for query in queries)
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    with open(descriptor, 'a', encoding='utf-8') as log:
+        log.write(lines)
+
+
+@contextlib.contextmanager
+def sample_queries(path):
+    """Record every statement run on any database inside the block to the sample log at path"""
+    samplers = []
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            sampler = QuerySampler(connection.alias)
+            stack.enter_context(connection.execute_wrapper(sampler))
+            samplers.append(sampler)
+        yield
+    try:
+        write_samples(path, [query for sampler in samplers for query in sampler.queries])
+    except OSError:
+        logger.exception("Couldn't write query samples to %s", path)
+
+
+class QuerySamplingMiddleware:
+    def __init__(self, get_response):
+        if settings.QUERY_SAMPLE_RATE <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.QUERY_SAMPLE_RATE:
+            return self.get_response(request)
+        with sample_queries(settings.QUERY_SAMPLE_LOG):
+            return self.get_response(request)
@@ -0,0 +1,108 @@
+"""
+Compact reference IDs for businesses.
+
+An ID is eight Crockford base32 characters encoding a number from a
+database sequence, plus a ninth check character, e.g. "7KQ2M9XP4". The
+alphabet leaves out I, L, O and U, so IDs read back over the phone or typed
+from a letter don't confuse 1/I/L or 0/O, and normalise() maps those back.
+Every sequence number encodes to a different ID, so IDs are unique without
+asking the database; allocators reserve numbers in blocks and hand them
+out from memory.
+
+IDs from before the allocator are eight lowercase hex characters and are
+still accepted. Being one character shorter, they can't collide with
+allocated IDs.
+"""
+import re
+import threading
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+BASE = len(ALPHABET)
+PAYLOAD_LENGTH = 8
+LENGTH = PAYLOAD_LENGTH + 1
+# Sequence numbers that fit in PAYLOAD_LENGTH characters (2 ** 40)
+CAPACITY = BASE ** PAYLOAD_LENGTH
+
+REFERENCE_ID_RE = re.compile(rf'^[{ALPHABET}]{{{LENGTH}}}$')
+LEGACY_REFERENCE_ID_RE = re.compile(r'^[0-9a-f]{8}$')
+
+# Characters people type for the ones the alphabet leaves out
+LOOKALIKES = str.maketrans('OIL', '011')
+SEPARATORS_RE = re.compile(r'[\s-]+')
+
+# Odd multipliers and an xor, so each step of the mix is a bijection on
+# [0, CAPACITY). The mix isn't secret; it just keeps consecutive letters
+# from carrying consecutive-looking IDs.
+MULTIPLIERS = (0x5DEECE66D, 0x2545F4914F)
+SHIFT = 20
+XOR = 0x3A5C96F0E1
+
+
+def _mix(number):
+    number = (number * MULTIPLIERS[0]) % CAPACITY
+    number ^= number >> SHIFT
+    return ((number * MULTIPLIERS[1]) % CAPACITY) ^ XOR
+
+
+def check_character(payload):
+    """Luhn mod 32 check character, which catches any single wrong character and most swaps"""
+    total = 0
+    factor = 2
+    for char in reversed(payload):
+        addend = factor * ALPHABET.index(char)
+        total += addend // BASE + addend % BASE
+        factor = 3 - factor
+    return ALPHABET[-total % BASE]
+
+
+def encode(number):
+    """The reference ID for sequence number"""
+    if not 0 <= number < CAPACITY:
+        raise ValueError(f"Sequence number {number} is out of range")
+    number = _mix(number)
+    chars = []
+    for _position in range(PAYLOAD_LENGTH):
+        number, digit = divmod(number, BASE)
+        chars.append(ALPHABET[digit])
+    payload = ''.join(reversed(chars))
+    return payload + check_character(payload)
+
+
+def normalise(value):
+    """
+    Return value as a canonical reference ID, or None if it isn't one:
+    separators are dropped, allocated IDs are uppercased with lookalike
+    letters mapped back and their check character verified, and legacy hex
+    IDs are lowercased.
+    """
+    value = SEPARATORS_RE.sub('', value or '')
+    if LEGACY_REFERENCE_ID_RE.match(value.lower()):
+        return value.lower()
+    value = value.upper().translate(LOOKALIKES)
+    if REFERENCE_ID_RE.match(value) and check_character(value[:-1]) == value[-1]:
+        return value
+    return None
+
+
+class ReferenceIdAllocator:
+    """
+    Hands out reference IDs from blocks of block_size sequence numbers,
+    calling reserve(count) for the next block when one runs out. reserve
+    returns an iterable of the numbers, which may stop early if the
+    reservation is withdrawn. Numbers left in a block when the process
+    exits are never used.
+    """
+
+    def __init__(self, reserve, block_size=100):
+        self.reserve = reserve
+        self.block_size = block_size
+        self._numbers = iter(())
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            number = next(self._numbers, None)
+            if number is None:
+                self._numbers = iter(self.reserve(self.block_size))
+                number = next(self._numbers)
+        return encode(number)
@@ -0,0 +1,375 @@
+import base64
+import binascii
+import hashlib
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+from .models import Business, normalise_business_name, normalise_reference_id
+
+# SQLite FTS5 table mirroring core_business(name, reference_id)
+FTS_TABLE = 'core_business_fts'
+
+# PostgreSQL trigram indexes backing name/reference_id substring lookups
+TRIGRAM_INDEXES = {
+    'core_business_name_trgm': 'name',
+    'core_business_ref_trgm': 'reference_id',
+}
+
+
+def trigrams(value):
+    """Casefolded character trigrams of value, as the FTS5 trigram tokenizer produces them"""
+    value = ' '.join((value or '').casefold().split())
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+# How many businesses a search matched. An estimate may be off either way;
+# a capped count only says there are more than count.
+ResultCount = namedtuple('ResultCount', 'count is_estimate is_capped', defaults=(False,))
+
+
+def listed_businesses():
+    """Businesses that search should offer: everything not soft-deleted by an import"""
+    return Business.objects.filter(removed_at__isnull=True)
+
+
+class BaseSearchBackend:
+    """
+    Resolves a free-text query to a queryset of matching businesses.
+    Backends only narrow the candidate rows; callers order, project and slice.
+    """
+    vendor = None
+    # Above this many matches the exact total is not worth counting
+    count_cap = 1000
+
+    def search(self, query):
+        query = (query or '').strip()
+        if not query:
+            return Business.objects.none()
+        return self.filter(listed_businesses(), query)
+
+    def filter(self, queryset, query):
+        return queryset.filter(
+            Q(name__icontains=query) | Q(reference_id__icontains=query)
+        )
+
+    def key_prefix_filter(self, key):
+        """Q matching businesses whose search_key starts with key"""
+        return Q(search_key__startswith=key)
+
+    def fuzzy_candidates(self, query, limit):
+        """
+        Return up to limit (reference_id, name, state_code) rows whose names
+        share n-grams with query, best first. Without an n-gram index there
+        are no candidates.
+        """
+        return []
+
+    def estimate_count(self, queryset):
+        """
+        Return a ResultCount for queryset without an unbounded COUNT.
+        The default counts at most count_cap + 1 rows.
+        """
+        count = queryset.order_by()[:self.count_cap + 1].count()
+        if count > self.count_cap:
+            return ResultCount(self.count_cap, True, True)
+        return ResultCount(count, False)
+
+    def install(self, schema_editor):
+        """Create the database objects the backend relies on"""
+
+    def uninstall(self, schema_editor):
+        """Drop the database objects created by install()"""
+
+    def rebuild(self):
+        """Re-sync the search index with the business table"""
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """Plain icontains lookups, used when no indexed backend is available."""
+
+
+class PostgresTrigramSearchBackend(BaseSearchBackend):
+    """
+    Backs the icontains lookups with pg_trgm GIN indexes on UPPER(column),
+    which is the expression Django emits for icontains on PostgreSQL.
+    The indexes are maintained by PostgreSQL itself, so saves and bulk
+    loads need no extra bookkeeping.
+    """
+    vendor = 'postgresql'
+
+    def fuzzy_candidates(self, query, limit):
+        # % is answered from the trigram GIN index; similarity() orders the survivors
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reference_id, name, state_code FROM core_business '
+                'WHERE UPPER(name) %% UPPER(%s) AND removed_at IS NULL '
+                'ORDER BY similarity(UPPER(name), UPPER(%s)) DESC LIMIT %s',
+                [query, query, limit],
+            )
+            return cursor.fetchall()
+
+    def estimate_count(self, queryset):
+        # The planner's row estimate costs a plan, not a scan
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return ResultCount(int(plan[0]['Plan']['Plan Rows']), True)
+
+    def install(self, schema_editor):
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for index_name, column in TRIGRAM_INDEXES.items():
+            schema_editor.execute(
+                f'CREATE INDEX IF NOT EXISTS {index_name} ON core_business '
+                f'USING gin (UPPER({column}) gin_trgm_ops)'
+            )
+
+    def uninstall(self, schema_editor):
+        for index_name in TRIGRAM_INDEXES:
+            schema_editor.execute(f'DROP INDEX IF EXISTS {index_name}')
+
+
+class SQLiteFTSSearchBackend(BaseSearchBackend):
+    """
+    External-content FTS5 table with the trigram tokenizer, which answers
+    case-insensitive substring queries of three or more characters from the
+    index. Triggers keep it in step with every write to core_business,
+    including bulk_create and raw loads that bypass model signals.
+    """
+    vendor = 'sqlite'
+    min_query_length = 3
+    # Fuzzy candidates: only the first fuzzy_prefix_length characters of the
+    # query are matched, each trigram group reading at most fuzzy_group_limit rows
+    fuzzy_prefix_length = 20
+    fuzzy_group_limit = 100
+
+    def key_prefix_filter(self, key):
+        # SQLite's LIKE is case-insensitive and can't use the index; a range
+        # over the binary-collated column can
+        return Q(search_key__gte=key, search_key__lt=key + '\U0010ffff')
+
+    def filter(self, queryset, query):
+        if len(query) < self.min_query_length:
+            return super().filter(queryset, query)
+        match = '"{}"'.format(query.replace('"', '""'))
+        # The FTS rowid is core_business.id
+        return queryset.filter(pk__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            [match],
+        ))
+
+    def fuzzy_candidates(self, query, limit):
+        # One typo breaks at most four consecutive trigrams of the query (three
+        # for an insertion, deletion or substitution, four for a transposition).
+        # Every such run lies inside one of the windows of five starting at even
+        # offsets, so requiring all trigrams outside some window still finds the
+        # intended name while each AND query stays selective.
+        query_trigrams = [query[i:i + 3] for i in range(min(len(query), self.fuzzy_prefix_length) - 2)]
+        window = 5
+        if len(query_trigrams) <= window:
+            return []
+        groups = {
+            tuple(dict.fromkeys(query_trigrams[:i] + query_trigrams[i + window:]))
+            for i in range(0, len(query_trigrams) - window + 2, 2)
+        }
+
+        rows = {}
+        with connection.cursor() as cursor:
+            for group in groups:
+                match = ' AND '.join('"{}"'.format(term.replace('"', '""')) for term in group)
+                # bm25 rank favours the names that are mostly made of the
+                # query's trigrams, so the limit keeps the closest matches
+                cursor.execute(
+                    f'SELECT b.reference_id, b.name, b.state_code FROM {FTS_TABLE} '
+                    f'JOIN core_business b ON b.id = {FTS_TABLE}.rowid '
+                    f'WHERE {FTS_TABLE} MATCH %s AND b.removed_at IS NULL '
+                    f'ORDER BY {FTS_TABLE}.rank LIMIT %s',
+                    [match, self.fuzzy_group_limit],
+                )
+                for row in cursor.fetchall():
+                    rows[row[0]] = row
+        # Rank by the number of query trigrams each name shares, then the
+        # shorter name, which has fewer characters the query didn't ask for
+        query_trigrams = set(query_trigrams)
+        return sorted(
+            rows.values(), key=lambda row: (-len(query_trigrams & trigrams(row[1])), len(row[1]))
+        )[:limit]
+
+    def install(self, schema_editor):
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"name, reference_id, content='core_business', content_rowid='rowid', "
+            f"tokenize='trigram')"
+        )
+        schema_editor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON core_business BEGIN '
+            f'INSERT INTO {FTS_TABLE}(rowid, name, reference_id) '
+            f'VALUES (new.rowid, new.name, new.reference_id); END'
+        )
+        schema_editor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON core_business BEGIN '
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, reference_id) "
+            f"VALUES ('delete', old.rowid, old.name, old.reference_id); END"
+        )
+        schema_editor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name, reference_id '
+            f'ON core_business BEGIN '
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, reference_id) "
+            f"VALUES ('delete', old.rowid, old.name, old.reference_id); "
+            f'INSERT INTO {FTS_TABLE}(rowid, name, reference_id) '
+            f'VALUES (new.rowid, new.name, new.reference_id); END'
+        )
+        schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+    def uninstall(self, schema_editor):
+        for suffix in ('ai', 'ad', 'au'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def resolve_reference_id(query):
+    """
+    Unique-index lookup for reference-ID-shaped queries, so letters that print
+    the reference ID skip the substring search. Returns the Business or None.
+    """
+    reference_id = normalise_reference_id(query)
+    if reference_id is None:
+        return None
+    return Business.objects.filter(reference_id=reference_id).only('reference_id').first()
+
+
+# Columns rendered by core/search_results.html, plus updated_at for the ETag
+# and search_key for the cursor
+RESULT_FIELDS = ('name', 'reference_id', 'business_type', 'state_code', 'updated_at', 'search_key')
+
+# Relevance tiers, best first, and the column each is ordered by; ties are
+# broken by id
+EXACT, PREFIX, SUBSTRING = range(3)
+TIER_ORDERING = {EXACT: 'search_key', PREFIX: 'search_key', SUBSTRING: 'name'}
+
+
+def encode_cursor(tier, business):
+    """Opaque keyset cursor pointing just past business within its relevance tier"""
+    payload = json.dumps([tier, getattr(business, TIER_ORDERING[tier]), business.pk]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the (tier, value, pk) triple in cursor, or None if it is malformed"""
+    try:
+        tier, value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        return None
+    if tier not in TIER_ORDERING or not isinstance(value, str) or type(pk) is not int:
+        return None
+    return tier, value, pk
+
+
+class SearchPage:
+    """
+    One keyset page of search results, limited to RESULT_FIELDS and ranked
+    in the database: businesses whose search key equals the query's come
+    first, then those whose key starts with it, then the remaining substring
+    matches from the search backend. Each tier is read in index order and
+    only as far as the page needs. The total is only estimated when asked for.
+    """
+
+    def __init__(self, query, cursor=None, page_size=20):
+        self.query = query
+        self.cursor = cursor
+        self.backend = get_search_backend()
+        self.matches = self.backend.search(query)
+        self.key = normalise_business_name(query)
+
+        after = decode_cursor(cursor) if cursor else None
+        self.is_first_page = after is None
+        first_tier = after[0] if after else EXACT
+
+        rows = []
+        for tier, queryset in self.tiers():
+            if tier < first_tier:
+                continue
+            field = TIER_ORDERING[tier]
+            page = queryset.only(*RESULT_FIELDS).order_by(field, 'pk')
+            if after and tier == first_tier:
+                _tier, value, pk = after
+                page = page.filter(Q(**{f'{field}__gt': value}) | Q(**{field: value, 'pk__gt': pk}))
+            rows.extend((tier, business) for business in page[:page_size + 1 - len(rows)])
+            if len(rows) > page_size:
+                break
+
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.businesses = [business for _tier, business in rows]
+        self.next_cursor = encode_cursor(*rows[-1]) if self.has_next else None
+
+    def tiers(self):
+        """(tier, queryset) pairs, best first; each excludes the rows of the tiers before it"""
+        if not self.key:
+            return [(SUBSTRING, self.matches)]
+        prefix = self.backend.key_prefix_filter(self.key)
+        return [
+            (EXACT, listed_businesses().filter(search_key=self.key)),
+            (PREFIX, listed_businesses().filter(prefix).exclude(search_key=self.key)),
+            (SUBSTRING, self.matches.exclude(prefix)),
+        ]
+
+    @cached_property
+    def count(self):
+        """ResultCount for the whole result set"""
+        if self.is_first_page and not self.has_next:
+            # The whole result set fits on this page
+            return ResultCount(len(self.businesses), False)
+        if not self.key:
+            return self.backend.estimate_count(self.matches)
+        return self.backend.estimate_count(
+            self.matches | listed_businesses().filter(self.backend.key_prefix_filter(self.key))
+        )
+
+    @cached_property
+    def etag(self):
+        """Validator covering the rows on this page and their last modification"""
+        digest = hashlib.sha1(json.dumps([self.query, self.cursor, self.has_next]).encode('utf-8'))
+        for business in self.businesses:
+            digest.update(f'|{business.reference_id}:{business.updated_at.isoformat()}'.encode('utf-8'))
+        return f'"{digest.hexdigest()}"'
+
+
+VENDOR_BACKENDS = {
+    'postgresql': PostgresTrigramSearchBackend,
+    'sqlite': SQLiteFTSSearchBackend,
+}
+
+_backend = None
+
+
+def backend_for_vendor(vendor):
+    return VENDOR_BACKENDS.get(vendor, DatabaseSearchBackend)()
+
+
+def get_search_backend():
+    """
+    Return the configured search backend. SEARCH_BACKEND may name a backend
+    class by dotted path; otherwise one is picked for the database vendor.
+    """
+    global _backend
+    if _backend is None:
+        backend_path = getattr(settings, 'SEARCH_BACKEND', None)
+        if backend_path:
+            _backend = import_string(backend_path)()
+        else:
+            _backend = backend_for_vendor(connection.vendor)
+    return _backend
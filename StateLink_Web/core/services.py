@@ -0,0 +1,196 @@
+"""
+The services customers can order, and the forms that collect what each needs.
+
+SERVICES maps a service code (OrderItem.service) to a Service: the line
+item name and price it's sold at, the business types it's offered to and
+the steps of its service form. Most services are one step; the labor law
+poster and certificate of existence bundle is two. Each Step works out at
+import which fields it writes: the form's fields that its model has.
+Adding a service is one entry in SERVICES.
+
+A step's row also holds its draft: answers autosaved while the customer is
+still filling the form in, which start the form off when they come back.
+The order item stays pending until the whole form is submitted.
+"""
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .forms import (
+    CertificateExistenceForm,
+    CorporateBylawsForm,
+    FederalEINForm,
+    LaborLawPosterForm,
+    OperatingAgreementForm,
+)
+from .models import (
+    CertificateExistenceRequest,
+    ComplianceRequest,
+    CorporateBylawsRequest,
+    FederalEINRequest,
+    LaborLawPosterRequest,
+    OperatingAgreementRequest,
+)
+
+
+class Step:
+    """
+    One service form: the form class and the template of its fields, included
+    by the page showing it, and the model its answers are saved to, one row
+    per compliance request. Answers named in request_fields are saved on the
+    ComplianceRequest itself.
+    """
+
+    def __init__(self, name, form_class, template, model, request_fields=()):
+        self.name = name
+        self.form_class = form_class
+        self.template = template
+        self.model = model
+        self.request_fields = tuple(request_fields)
+        model_fields = {
+            field.name for field in model._meta.concrete_fields
+            if field.editable and not field.primary_key and field.name != 'compliance_request'
+        }
+        self.fields = tuple(name for name in form_class.base_fields if name in model_fields)
+
+    def __repr__(self):
+        return f'<Step {self.name}>'
+
+    def save(self, compliance_request, cleaned_data):
+        """
+        Save the step's answers for compliance_request, inserting its row or
+        updating just the step's fields on the one already there. Answers
+        for the ComplianceRequest are only set on it; their names are
+        returned for the caller to save along with its own changes.
+        """
+        request_fields = [field for field in self.request_fields if field in cleaned_data]
+        for field in request_fields:
+            setattr(compliance_request, field, cleaned_data[field])
+
+        values = {field: cleaned_data.get(field) for field in self.fields}
+        row = self.model.objects.filter(compliance_request=compliance_request).only('pk').first()
+        if row is None:
+            self.model.objects.create(compliance_request=compliance_request, **values)
+        else:
+            for field, value in values.items():
+                setattr(row, field, value)
+            row.save(update_fields=self.fields)
+        return request_fields
+
+    def initial(self, compliance_request):
+        """The answers saved so far for compliance_request, to start the form from"""
+        initial = {field: getattr(compliance_request, field) for field in self.request_fields}
+        row = self.model.objects.filter(compliance_request=compliance_request).values(*self.fields).first()
+        initial.update(row or {})
+        return initial
+
+    def clean_fields(self, data, names):
+        """
+        Validate just the named fields of data, a partly filled-in form.
+        Returns the cleaned values and the errors, by field name; checks
+        across fields wait for the whole form.
+        """
+        form = self.form_class(data=data)
+        values, errors = {}, {}
+        for name in names:
+            if name not in form.fields:
+                continue
+            try:
+                value = form.fields[name].clean(form[name].data)
+                form.cleaned_data = {name: value}
+                if hasattr(form, f'clean_{name}'):
+                    value = getattr(form, f'clean_{name}')()
+            except ValidationError as error:
+                errors[name] = error.messages
+            else:
+                values[name] = value
+        return values, errors
+
+    def save_draft(self, compliance_request, values):
+        """
+        Write values, cleaned answers to some of the step's fields, updating
+        just their columns. Returns the names written; answers the step
+        doesn't keep are left out.
+        """
+        row_values = {field: value for field, value in values.items() if field in self.fields}
+        request_values = {field: value for field, value in values.items() if field in self.request_fields}
+        with transaction.atomic():
+            if request_values:
+                ComplianceRequest.objects.filter(pk=compliance_request.pk).update(
+                    **request_values, updated_at=timezone.now(),
+                )
+                for field, value in request_values.items():
+                    setattr(compliance_request, field, value)
+            rows = self.model.objects.filter(compliance_request=compliance_request)
+            if row_values and not rows.update(**row_values):
+                try:
+                    with transaction.atomic():
+                        self.model.objects.create(compliance_request=compliance_request, **row_values)
+                except IntegrityError:
+                    # Another autosave created the row first
+                    rows.update(**row_values)
+        return [*row_values, *request_values]
+
+
+class Service:
+    """
+    Something a customer can order. business_types limits who's offered it;
+    None offers it to every business type, and an empty tuple to none.
+    """
+
+    def __init__(self, name, price, steps, business_types=None):
+        self.name = name
+        self.price = price
+        self.steps = tuple(steps)
+        self.business_types = business_types
+
+    def __repr__(self):
+        return f'<Service {self.name}>'
+
+    def offered_to(self, business_type):
+        return self.business_types is None or business_type in self.business_types
+
+
+APPLICANT_FIELDS = (
+    'applicant_reference_id', 'applicant_first_name', 'applicant_last_name', 'applicant_email', 'applicant_phone_number',
+)
+
+LABOR_LAW_POSTER_STEP = Step(
+    'Labor Law Poster', LaborLawPosterForm, 'core/service_forms/labor_law_poster.html', LaborLawPosterRequest,
+)
+CERTIFICATE_EXISTENCE_STEP = Step(
+    'Certificate of Existence', CertificateExistenceForm, 'core/service_forms/certificate_existence.html',
+    CertificateExistenceRequest,
+)
+
+# In the order the compliance form offers them
+SERVICES = {
+    'OPERATING_AGREEMENT': Service(
+        'Operating Agreement', Decimal('249.95'),
+        [Step('Operating Agreement', OperatingAgreementForm, 'core/service_forms/operating_agreement.html', OperatingAgreementRequest)],
+        business_types=('LLC',),
+    ),
+    'CORPORATE_BYLAWS': Service(
+        'Corporate Bylaws', Decimal('249.95'),
+        [Step('Corporate Bylaws', CorporateBylawsForm, 'core/service_forms/corporate_bylaws.html', CorporateBylawsRequest)],
+        business_types=('CORP',),
+    ),
+    'FEDERAL_EIN': Service(
+        'Federal EIN Application', Decimal('149.95'),
+        [Step(
+            'Federal EIN Application', FederalEINForm, 'core/service_forms/federal_ein.html', FederalEINRequest,
+            request_fields=APPLICANT_FIELDS,
+        )],
+    ),
+    'LABOR_LAW_POSTER_CERT': Service(
+        'Labor Law Posters & Certificate of Existence', Decimal('149.95'),
+        [LABOR_LAW_POSTER_STEP, CERTIFICATE_EXISTENCE_STEP],
+    ),
+    # Sold separately before the bundle; still on older orders
+    'LABOR_LAW_POSTER': Service('Labor Law Posters', Decimal('99.95'), [LABOR_LAW_POSTER_STEP], business_types=()),
+    'CERTIFICATE_EXISTENCE': Service(
+        'Certificate of Existence', Decimal('99.95'), [CERTIFICATE_EXISTENCE_STEP], business_types=(),
+    ),
+}
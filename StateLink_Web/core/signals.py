@@ -0,0 +1,24 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from . import prefix_index
+from .models import Business
+
+# Sent by bulk loaders after writing Business rows outside of Model.save().
+# Pass reference_ids when the affected rows are known, or None for a full reload.
+businesses_loaded = Signal()
+
+
+@receiver(post_save, sender=Business)
+def business_saved(sender, instance, using, **kwargs):
+    prefix_index.business_saved(instance, using)
+
+
+@receiver(post_delete, sender=Business)
+def business_deleted(sender, instance, using, **kwargs):
+    prefix_index.business_deleted(instance, using)
+
+
+@receiver(businesses_loaded)
+def business_bulk_loaded(sender, reference_ids=None, **kwargs):
+    prefix_index.businesses_loaded(reference_ids)
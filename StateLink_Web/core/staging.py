@@ -0,0 +1,342 @@
+import logging
+import re
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Business
+from .search import backend_for_vendor
+
+logger = logging.getLogger(__name__)
+
+# Catching staging up re-reads rows written this long before the first carry
+# over, so rows written by transactions that committed late aren't missed
+CATCH_UP_OVERLAP = timedelta(seconds=60)
+
+
+class TableSwap(ABC):
+    """
+    Builds a staging copy of core_business and swaps it in for the live table
+    in one short transaction, so readers see either the old rows or the new
+    ones and never a half-loaded table.
+
+    Indexes and triggers are copied from whatever the live table has at swap
+    time, so the staging table matches what migrations have created.
+
+    Rows are carried over and the staging table indexed while the live
+    table is still being written to. Writes are then held off, reads still
+    allowed, only while staging catches up with the rows written since and
+    is swapped in (see writes_held). Writes made during the load to rows the
+    file reloads are replaced by the file's rows, as an import would replace
+    them; new businesses added meanwhile in a reloaded state and left out of
+    the file are dropped unless something references them.
+    """
+    table = Business._meta.db_table
+    staging_table = f'{Business._meta.db_table}_staging'
+
+    @abstractmethod
+    def create_staging(self):
+        """
+        Create an empty staging table with the live table's columns and its
+        primary key and unique constraints only, whose ids for new
+        businesses continue after the live table's.
+        """
+
+    def create_indexes(self):
+        """Index the loaded staging table like the live table"""
+
+    @contextmanager
+    def writes_held(self):
+        """
+        Transaction that the final carry_over() through swap() run in, which
+        keeps writes to the live table waiting until it commits so none are lost
+        """
+        with transaction.atomic():
+            yield
+
+    @abstractmethod
+    def swap(self):
+        """Replace the live table with the staging table"""
+
+    def validate(self):
+        """Finish checking the swapped-in table, after writes_held() has committed"""
+
+    def drop_staging(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.staging_table}')
+
+    @property
+    def columns(self):
+        return [field.column for field in Business._meta.concrete_fields]
+
+    def references(self):
+        """(table, column, target column) triples of the foreign keys pointing at core_business"""
+        return [
+            (relation.related_model._meta.db_table, relation.field.column, relation.field.target_field.column)
+            for relation in Business._meta.related_objects
+            if relation.field.concrete and not relation.many_to_many
+        ]
+
+    def next_id(self, cursor):
+        cursor.execute(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {self.table}')
+        return cursor.fetchone()[0]
+
+    def carry_over(self, state_codes, since=None):
+        """
+        Copy into staging the live rows a reload of state_codes must keep:
+        businesses in other states, and businesses the file dropped that
+        other tables still reference, which come across soft-deleted. Rows
+        the file did load keep their created_at and derived flags, and their
+        updated_at when the content is unchanged.
+
+        With since, catch up with the live table instead: carried rows
+        written or deleted since then are copied again, and only rows
+        written since, or whose flags differ, are touched. Every writer
+        but the flag recompute sets updated_at, which is how writes are found.
+        """
+        columns = ', '.join(self.columns)
+        state_placeholders = ', '.join(['%s'] * len(state_codes))
+        not_loaded = f'reference_id NOT IN (SELECT reference_id FROM {self.staging_table})'
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        written, changed, params = '', '', []
+        with connection.cursor() as cursor:
+            if since is not None:
+                since = connection.ops.adapt_datetimefield_value(since - CATCH_UP_OVERLAP)
+                written, params = ' AND updated_at >= %s', [since]
+                changed = (
+                    ' AND (b.updated_at >= %s OR b.is_new <> s.is_new OR b.missing_filing <> s.missing_filing)'
+                )
+                cursor.execute(
+                    f'DELETE FROM {self.staging_table} '
+                    f'WHERE (state_code NOT IN ({state_placeholders}) OR removed_at IS NOT NULL) '
+                    f'AND (id IN (SELECT id FROM {self.table} WHERE updated_at >= %s) '
+                    f'OR id NOT IN (SELECT id FROM {self.table}))',
+                    [*state_codes, since],
+                )
+            cursor.execute(
+                f'INSERT INTO {self.staging_table} ({columns}) SELECT {columns} FROM {self.table} '
+                f'WHERE state_code NOT IN ({state_placeholders}) AND {not_loaded}{written}',
+                [*state_codes, *params],
+            )
+            removed_columns = ', '.join(
+                'COALESCE(removed_at, %s)' if column == 'removed_at' else column
+                for column in self.columns
+            )
+            # Referencing rows may be new whenever the business isn't, so these are all checked
+            for table, column, target in self.references():
+                cursor.execute(
+                    f'INSERT INTO {self.staging_table} ({columns}) SELECT {removed_columns} FROM {self.table} '
+                    f'WHERE {target} IN (SELECT {column} FROM {table}) AND {not_loaded}',
+                    [now],
+                )
+            cursor.execute(
+                f'UPDATE {self.staging_table} AS s SET created_at = b.created_at, is_new = b.is_new, '
+                f'missing_filing = b.missing_filing, updated_at = CASE '
+                f'WHEN b.content_hash = s.content_hash AND b.removed_at IS NULL THEN b.updated_at '
+                f'ELSE s.updated_at END '
+                f'FROM {self.table} AS b WHERE b.id = s.id{changed}',
+                params,
+            )
+
+    def count_removed(self, state_codes):
+        """Listed live businesses in state_codes that staging no longer lists"""
+        state_placeholders = ', '.join(['%s'] * len(state_codes))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT COUNT(*) FROM {self.table} b WHERE b.state_code IN ({state_placeholders}) '
+                f'AND b.removed_at IS NULL AND NOT EXISTS (SELECT 1 FROM {self.staging_table} s '
+                f'WHERE s.reference_id = b.reference_id AND s.removed_at IS NULL)',
+                list(state_codes),
+            )
+            removed = cursor.fetchone()[0]
+            cursor.execute(
+                f'SELECT COUNT(*) FROM {self.table} WHERE state_code IN ({state_placeholders}) '
+                f'AND removed_at IS NULL',
+                list(state_codes),
+            )
+            return removed, cursor.fetchone()[0]
+
+    def count_dangling(self):
+        """References that would point at no business after the swap"""
+        dangling = 0
+        with connection.cursor() as cursor:
+            for table, column, target in self.references():
+                cursor.execute(
+                    f'SELECT COUNT(*) FROM {table} WHERE {column} IS NOT NULL AND {column} NOT IN '
+                    f'(SELECT {target} FROM {self.staging_table})'
+                )
+                dangling += cursor.fetchone()[0]
+        return dangling
+
+
+class PostgresTableSwap(TableSwap):
+    """
+    Constraints and indexes are created on the staging table under
+    temporary names and renamed in the swap. Foreign keys into core_business are dropped and
+    re-added NOT VALID inside the swap, then validated after it without
+    blocking reads. Writes wait on an EXCLUSIVE lock on the live table
+    while it is swapped.
+    """
+    index_suffix = '_stg'
+    lock_timeout = '10s'
+
+    def create_staging(self):
+        self.drop_staging()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TABLE {self.staging_table} '
+                f'(LIKE {self.table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY)'
+            )
+            for name, definition in self.live_constraints(cursor):
+                cursor.execute(
+                    f'ALTER TABLE {self.staging_table} ADD CONSTRAINT {name}{self.index_suffix} {definition}'
+                )
+            cursor.execute(
+                f'ALTER TABLE {self.staging_table} ALTER COLUMN id RESTART WITH {self.next_id(cursor)}'
+            )
+
+    def live_constraints(self, cursor):
+        """The live table's primary key and unique constraints, which the upserts need during the load"""
+        cursor.execute(
+            'SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint '
+            "WHERE conrelid = %s::regclass AND contype IN ('p', 'u')",
+            [self.table],
+        )
+        return cursor.fetchall()
+
+    def live_indexes(self, cursor):
+        cursor.execute(
+            'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() '
+            'AND tablename = %s AND indexname NOT IN ('
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('p', 'u'))",
+            [self.table, self.table],
+        )
+        return cursor.fetchall()
+
+    def create_indexes(self):
+        with connection.cursor() as cursor:
+            for name, definition in self.live_indexes(cursor):
+                definition = re.sub(
+                    r'^(CREATE (?:UNIQUE )?INDEX )(\S+)( ON (?:ONLY )?(?:\S+\.)?)(\S+)',
+                    lambda match: f'{match[1]}{name}{self.index_suffix}{match[3]}{self.staging_table}',
+                    definition,
+                )
+                cursor.execute(definition)
+            cursor.execute(f'ANALYZE {self.staging_table}')
+
+    @contextmanager
+    def writes_held(self):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f"SET LOCAL lock_timeout = '{self.lock_timeout}'")
+                # Conflicts with INSERT, UPDATE and DELETE but not SELECT
+                cursor.execute(f'LOCK TABLE {self.table} IN EXCLUSIVE MODE')
+            yield
+
+    def swap(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint '
+                "WHERE confrelid = %s::regclass AND contype = 'f'",
+                [self.table],
+            )
+            foreign_keys = cursor.fetchall()
+            constraints = [name for name, _definition in self.live_constraints(cursor)]
+            indexes = [name for name, _definition in self.live_indexes(cursor)]
+
+            with transaction.atomic():
+                cursor.execute(f"SET LOCAL lock_timeout = '{self.lock_timeout}'")
+                for table, name, _definition in foreign_keys:
+                    cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {name}')
+                cursor.execute(f'DROP TABLE {self.table}')
+                cursor.execute(f'ALTER TABLE {self.staging_table} RENAME TO {self.table}')
+                for name in constraints:
+                    cursor.execute(
+                        f'ALTER TABLE {self.table} RENAME CONSTRAINT {name}{self.index_suffix} TO {name}'
+                    )
+                for name in indexes:
+                    cursor.execute(f'ALTER INDEX {name}{self.index_suffix} RENAME TO {name}')
+                for table, name, definition in foreign_keys:
+                    cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID')
+
+    def validate(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT conrelid::regclass::text, conname FROM pg_constraint '
+                "WHERE confrelid = %s::regclass AND contype = 'f' AND NOT convalidated",
+                [self.table],
+            )
+            for table, name in cursor.fetchall():
+                cursor.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {name}')
+
+
+class SQLiteTableSwap(TableSwap):
+    """
+    SQLite can't rename indexes, so the live table's indexes and triggers
+    are recreated on the staging table inside the swap transaction, and the
+    FTS index is rebuilt there too. The database is switched to WAL mode so
+    readers keep reading the old table until that transaction commits.
+    SQLite takes one writer at a time, so other writers wait (and then fail
+    with "database is locked") until it does.
+    """
+
+    @contextmanager
+    def writes_held(self):
+        # Neither can change inside a transaction: WAL lets readers carry on,
+        # and the schema editor in swap() needs foreign key enforcement off
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            if cursor.fetchone()[0].lower() != 'wal':
+                cursor.execute('PRAGMA journal_mode = WAL')
+        if not connection.disable_constraint_checking():
+            raise transaction.TransactionManagementError("Staging reloads can't run inside a transaction on SQLite")
+        try:
+            with transaction.atomic():
+                yield
+        finally:
+            connection.enable_constraint_checking()
+
+    def create_staging(self):
+        self.drop_staging()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table])
+            definition = cursor.fetchone()[0]
+            cursor.execute(definition.replace(f'"{self.table}"', f'"{self.staging_table}"', 1))
+            # AUTOINCREMENT continues from the table's sqlite_sequence entry
+            cursor.execute(
+                'INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)',
+                [self.staging_table, self.next_id(cursor) - 1],
+            )
+
+    def swap(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = %s "
+                "AND sql IS NOT NULL ORDER BY type",
+                [self.table],
+            )
+            definitions = [row[0] for row in cursor.fetchall()]
+
+        # The schema editor turns off foreign key enforcement for the swap
+        # and checks every foreign key before committing
+        with connection.schema_editor() as schema_editor:
+            schema_editor.execute(f'DROP TABLE {self.table}')
+            schema_editor.execute(f'ALTER TABLE {self.staging_table} RENAME TO {self.table}')
+            for definition in definitions:
+                schema_editor.execute(definition)
+            backend_for_vendor(connection.vendor).rebuild()
+
+
+VENDOR_SWAPS = {
+    'postgresql': PostgresTableSwap,
+    'sqlite': SQLiteTableSwap,
+}
+
+
+def table_swap_for_connection():
+    """Return the TableSwap for the database in use, or None if it has none"""
+    swap_class = VENDOR_SWAPS.get(connection.vendor)
+    return swap_class() if swap_class else None
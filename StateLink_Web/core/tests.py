@@ -1,3 +1,1715 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+from collections import Counter
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import urllib3
+from django.core import mail
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Q, QuerySet
+from django.template.loader import get_template
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from globalpayments.api import gateways
+from globalpayments.api.entities.exceptions import GatewayException
+
+from . import (
+    fuzzy,
+    index_advisor,
+    ingest,
+    payments,
+    pipeline,
+    prefix_index,
+    pricing,
+    query_sampling,
+    reference_ids,
+    search,
+    staging,
+)
+from .flags import recompute_flags
+from .models import (
+    Business,
+    ComplianceRequest,
+    FederalEINRequest,
+    LaborLawPosterRequest,
+    OperatingAgreementRequest,
+    OrderItem,
+    Payment,
+    ReferenceIdSequence,
+    normalise_business_name,
+)
+from .services import SERVICES
+from .signals import businesses_loaded
+
+
+def make_business(name, **fields):
+    """A business with the registry fields filled in, for tests that only care about a few"""
+    fields = {
+        'business_type': 'LLC', 'address': '1 Main St', 'city': 'Raleigh', 'state_code': 'NC',
+        'zip_code': '27601', 'date_formed': datetime.date(2020, 1, 1), 'status': Business.ACTIVE, **fields,
+    }
+    return Business.objects.create(name=name, **fields)
+
+
+REQUESTOR = {
+    'requestor_first_name': 'Ada',
+    'requestor_last_name': 'Lovelace',
+    'requestor_email': 'ada@example.com',
+    'requestor_phone_number': '919-555-0100',
+    'business_reference_id': 'REF123',
+    'business_name': 'Acme LLC',
+}
+
+OPERATING_AGREEMENT = {
+    'member_names': 'Ada Lovelace',
+    'ownership_percentages': '100',
+    'management_structure': 'MEMBER',
+    'capital_contributions': '1000',
+    'profit_distribution': 'Pro rata',
+}
+
+
+class ServiceFormTestCase(TestCase):
+    """An LLC's order for an operating agreement and the labor law poster bundle, at its first service form"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business = Business.objects.create(
+            name='Acme LLC', business_type='LLC', address='1 Main St', city='Raleigh', state_code='NC',
+            zip_code='27601', date_formed=datetime.date(2020, 1, 1), status=Business.ACTIVE,
+        )
+
+    def setUp(self):
+        url = reverse('core:compliance_request', args=[self.business.reference_id])
+        self.client.post(url, {'services': ['OPERATING_AGREEMENT', 'LABOR_LAW_POSTER_CERT']})
+        self.compliance_request = ComplianceRequest.objects.get(business=self.business)
+        self.url = reverse('core:service_form', args=[self.compliance_request.pk])
+
+
+class ServiceFormQueryTests(ServiceFormTestCase):
+    """Each service form step runs in one transaction, updating each row at most once"""
+
+    def post_step(self, data, queries):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(self.url, data)
+        statements = [query['sql'] for query in captured]
+        self.assertEqual(len(statements), queries, '\n'.join(statements))
+        updated = Counter(sql.split('"')[1] for sql in statements if sql.startswith('UPDATE'))
+        self.assertEqual([table for table, count in updated.items() if count > 1], [])
+        return response
+
+    def test_query_counts(self):
+        # Reads of the request, the current item and the session; then one
+        # savepoint with the service row's lookup and insert and a single
+        # update each of the item and the request; then the pending check
+        response = self.post_step(OPERATING_AGREEMENT, 10)
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        self.assertEqual(OperatingAgreementRequest.objects.get().member_names, 'Ada Lovelace')
+
+        # The bundle's first form only writes its own row, then the session
+        # records that its second form is next
+        response = self.post_step(REQUESTOR, 10)
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        self.assertEqual(LaborLawPosterRequest.objects.get().requestor_email, 'ada@example.com')
+
+        # Its second form completes the service, as the first step did, and clears the session's step
+        response = self.post_step(dict(REQUESTOR, purpose_of_request='BUSINESS_LOAN'), 13)
+        self.assertRedirects(
+            response, reverse('core:payment', args=[self.compliance_request.pk]), fetch_redirect_response=False,
+        )
+        self.assertEqual(set(self.compliance_request.items.values_list('status', flat=True)), {OrderItem.SUBMITTED})
+        self.compliance_request.refresh_from_db()
+        self.assertEqual(self.compliance_request.status, 'IN_PROGRESS')
+
+    def test_resubmitting_updates_only_the_forms_fields(self):
+        self.post_step(OPERATING_AGREEMENT, 10)
+        self.compliance_request.items.filter(service='OPERATING_AGREEMENT').update(status=OrderItem.PENDING)
+
+        with CaptureQueriesContext(connection) as captured:
+            self.client.post(self.url, dict(OPERATING_AGREEMENT, member_names='Grace Hopper'))
+        update = next(query['sql'] for query in captured if query['sql'].startswith('UPDATE "core_operatingagreementrequest"'))
+        self.assertNotIn('"compliance_request_id" =', update.split('WHERE')[0])
+        self.assertEqual(OperatingAgreementRequest.objects.get().member_names, 'Grace Hopper')
+
+
+class RequestLookupTests(ServiceFormTestCase):
+    """Each page looks its compliance request or business up once, the request with its business"""
+
+    def selects(self, method, url, data=None):
+        """How many times each table is read from, counting joins, when fetching url"""
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400)
+        selects = [query['sql'] for query in captured if query['sql'].startswith('SELECT')]
+        return Counter(table for sql in selects for table in ('core_compliancerequest', 'core_business') if f'"{table}"' in sql)
+
+    def test_service_form(self):
+        self.assertEqual(self.selects('get', self.url), {'core_compliancerequest': 1, 'core_business': 1})
+        self.assertEqual(
+            self.selects('post', self.url, OPERATING_AGREEMENT), {'core_compliancerequest': 1, 'core_business': 1},
+        )
+
+    def test_payment_page(self):
+        url = reverse('core:payment', args=[self.compliance_request.pk])
+        self.assertEqual(self.selects('get', url), {'core_compliancerequest': 1, 'core_business': 1})
+
+    def test_services_page(self):
+        url = reverse('core:compliance_request', args=[self.business.reference_id])
+        self.assertEqual(self.selects('get', url), {'core_business': 1})
+        reads = self.selects('post', url, {'services': ['OPERATING_AGREEMENT']})
+        self.assertEqual(reads, {'core_business': 1, 'core_compliancerequest': 1})
+
+
+class ServiceDraftTests(ServiceFormTestCase):
+    """Autosaving the service form's changed fields"""
+
+    def setUp(self):
+        super().setUp()
+        self.draft_url = self.client.get(self.url).context['draft_url']
+
+    def test_saves_valid_fields_in_their_columns(self):
+        response = self.client.post(self.draft_url, {'member_names': 'Ada Lovelace', 'ownership_percentages': ''})
+        self.assertEqual(
+            response.json(), {'saved': ['member_names'], 'errors': {'ownership_percentages': ['This field is required.']}},
+        )
+        # No row yet, so the update finds nothing and it's inserted
+        self.assertEqual(OperatingAgreementRequest.objects.get().member_names, 'Ada Lovelace')
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(self.draft_url, {'capital_contributions': '1000'})
+        self.assertEqual(response.json(), {'saved': ['capital_contributions'], 'errors': {}})
+        update = next(query['sql'] for query in captured if query['sql'].startswith('UPDATE "core_operatingagreementrequest"'))
+        self.assertEqual(update.split('WHERE')[0].count('='), 1)
+        self.assertEqual(OperatingAgreementRequest.objects.get().member_names, 'Ada Lovelace')
+        self.assertEqual(self.compliance_request.items.get(service='OPERATING_AGREEMENT').status, OrderItem.PENDING)
+
+    def test_form_starts_from_the_draft(self):
+        self.client.post(self.draft_url, {'member_names': 'Ada Lovelace'})
+        self.assertEqual(self.client.get(self.url).context['form'].initial['member_names'], 'Ada Lovelace')
+
+    def test_submitted_step_is_stale(self):
+        self.client.post(self.url, OPERATING_AGREEMENT)
+        response = self.client.post(self.draft_url, {'member_names': 'Grace Hopper'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(OperatingAgreementRequest.objects.get().member_names, 'Ada Lovelace')
+
+
+class CheckoutTests(ServiceFormTestCase):
+    """The whole order's service forms, submitted at once"""
+
+    def setUp(self):
+        super().setUp()
+        self.checkout_url = reverse('core:checkout', args=[self.compliance_request.pk])
+        agreement, bundle = self.compliance_request.items.all()
+        self.data = {
+            **{f'{agreement.pk}-0-{name}': value for name, value in OPERATING_AGREEMENT.items()},
+            **{f'{bundle.pk}-0-{name}': value for name, value in REQUESTOR.items()},
+            **{f'{bundle.pk}-1-{name}': value for name, value in REQUESTOR.items()},
+            f'{bundle.pk}-1-purpose_of_request': 'BUSINESS_LOAN',
+        }
+
+    def test_compliance_form_goes_to_checkout(self):
+        url = reverse('core:compliance_request', args=[self.business.reference_id])
+        response = self.client.post(url, {'services': ['OPERATING_AGREEMENT']})
+        self.assertRedirects(response, self.checkout_url, fetch_redirect_response=False)
+
+    def test_shows_every_form(self):
+        response = self.client.get(self.checkout_url)
+        self.assertEqual(
+            [step.name for item, step, form in response.context['sections']],
+            ['Operating Agreement', 'Labor Law Poster', 'Certificate of Existence'],
+        )
+
+    def test_saves_the_order_in_one_transaction(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(self.checkout_url, self.data)
+        self.assertRedirects(
+            response, reverse('core:payment', args=[self.compliance_request.pk]), fetch_redirect_response=False,
+        )
+        statements = [query['sql'] for query in captured]
+        self.assertEqual(sum(sql.startswith('SAVEPOINT') for sql in statements), 1, '\n'.join(statements))
+        updated = Counter(sql.split('"')[1] for sql in statements if sql.startswith('UPDATE'))
+        self.assertEqual([table for table, count in updated.items() if count > 1], [])
+
+        self.assertEqual(OperatingAgreementRequest.objects.get().member_names, 'Ada Lovelace')
+        self.assertEqual(LaborLawPosterRequest.objects.get().requestor_email, 'ada@example.com')
+        self.assertEqual(set(self.compliance_request.items.values_list('status', flat=True)), {OrderItem.SUBMITTED})
+        self.compliance_request.refresh_from_db()
+        self.assertEqual(self.compliance_request.status, 'IN_PROGRESS')
+
+    def test_saves_nothing_until_every_form_is_valid(self):
+        del self.data[next(name for name in self.data if name.endswith('-1-purpose_of_request'))]
+        response = self.client.post(self.checkout_url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([bool(form.errors) for item, step, form in response.context['sections']], [False, False, True])
+        self.assertFalse(OperatingAgreementRequest.objects.exists())
+        self.assertEqual(set(self.compliance_request.items.values_list('status', flat=True)), {OrderItem.PENDING})
+
+
+class SearchBackendTests(TestCase):
+    """Business lookups answered from the SQLite FTS5 trigram index"""
+
+    def setUp(self):
+        self.backend = search.get_search_backend()
+        self.quuxly = make_business('Quuxly Widgets LLC')
+        self.zorbex = make_business('Zorbex Corporation')
+
+    def search(self, query):
+        return set(self.backend.search(query).values_list('name', flat=True))
+
+    def test_picks_the_backend_for_the_database(self):
+        self.assertIsInstance(self.backend, search.SQLiteFTSSearchBackend)
+
+    def test_matches_substrings_of_names_and_reference_ids(self):
+        self.assertEqual(self.search('WIDGET'), {'Quuxly Widgets LLC'})
+        self.assertEqual(self.search(self.zorbex.reference_id[2:7]), {'Zorbex Corporation'})
+        # Shorter than a trigram, so answered without the index
+        self.assertEqual(self.search('rb'), {'Zorbex Corporation'})
+        self.assertEqual(self.search('  '), set())
+
+    def test_index_follows_writes(self):
+        self.quuxly.name = 'Vantrix LLC'
+        self.quuxly.save()
+        self.assertEqual(self.search('widget'), set())
+        self.assertEqual(self.search('vantrix'), {'Vantrix LLC'})
+        self.zorbex.delete()
+        self.assertEqual(self.search('zorbex'), set())
+
+    def test_skips_removed_businesses(self):
+        Business.objects.filter(pk=self.quuxly.pk).update(removed_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(self.search('quuxly'), set())
+
+
+class PrefixIndexTests(TestCase):
+    """Autocomplete's in-process prefix index"""
+
+    def setUp(self):
+        # Tests build the index themselves, in the foreground
+        state = {
+            name: getattr(prefix_index, name)
+            for name in ('_index', '_synced_at', '_built_at', '_checked_at', '_too_large', '_busy')
+        }
+        self.addCleanup(lambda: [setattr(prefix_index, name, value) for name, value in state.items()])
+        prefix_index._index, prefix_index._too_large, prefix_index._busy = None, False, False
+
+    def test_matches_name_and_reference_id_prefixes(self):
+        index = prefix_index.PrefixIndex([('7KQ2M9XP4', 'Quuxly Widgets', 'NC'), ('0000AAAA0', 'Quuxly Labs', 'VA')])
+        self.assertEqual([row[0] for row in index.lookup('QUUXLY')], ['0000AAAA0', '7KQ2M9XP4'])
+        self.assertEqual(index.lookup('7kq'), [('7KQ2M9XP4', 'Quuxly Widgets', 'NC')])
+
+        index.upsert('7KQ2M9XP4', 'Zorbex Widgets', 'NC')
+        index.remove('0000AAAA0')
+        self.assertEqual(index.lookup('quuxly'), [])
+        self.assertEqual(index.lookup('zorbex'), [('7KQ2M9XP4', 'Zorbex Widgets', 'NC')])
+        index.compact()
+        self.assertEqual(list(index.records()), [('7KQ2M9XP4', 'Zorbex Widgets', 'NC')])
+
+    def test_stops_loading_past_the_byte_limit(self):
+        read = []
+
+        def rows():
+            for number in range(1000):
+                read.append(number)
+                yield (f'{number:09d}', f'Business {number}', 'NC')
+
+        with self.assertRaises(prefix_index.IndexTooLarge) as raised:
+            prefix_index.PrefixIndex(rows(), max_bytes=2000)
+        self.assertLess(len(read), 100)
+        self.assertEqual(raised.exception.businesses, len(read))
+
+    def test_lookup_answers_from_the_database_until_built(self):
+        with mock.patch.object(prefix_index, 'schedule_rebuild') as schedule_rebuild:
+            self.assertIsNone(prefix_index.lookup('acme'))
+        schedule_rebuild.assert_called_once_with()
+
+        with self.settings(AUTOCOMPLETE_PREFIX_INDEX_MAX_BYTES=100):
+            self.assertIsNone(prefix_index.build_index())
+        with mock.patch.object(prefix_index, 'schedule_rebuild') as schedule_rebuild:
+            self.assertIsNone(prefix_index.lookup('acme'))
+        # Too large: not tried again on every keypress
+        schedule_rebuild.assert_not_called()
+
+        prefix_index.build_index()
+        self.assertEqual([row[1] for row in prefix_index.lookup('acme')], ['Acme Technologies LLC'])
+
+    def test_catches_up_with_other_processes_writes(self):
+        prefix_index.build_index()
+        business = make_business('Quuxly Widgets')
+        # As if written by another worker: no signal reaches this index
+        Business.objects.filter(pk=business.pk).update(name='Zorbex Widgets', updated_at=datetime.datetime.now(datetime.timezone.utc))
+        self.assertEqual(prefix_index.lookup('zorbex'), [])
+        prefix_index.catch_up()
+        self.assertEqual([row[1] for row in prefix_index.lookup('zorbex')], ['Zorbex Widgets'])
+        self.assertEqual(prefix_index.lookup('quuxly'), [])
+
+    def test_applies_writes_once_committed(self):
+        kept = make_business('Vantrix Widgets')
+        prefix_index.build_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                make_business('Zorbex Widgets')
+                Business.objects.get(pk=kept.pk).delete()
+                raise RuntimeError
+            make_business('Quuxly Widgets')
+        self.assertEqual(prefix_index.lookup('zorbex'), [])
+        self.assertEqual([row[1] for row in prefix_index.lookup('vantrix')], ['Vantrix Widgets'])
+        self.assertEqual([row[1] for row in prefix_index.lookup('quuxly')], ['Quuxly Widgets'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            kept.delete()
+        self.assertEqual(prefix_index.lookup('vantrix'), [])
+
+    def test_rebuilds_to_drop_rows_deleted_elsewhere(self):
+        business = make_business('Zorbex Widgets')
+        prefix_index.build_index()
+        # As if deleted by another worker: no signal reaches this index
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM core_business WHERE id = %s', [business.pk])
+        with self.settings(AUTOCOMPLETE_PREFIX_INDEX_REBUILD_INTERVAL=60):
+            prefix_index.catch_up()
+            self.assertEqual(len(prefix_index.lookup('zorbex')), 1)
+            prefix_index._built_at -= 61
+            prefix_index.catch_up()
+        self.assertEqual(prefix_index.lookup('zorbex'), [])
+
+
+class SearchKeyTests(TestCase):
+    """The normalised name businesses are ranked by"""
+
+    def test_spellings_of_one_name_share_a_key(self):
+        key = normalise_business_name('Acme Technologies LLC')
+        self.assertEqual(key, 'acme technologies')
+        for spelling in ('Acme Technologies, L.L.C.', 'ACME  technologies llc', 'Acme Technologies'):
+            self.assertEqual(normalise_business_name(spelling), key, spelling)
+
+    def test_punctuation_and_suffixes(self):
+        self.assertEqual(normalise_business_name("O'Brien & Sons, Inc."), 'obrien and sons')
+        self.assertEqual(normalise_business_name('Smith-Jones Co. Ltd'), 'smith jones')
+        # A name that is only a suffix keeps it
+        self.assertEqual(normalise_business_name('LLC'), 'llc')
+        self.assertEqual(normalise_business_name(None), '')
+
+    def test_kept_up_to_date_on_save(self):
+        business = make_business('Zorbex, L.L.C.')
+        self.assertEqual(business.search_key, 'zorbex')
+        business.name = 'Zorbex Holdings Corp.'
+        business.save(update_fields=['name'])
+        business.refresh_from_db()
+        self.assertEqual(business.search_key, 'zorbex holdings')
+
+    def test_query_spelling_finds_the_exact_match_first(self):
+        make_business('Vantrix Holdings Group')
+        make_business('Vantrix Holdings LLC')
+        page = search.SearchPage('vantrix holdings, l.l.c.')
+        self.assertEqual([business.name for business in page.businesses][:1], ['Vantrix Holdings LLC'])
+
+
+class SearchPageTests(TestCase):
+    """Keyset pages of search results, ranked exact, prefix, then substring"""
+
+    @classmethod
+    def setUpTestData(cls):
+        make_business('The Quuxly Shop')
+        for number in range(12):
+            make_business(f'Quuxly Widgets {number:02d}')
+        make_business('Quuxly, LLC')
+
+    def test_pages_through_the_tiers_in_order(self):
+        names, cursor = [], None
+        while True:
+            page = search.SearchPage('quuxly', cursor=cursor, page_size=5)
+            names += [business.name for business in page.businesses]
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(
+            names, ['Quuxly, LLC', *(f'Quuxly Widgets {number:02d}' for number in range(12)), 'The Quuxly Shop'],
+        )
+
+    def test_reads_only_the_rendered_columns(self):
+        business = search.SearchPage('quuxly').businesses[0]
+        self.assertIn('address', business.get_deferred_fields())
+        self.assertNotIn('name', business.get_deferred_fields())
+
+    def test_ignores_malformed_cursors(self):
+        page = search.SearchPage('quuxly', cursor='not-a-cursor', page_size=5)
+        self.assertTrue(page.is_first_page)
+        self.assertEqual(page.businesses[0].name, 'Quuxly, LLC')
+
+    def test_counts(self):
+        self.assertEqual(search.SearchPage('quuxly').count, (14, False, False))
+        page = search.SearchPage('quuxly', page_size=5)
+        with mock.patch.object(page.backend, 'count_cap', 10):
+            self.assertEqual(page.count, (10, True, True))
+
+    def test_capped_count_is_shown_as_a_floor(self):
+        for number in range(12, 24):
+            make_business(f'Quuxly Widgets {number:02d}')
+        with mock.patch.object(search.get_search_backend(), 'count_cap', 10):
+            response = self.client.get(reverse('core:search_results'), {'q': 'quuxly'})
+        self.assertContains(response, 'More than 10 results')
+        self.assertNotContains(response, 'About')
+
+
+class ReferenceIdTests(TestCase):
+    """Check-charactered reference IDs and the blocks they're allocated from"""
+
+    def test_round_trips(self):
+        for number in (0, 1, 2, 12345, reference_ids.CAPACITY - 1):
+            reference_id = reference_ids.encode(number)
+            self.assertRegex(reference_id, reference_ids.REFERENCE_ID_RE)
+            self.assertEqual(reference_ids.normalise(reference_id), reference_id)
+        self.assertEqual(len({reference_ids.encode(number) for number in range(1000)}), 1000)
+        with self.assertRaises(ValueError):
+            reference_ids.encode(reference_ids.CAPACITY)
+
+    def test_rejects_any_single_wrong_character(self):
+        reference_id = reference_ids.encode(4242)
+        for position in range(reference_ids.LENGTH):
+            for char in reference_ids.ALPHABET:
+                if char != reference_id[position]:
+                    typo = reference_id[:position] + char + reference_id[position + 1:]
+                    self.assertIsNone(reference_ids.normalise(typo), typo)
+
+    def test_normalises_what_people_type(self):
+        reference_id = next(
+            encoded for encoded in map(reference_ids.encode, range(1000)) if '0' in encoded and '1' in encoded
+        )
+        typed = reference_id.lower().replace('0', 'o').replace('1', 'l', 1).replace('1', 'I')
+        self.assertEqual(reference_ids.normalise(f' {typed[:4]}-{typed[4:]} '), reference_id)
+        # Letters from before the allocator
+        self.assertEqual(reference_ids.normalise('C81C2A67'), 'c81c2a67')
+        self.assertIsNone(reference_ids.normalise('not an id'))
+
+    def test_allocator_hands_out_each_number_once(self):
+        allocator = reference_ids.ReferenceIdAllocator(ReferenceIdSequence.reserve, block_size=3)
+        allocated = [allocator() for _ in range(10)]
+        self.assertEqual(allocated, [reference_ids.encode(number) for number in range(10)])
+        self.assertEqual(ReferenceIdSequence.objects.get(name='business').next_value, 12)
+
+    def test_numbers_reserved_in_a_rolled_back_transaction_are_withdrawn(self):
+        allocator = reference_ids.ReferenceIdAllocator(ReferenceIdSequence.reserve, block_size=5)
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                rolled_back = allocator()
+                1 / 0
+        # The counter is back where it was, so its numbers are the next ones again
+        self.assertEqual(allocator(), rolled_back)
+        self.assertEqual(allocator(), reference_ids.encode(1))
+
+    def test_a_savepoint_rolling_back_withdraws_its_numbers(self):
+        with self.assertRaises(ZeroDivisionError), transaction.atomic():
+            withdrawn = ReferenceIdSequence.reserve(5)
+            self.assertEqual(next(withdrawn), 0)
+            1 / 0
+        # The same numbers, reserved again in the same transaction
+        self.assertEqual(list(ReferenceIdSequence.reserve(5)), list(range(5)))
+        self.assertEqual(list(withdrawn), [])
+
+
+class ConcurrentReserveTests(TransactionTestCase):
+    """Reference ID blocks reserved from several threads at once"""
+
+    def test_interleaved_blocks_never_overlap(self):
+        first = ReferenceIdSequence.reserve(5)
+        second = ReferenceIdSequence.reserve(5)
+        self.assertEqual(list(second) + list(first), list(range(5, 10)) + list(range(5)))
+
+    def test_committed_reservations_keep_their_numbers(self):
+        with transaction.atomic():
+            reserved = ReferenceIdSequence.reserve(5)
+            self.assertEqual(next(reserved), 0)
+        self.assertEqual(list(reserved), [1, 2, 3, 4])
+        # The marker tracking the reservation goes once it commits
+        self.assertEqual(list(ReferenceIdSequence.objects.values_list('name', flat=True)), ['business'])
+
+    # SQLite's in-memory test database takes one writer at a time
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    def test_blocks_never_overlap(self):
+        reserved = []
+
+        def reserve():
+            try:
+                for _ in range(10):
+                    reserved.extend(ReferenceIdSequence.reserve(7))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(reserved), list(range(4 * 10 * 7)))
+
+    def test_allocator_is_thread_safe(self):
+        allocator = reference_ids.ReferenceIdAllocator(lambda count: iter(range(count)), block_size=1000)
+        allocated = []
+        threads = [threading.Thread(target=lambda: allocated.extend(allocator() for _ in range(200))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(allocated)), 800)
+
+
+class ReferenceIdLookupTests(TestCase):
+    """Reference numbers from mailed letters go straight to their business"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business = make_business('Vantrix Holdings LLC')
+        cls.landing = reverse('core:compliance_request', args=[cls.business.reference_id])
+
+    def typed(self):
+        # As someone might copy it off a letter
+        reference_id = self.business.reference_id.lower()
+        return f'{reference_id[:4]}-{reference_id[4:]}'
+
+    def test_resolves_with_one_unique_lookup(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(search.resolve_reference_id(self.typed()), self.business)
+        with self.assertNumQueries(0):
+            self.assertIsNone(search.resolve_reference_id('vantrix holdings'))
+
+    def test_searches_redirect_to_the_business(self):
+        response = self.client.get(reverse('core:search_results'), {'q': self.typed()})
+        self.assertRedirects(response, self.landing)
+        response = self.client.post(reverse('core:home'), {'search_query': self.typed()})
+        self.assertRedirects(response, self.landing)
+
+    def test_unknown_reference_ids_are_searched_for(self):
+        unknown = next(
+            reference_id for reference_id in map(reference_ids.encode, range(1000, 2000))
+            if reference_id != self.business.reference_id
+        )
+        response = self.client.get(reverse('core:search_results'), {'q': unknown})
+        self.assertContains(response, f'No businesses found matching "{unknown}"')
+
+    def test_letter_landing_route(self):
+        response = self.client.get(reverse('core:reference_landing', args=[self.typed()]))
+        self.assertContains(response, 'Vantrix Holdings LLC')
+        response = self.client.get(reverse('core:reference_landing', args=['not-an-id']))
+        self.assertEqual(response.status_code, 404)
+
+
+class SearchCachingTests(TestCase):
+    """Results pages addressed by query string and revalidated by ETag"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business = make_business('Zorbex Tooling LLC')
+
+    def get(self, **headers):
+        return self.client.get(reverse('core:search_results'), {'q': 'zorbex'}, headers=headers)
+
+    def test_pages_are_private(self):
+        response = self.get()
+        self.assertContains(response, 'Zorbex Tooling LLC')
+        cache_control = {directive.strip() for directive in response['Cache-Control'].split(',')}
+        self.assertEqual(cache_control, {'private', 'max-age=60'})
+
+    def test_unchanged_page_is_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_edits_change_the_etag(self):
+        etag = self.get()['ETag']
+        self.business.name = 'Zorbex Tools LLC'
+        self.business.save()
+        response = self.get(if_none_match=etag)
+        self.assertContains(response, 'Zorbex Tools LLC')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_session_query_moves_into_the_url(self):
+        session = self.client.session
+        session['search_query'] = 'zorbex'
+        session.save()
+        response = self.client.get(reverse('core:search_results'))
+        self.assertRedirects(response, f"{reverse('core:search_results')}?q=zorbex")
+        response = self.client.post(reverse('core:home'), {'search_query': 'zorbex tooling'})
+        self.assertRedirects(response, f"{reverse('core:search_results')}?q=zorbex+tooling")
+
+
+class FuzzySuggestionTests(TestCase):
+    """"Did you mean" suggestions for searches that found nothing"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # Newest first, so the closest name isn't simply the first row the index reads
+        for number in range(300, 0, -1):
+            make_business(f'Quuxly {number}')
+        make_business('Zorbex Trading LLC', removed_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def test_prefix_edit_distance(self):
+        self.assertEqual(fuzzy.prefix_edit_distance('quuxyl', 'quuxly 10', 2), 1)
+        self.assertEqual(fuzzy.prefix_edit_distance('quxly', 'quuxly', 2), 1)
+        self.assertEqual(fuzzy.prefix_edit_distance('qaaxly', 'quuxly', 1), 2)
+        self.assertEqual(fuzzy.prefix_edit_distance('quuxly', 'quuxly trading', 1), 0)
+
+    def test_closest_names_come_first(self):
+        suggestions = [name for _reference_id, name, _state_code in fuzzy.suggest('quuxyl 10')]
+        self.assertEqual(suggestions, ['Quuxly 10'])
+
+    def test_skips_removed_businesses(self):
+        self.assertEqual(fuzzy.suggest('zorbex tradnig'), [])
+
+    def test_shown_when_nothing_matches(self):
+        response = self.client.get(reverse('core:search_results'), {'q': 'quuxyl 10'})
+        self.assertContains(response, 'Did you mean')
+        self.assertContains(response, 'Quuxly 10 <small')
+
+
+def registry_row(registry_id, name, **fields):
+    """A raw registry file row, as read from its CSV"""
+    return {
+        'registry_id': registry_id, 'name': name, 'business_type': 'Limited Liability Company',
+        'address': '1 Main St', 'city': 'Raleigh', 'state_code': 'NC', 'zip_code': '27601',
+        'date_formed': '2020-01-01', 'status': 'Current-Active', **fields,
+    }
+
+
+def write_registry_csv(path, rows):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', newline='') as registry_file:
+        writer = csv.DictWriter(registry_file, fieldnames=ingest.IMPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+class RegistryFileTestCase(TestCase):
+    """Base for tests that load registry files from a temporary directory"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def registry_file(self, rows, name='nc.csv'):
+        return write_registry_csv(os.path.join(self.directory, name), rows)
+
+    def import_file(self, path, *args):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_businesses', path, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def records(self, rows):
+        return enumerate(rows, start=2)
+
+
+class ImportBusinessesTests(RegistryFileTestCase):
+    """manage.py import_businesses and the row cleaning behind it"""
+
+    def test_cleans_registry_spellings(self):
+        row = ingest.clean_row(registry_row(
+            'NC1', ' Quuxly Widgets, L.L.C. ', business_type='corporation', state_code='nc',
+            date_formed='03/04/2019', last_filing_date='20240105', status='Admin. Dissolved',
+        ))
+        self.assertEqual(row['name'], 'Quuxly Widgets, L.L.C.')
+        self.assertEqual(row['business_type'], 'CORP')
+        self.assertEqual(row['state_code'], 'NC')
+        self.assertEqual(row['date_formed'], datetime.date(2019, 3, 4))
+        self.assertEqual(row['last_filing_date'], datetime.date(2024, 1, 5))
+        self.assertEqual(row['status'], Business.DISSOLVED)
+        self.assertEqual(row['search_key'], 'quuxly widgets')
+        self.assertIsNone(row['address2'])
+        self.assertEqual(ingest.clean_row(registry_row('NC1', 'Quuxly', status='Pending'))['status'], Business.OTHER)
+
+    def test_rejects_unusable_rows(self):
+        bad_rows = {
+            'missing name': registry_row('NC1', ''),
+            'unknown business type': registry_row('NC1', 'Quuxly', business_type='Partnership'),
+            'invalid state code': registry_row('NC1', 'Quuxly', state_code='North Carolina'),
+            'unrecognised date': registry_row('NC1', 'Quuxly', date_formed='yesterday'),
+            'longer than 10 characters': registry_row('NC1', 'Quuxly', zip_code='27601-00000'),
+        }
+        for message, raw in bad_rows.items():
+            with self.assertRaisesMessage(ingest.RowError, message):
+                ingest.clean_row(raw)
+        # Rows without a state take the file's
+        self.assertEqual(ingest.clean_row(registry_row('NC1', 'Quuxly', state_code=''), 'SC')['state_code'], 'SC')
+
+    def test_loads_a_csv_file(self):
+        path = self.registry_file([registry_row(f'NC{number}', f'Quuxly {number}') for number in range(7)], 'nc.csv.gz')
+        stdout, _stderr = self.import_file(path, '--batch-size', '3')
+        self.assertIn('Read 7 rows', stdout)
+        self.assertIn('7 inserted, 0 updated, 0 unchanged, 0 removed, 0 invalid', stdout)
+        self.assertIn('rows/sec', stdout)
+        business = Business.objects.get(registry_id='NC3')
+        self.assertEqual((business.name, business.search_key, business.status), ('Quuxly 3', 'quuxly 3', Business.ACTIVE))
+        self.assertEqual(reference_ids.normalise(business.reference_id), business.reference_id)
+        self.assertEqual(business.content_hash, ingest.content_hash(ingest.clean_row(registry_row('NC3', 'Quuxly 3'))))
+        # Loaded rows are found by search
+        self.assertEqual(search.SearchPage('quuxly 3').businesses[0].registry_id, 'NC3')
+
+    def test_loads_a_fixed_width_file(self):
+        layout = {
+            'registry_id': [0, 6], 'name': [6, 26], 'business_type': [26, 30], 'address': [30, 45],
+            'city': [45, 55], 'zip_code': [55, 60], 'date_formed': [60, 70], 'status': [70, 80],
+        }
+        layout_path = os.path.join(self.directory, 'layout.json')
+        with open(layout_path, 'w') as layout_file:
+            json.dump(layout, layout_file)
+        path = os.path.join(self.directory, 'nc.txt')
+        with open(path, 'w') as registry_file:
+            registry_file.write(
+                f"{'NC0001':6}{'Zorbex Tooling':20}{'LLC':4}{'1 Main St':15}{'Raleigh':10}{'27601':5}"
+                f"{'2020-01-01':10}{'ACTIVE':10}\n\n"
+            )
+        stdout, _stderr = self.import_file(path, '--format', 'fixed', '--layout', layout_path, '--state', 'NC')
+        self.assertIn('1 inserted', stdout)
+        self.assertTrue(Business.objects.filter(registry_id='NC0001', name='Zorbex Tooling', state_code='NC').exists())
+        with self.assertRaisesMessage(CommandError, '--layout'):
+            self.import_file(path, '--format', 'fixed')
+
+    def test_later_rows_win_within_a_batch(self):
+        stats = ingest.import_rows(self.records([registry_row('NC1', 'Quuxly Old'), registry_row('NC1', 'Quuxly New')]))
+        self.assertEqual((stats.rows, stats.inserted), (2, 1))
+        self.assertEqual(Business.objects.get(registry_id='NC1').name, 'Quuxly New')
+
+    def test_reports_and_limits_invalid_rows(self):
+        rows = [registry_row('NC1', 'Quuxly'), registry_row('NC2', ''), registry_row('NC3', 'Zorbex', business_type='LP')]
+        stdout, stderr = self.import_file(self.registry_file(rows))
+        self.assertIn('1 inserted', stdout)
+        self.assertIn('2 invalid', stdout)
+        self.assertIn('Line 3: missing name', stderr)
+        with self.assertRaisesMessage(CommandError, 'Stopped after 2 invalid rows'):
+            self.import_file(self.registry_file(rows), '--max-errors', '1')
+        path = os.path.join(self.directory, 'short.csv')
+        with open(path, 'w') as registry_file:
+            registry_file.write('name,city\n')
+        with self.assertRaisesMessage(CommandError, 'CSV header is missing'):
+            self.import_file(path)
+
+
+class DeltaImportTests(RegistryFileTestCase):
+    """Re-imports only write the rows whose registry content changed"""
+
+    def setUp(self):
+        super().setUp()
+        # Virginia, which the seeded businesses aren't in
+        self.rows = [registry_row(f'VA{number}', f'Quuxly {number}', state_code='VA') for number in range(20)]
+        ingest.import_rows(self.records(self.rows))
+        self.loaded = []
+        handler = lambda sender, reference_ids, **kwargs: self.loaded.append(reference_ids)
+        businesses_loaded.connect(handler)
+        self.addCleanup(businesses_loaded.disconnect, handler)
+
+    def test_unchanged_rows_are_left_alone(self):
+        updated_at = Business.objects.get(registry_id='VA1').updated_at
+        with CaptureQueriesContext(connection) as queries:
+            stats = ingest.import_rows(self.records(self.rows))
+        self.assertEqual((stats.inserted, stats.updated, stats.unchanged), (0, 0, 20))
+        self.assertFalse([query for query in queries if query['sql'].startswith('INSERT INTO core_business')])
+        self.assertEqual(Business.objects.get(registry_id='VA1').updated_at, updated_at)
+        self.assertEqual(self.loaded, [])
+
+    def test_writes_changes_and_keeps_reference_ids(self):
+        business = Business.objects.get(registry_id='VA1')
+        self.rows[1]['address'] = '2 Main St'
+        self.rows.append(registry_row('VA20', 'Zorbex', state_code='VA'))
+        stats = ingest.import_rows(self.records(self.rows))
+        self.assertEqual((stats.inserted, stats.updated, stats.unchanged), (1, 1, 19))
+        changed = Business.objects.get(registry_id='VA1')
+        self.assertEqual((changed.pk, changed.reference_id, changed.address), (business.pk, business.reference_id, '2 Main St'))
+        self.assertGreater(changed.updated_at, business.updated_at)
+        new = Business.objects.get(registry_id='VA20')
+        self.assertEqual(sorted(self.loaded[0]), sorted([business.reference_id, new.reference_id]))
+
+    def test_full_files_soft_delete_what_they_leave_out(self):
+        other_state = make_business('Vantrix', registry_id='NC1')
+        dropped = Business.objects.get(registry_id='VA19')
+        stats = ingest.import_rows(self.records(self.rows[:19]), full=True)
+        self.assertEqual((stats.removed, stats.unchanged), (1, 19))
+        dropped.refresh_from_db()
+        self.assertIsNotNone(dropped.removed_at)
+        self.assertEqual(search.SearchPage('quuxly 19').businesses, [])
+        self.assertEqual(self.loaded, [[dropped.reference_id]])
+        other_state.refresh_from_db()
+        self.assertIsNone(other_state.removed_at)
+        # Listed again, it comes back with the same reference ID
+        stats = ingest.import_rows(self.records(self.rows), full=True)
+        self.assertEqual((stats.updated, stats.removed), (1, 0))
+        restored = Business.objects.get(registry_id='VA19')
+        self.assertEqual((restored.reference_id, restored.removed_at), (dropped.reference_id, None))
+
+    def test_refuses_to_remove_too_much(self):
+        with self.assertRaisesMessage(ingest.IngestError, 'would remove 10 of 20'):
+            ingest.import_rows(self.records(self.rows[:10]), full=True, max_removed_fraction=0.25)
+        self.assertFalse(Business.objects.filter(removed_at__isnull=False).exists())
+        stdout, _stderr = self.import_file(self.registry_file(self.rows[:10]), '--full', '--max-removed-fraction', '0.5')
+        self.assertIn('10 removed', stdout)
+
+
+class ReloadTests(TransactionTestCase):
+    """Full reloads through a staging table swapped in for core_business"""
+
+    # Reloads swap tables, which can't happen inside a test's transaction.
+    # Businesses come from imports, since the flush between tests restarts
+    # the reference ID sequence under the process's allocator.
+    def setUp(self):
+        self.rows = [registry_row(f'VA{number}', f'Quuxly {number}', state_code='VA') for number in range(10)]
+        ingest.import_rows(enumerate(self.rows + [registry_row('NC1', 'Zorbex')]))
+
+    def reload(self, rows, **options):
+        return ingest.reload_rows(enumerate(rows), **options)
+
+    def test_replaces_the_reloaded_states(self):
+        kept = Business.objects.get(registry_id='VA1')
+        self.rows[1]['address'] = '2 Main St'
+        stats = self.reload([*self.rows[:9], registry_row('VA10', 'Vantrix', state_code='VA')], max_removed_fraction=0.5)
+        self.assertEqual(
+            (stats.loaded, stats.inserted, stats.updated, stats.unchanged, stats.removed), (10, 1, 1, 8, 1),
+        )
+        self.assertFalse(Business.objects.filter(registry_id='VA9').exists())
+        changed = Business.objects.get(registry_id='VA1')
+        self.assertEqual((changed.pk, changed.reference_id, changed.address), (kept.pk, kept.reference_id, '2 Main St'))
+        self.assertEqual(changed.created_at, kept.created_at)
+        # Other states are carried over, and the search index follows the new table
+        self.assertTrue(Business.objects.filter(registry_id='NC1', removed_at__isnull=True).exists())
+        self.assertEqual([business.name for business in search.SearchPage('vantrix').businesses], ['Vantrix'])
+        self.assertNotIn(staging.TableSwap.staging_table, connection.introspection.table_names())
+
+    def test_keeps_referenced_businesses_soft_deleted(self):
+        dropped = Business.objects.get(registry_id='VA9')
+        compliance_request = ComplianceRequest.objects.create(business=dropped, status='PENDING')
+        stats = self.reload(self.rows[:9], max_removed_fraction=0.5)
+        self.assertEqual(stats.removed, 1)
+        compliance_request.refresh_from_db()
+        self.assertEqual(compliance_request.business.reference_id, dropped.reference_id)
+        self.assertIsNotNone(compliance_request.business.removed_at)
+
+    def test_refuses_without_touching_the_live_table(self):
+        before = set(Business.objects.values_list('reference_id', 'content_hash'))
+        with self.assertRaisesMessage(ingest.IngestError, 'would remove 5 of 10'):
+            self.reload(self.rows[:5])
+        self.assertEqual(set(Business.objects.values_list('reference_id', 'content_hash')), before)
+        self.assertNotIn(staging.TableSwap.staging_table, connection.introspection.table_names())
+
+    def test_catches_up_with_writes_during_the_load(self):
+        ingest.import_rows(enumerate([registry_row(f'SC{number}', f'Zorbex {number}', state_code='SC') for number in range(2)]))
+        swap_class = type(staging.table_swap_for_connection())
+        create_indexes = swap_class.create_indexes
+
+        # Written while staging is indexed, before writes are held
+        def create_indexes_while_writing(swap):
+            Business.objects.filter(registry_id='NC1').update(address='9 Main St', updated_at=timezone.now())
+            Business.objects.filter(registry_id='SC0').delete()
+            # The flag recompute leaves updated_at alone
+            Business.objects.filter(registry_id='SC1').update(is_new=True)
+            ingest.import_rows(enumerate([registry_row('NC2', 'Vantrix')]))
+            create_indexes(swap)
+
+        with mock.patch.object(swap_class, 'create_indexes', create_indexes_while_writing):
+            self.reload(self.rows)
+        self.assertEqual(Business.objects.get(registry_id='NC1').address, '9 Main St')
+        self.assertFalse(Business.objects.filter(registry_id='SC0').exists())
+        self.assertTrue(Business.objects.get(registry_id='SC1').is_new)
+        self.assertTrue(Business.objects.filter(registry_id='NC2').exists())
+
+    @skipUnless(connection.vendor == 'postgresql', "Writes wait on PostgreSQL's table lock")
+    def test_writes_wait_for_the_swap(self):
+        other_state = Business.objects.get(registry_id='NC1')
+        errors = []
+
+        def write():
+            try:
+                Business.objects.filter(pk=other_state.pk).update(address='9 Main St')
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        writer = threading.Thread(target=write)
+        swap_tables = staging.PostgresTableSwap.swap
+
+        def swap_while_writing(swap):
+            writer.start()
+            writer.join(timeout=1)
+            self.assertTrue(writer.is_alive())
+            swap_tables(swap)
+
+        with mock.patch.object(staging.PostgresTableSwap, 'swap', swap_while_writing):
+            self.reload(self.rows)
+        writer.join()
+        self.assertEqual(errors, [])
+        # Made to the new table once the swap committed, so it isn't lost
+        self.assertEqual(Business.objects.get(pk=other_state.pk).address, '9 Main St')
+
+
+class PipelineTests(RegistryFileTestCase):
+    """Several state files parsed in worker processes and written by one writer"""
+
+    def state_file(self, state, count, name=None):
+        rows = [registry_row(f'{state}{number}', f'Quuxly {state} {number}', state_code=state) for number in range(count)]
+        return self.registry_file(rows, name or f'{state.lower()}.csv')
+
+    def test_worker_messages(self):
+        batches = queue.Queue()
+        self.addCleanup(setattr, pipeline, '_batches', pipeline._batches)
+        pipeline._init_worker(batches)
+        path = self.registry_file([
+            *(registry_row(f'VA{number}', f'Quuxly {number}', state_code='VA') for number in range(5)),
+            registry_row('SC1', 'Zorbex', state_code='SC'),
+            registry_row('VA9', ''),
+        ])
+        pipeline.parse_source(pipeline.StateSource('VA', path), batch_size=4, max_errors=10)
+        messages = []
+        while not batches.empty():
+            messages.append(batches.get())
+        self.assertEqual([kind for kind, _state, _payload in messages], ['batch', 'row_error', 'row_error', 'batch', 'finished'])
+        self.assertEqual(sorted(len(payload) for kind, _state, payload in messages if kind == 'batch'), [1, 4])
+        self.assertIn('line 8: missing name', messages[1][2])
+        self.assertIn('SC1 is in SC, not VA', messages[2][2])
+        rows, errors, _seconds, _blocked = messages[-1][2]
+        self.assertEqual((rows, errors), (7, 2))
+
+    def test_imports_states_in_parallel(self):
+        errors = []
+        metrics = pipeline.import_states(
+            [pipeline.StateSource('VA', self.state_file('VA', 12)), pipeline.StateSource('SC', self.state_file('SC', 7))],
+            workers=2, batch_size=5, on_error=lambda state, message: errors.append(state),
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            {state: (state_metrics.writes.rows, state_metrics.writes.inserted, state_metrics.loaded_rows, state_metrics.error)
+             for state, state_metrics in metrics.items()},
+            {'VA': (12, 12, 12, None), 'SC': (7, 7, 7, None)},
+        )
+        self.assertEqual(Business.objects.filter(state_code='VA').count(), 12)
+        self.assertEqual(Business.objects.filter(state_code='SC').count(), 7)
+        self.assertEqual(len(set(Business.objects.values_list('reference_id', flat=True))), Business.objects.count())
+
+    def test_a_failed_state_does_not_stop_the_others(self):
+        pipeline.import_states([pipeline.StateSource('VA', self.state_file('VA', 10))])
+        metrics = pipeline.import_states(
+            [
+                pipeline.StateSource('VA', self.state_file('VA', 5, 'va-short.csv')),
+                pipeline.StateSource('SC', self.state_file('SC', 3)),
+                pipeline.StateSource('GA', os.path.join(self.directory, 'missing.csv')),
+            ],
+            full=True,
+        )
+        self.assertIn('would remove 5 of 10', metrics['VA'].error)
+        self.assertIn('No such file', metrics['GA'].error)
+        self.assertIsNone(metrics['SC'].error)
+        self.assertEqual(metrics['SC'].writes.inserted, 3)
+        self.assertFalse(Business.objects.filter(removed_at__isnull=False).exists())
+
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command('import_states', f"va={self.state_file('VA', 4)}", f"SC={self.state_file('SC', 2)}", stdout=stdout)
+        self.assertIn('VA: 4 rows', stdout.getvalue())
+        self.assertIn('SC: 2 rows', stdout.getvalue())
+        with self.assertRaisesMessage(CommandError, 'Some states failed to load'):
+            call_command('import_states', f"GA={os.path.join(self.directory, 'missing.csv')}", stdout=io.StringIO())
+        with self.assertRaisesMessage(CommandError, 'STATE=PATH'):
+            call_command('import_states', 'va.csv', stdout=io.StringIO())
+
+
+class BusinessFlagTests(TestCase):
+    """Date-derived flags recomputed in chunked UPDATEs"""
+
+    today = datetime.date(2025, 6, 30)
+
+    def setUp(self):
+        Business.objects.all().delete()
+        self.new = make_business('Quuxly New', date_formed=datetime.date(2025, 6, 20))
+        self.filed = make_business('Quuxly Filed', last_filing_date=datetime.date(2025, 1, 1))
+        self.unfiled = make_business('Quuxly Unfiled', last_filing_date=datetime.date(2023, 1, 1))
+        self.stale = make_business('Quuxly Stale', is_new=True, missing_filing=True, last_filing_date=datetime.date(2025, 1, 1))
+
+    def flags(self):
+        return {name: (is_new, missing) for name, is_new, missing in Business.objects.values_list('name', 'is_new', 'missing_filing')}
+
+    def test_sets_and_clears_flags_in_chunks(self):
+        updated_at = Business.objects.get(pk=self.stale.pk).updated_at
+        with CaptureQueriesContext(connection) as queries:
+            flipped = recompute_flags(self.today, chunk_size=2)
+        self.assertEqual(flipped, {'is_new': {'set': 1, 'cleared': 1}, 'missing_filing': {'set': 1, 'cleared': 1}})
+        self.assertEqual(self.flags(), {
+            'Quuxly New': (True, False), 'Quuxly Filed': (False, False),
+            'Quuxly Unfiled': (False, True), 'Quuxly Stale': (False, False),
+        })
+        # Two chunks, four UPDATEs each
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in queries), 8)
+        self.assertEqual(Business.objects.get(pk=self.stale.pk).updated_at, updated_at)
+        # Nothing left to flip
+        self.assertEqual(recompute_flags(self.today), {flag: {'set': 0, 'cleared': 0} for flag in flipped})
+
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command('recompute_business_flags', '--date', '2025-06-30', stdout=stdout)
+        self.assertIn('is_new: 1 set, 1 cleared', stdout.getvalue())
+        with self.assertRaisesMessage(CommandError, '--date must be YYYY-MM-DD'):
+            call_command('recompute_business_flags', '--date', '30/06/2025')
+
+
+class IntegerPrimaryKeyMigrationTests(TransactionTestCase):
+    """0019 and 0020 moving core_business from reference_id to an integer primary key"""
+
+    before = [('core', '0018_reference_id_allocator')]
+    after = [('core', '0020_business_integer_pk')]
+
+    def tearDown(self):
+        MigrationExecutor(connection).migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_copies_businesses_and_repoints_requests(self):
+        apps = self.migrate(self.before)
+        Business = apps.get_model('core', 'Business')
+        ComplianceRequest = apps.get_model('core', 'ComplianceRequest')
+        fields = {
+            'business_type': 'LLC', 'address': '1 Main St', 'city': 'Raleigh', 'state_code': 'NC',
+            'zip_code': '27601', 'date_formed': datetime.date(2020, 1, 1),
+        }
+        allocated = reference_ids.encode(7)
+        Business.objects.create(reference_id=allocated, name='Quuxly', status='Current-Active', **fields)
+        Business.objects.create(reference_id='c81c2a67', name='Zorbex', status='Admin. Dissolved', **fields)
+        # Too wide for the new column, so it gets an allocated ID
+        Business.objects.create(reference_id='NC-0001234', name='Vantrix', status='Pending', **fields)
+        ComplianceRequest.objects.create(business_id='NC-0001234', status='PENDING', request_type='ANNUAL_REPORT')
+
+        apps = self.migrate(self.after)
+        Business = apps.get_model('core', 'Business')
+        businesses = {business.name: business for business in Business.objects.all()}
+        self.assertEqual(
+            {name: (business.reference_id, business.status) for name, business in businesses.items() if name != 'Vantrix'},
+            {'Quuxly': (allocated, 1), 'Zorbex': ('c81c2a67', 3)},
+        )
+        vantrix = businesses['Vantrix']
+        self.assertEqual(vantrix.status, 99)
+        self.assertEqual(reference_ids.normalise(vantrix.reference_id), vantrix.reference_id)
+        self.assertIsInstance(vantrix.pk, int)
+        compliance_request = apps.get_model('core', 'ComplianceRequest').objects.get()
+        self.assertEqual(compliance_request.business_id, vantrix.pk)
+        # The search index was reinstalled on the new table
+        self.assertEqual(list(search.get_search_backend().search('vantri').values_list('pk', flat=True)), [vantrix.pk])
+
+
+class QuerySamplingTests(TestCase):
+    """SELECTs sampled from requests for the index advisor"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'samples.jsonl')
+
+    def samples(self):
+        with open(self.path, encoding='utf-8') as log:
+            return [json.loads(line) for line in log]
+
+    def test_records_only_selects(self):
+        with query_sampling.sample_queries(self.path):
+            business = make_business('Quuxly Payments LLC')
+            compliance_request = ComplianceRequest.objects.create(business=business, status='PENDING')
+            Payment.objects.create(
+                compliance_request=compliance_request, idempotency_key='key', order_reference='ORD-1',
+                amount='10.00', token='supt_secret-card-token', postal_code='27601',
+            )
+            list(Business.objects.filter(city='Raleigh'))
+        samples = self.samples()
+        self.assertTrue(samples)
+        self.assertTrue(all(sample['sql'].startswith('SELECT') for sample in samples))
+        self.assertNotIn('supt_secret-card-token', json.dumps(samples))
+        self.assertIn(['Raleigh'], [sample['params'] for sample in samples])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_middleware_samples_requests(self):
+        with override_settings(QUERY_SAMPLE_RATE=1, QUERY_SAMPLE_LOG=self.path):
+            self.client_class().get(reverse('core:search_results'), {'q': 'acme'})
+        self.assertTrue(any('core_business' in sample['sql'] for sample in self.samples()))
+        with self.assertRaises(MiddlewareNotUsed):
+            query_sampling.QuerySamplingMiddleware(lambda request: None)
+
+
+class IndexAdvisorTests(TestCase):
+    """Index suggestions from sampled queries"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'samples.jsonl')
+        for number in range(50):
+            make_business(f'Quuxly {number}', city=f'City {number % 5}', zip_code=f'{27600 + number}')
+
+    def sample(self, *querysets):
+        with query_sampling.sample_queries(self.path):
+            for queryset in querysets:
+                list(queryset)
+        with open(self.path, encoding='utf-8') as log:
+            return index_advisor.load_groups(log)
+
+    def test_query_shapes(self):
+        self.assertEqual(
+            index_advisor.query_shape('SELECT "a"."id" FROM "a" WHERE "a"."b" = 12 AND "a"."c" IN (%s, %s)  LIMIT 21'),
+            'SELECT "a"."id" FROM "a" WHERE "a"."b" = ? AND "a"."c" IN (...) LIMIT ?',
+        )
+        self.assertEqual(index_advisor.query_shape("SELECT 'it''s' FROM \"t1\""), 'SELECT ? FROM "t1"')
+
+    def test_reads_where_and_order_by_columns(self):
+        sql = str(Business.objects.filter(city='x', removed_at__isnull=True, date_formed__gte='2020-01-01')
+                  .order_by('zip_code').query)
+        columns = index_advisor.QueryColumns(sql)
+        self.assertEqual(columns.table, 'core_business')
+        self.assertEqual(columns.equality, ['city'])
+        self.assertEqual(columns.range, ['date_formed'])
+        self.assertEqual(columns.conditions, [('removed_at', 'isnull', True)])
+        self.assertEqual(columns.ordering, [('zip_code', False)])
+        self.assertFalse(index_advisor.QueryColumns(str(Business.objects.filter(Q(city='x') | Q(zip_code='y')).query)).understood)
+
+    def test_groups_samples_by_shape(self):
+        groups = self.sample(
+            Business.objects.filter(city='City 1'), Business.objects.filter(city='City 2'),
+            Business.objects.filter(zip_code='27601'),
+        )
+        self.assertEqual(sorted(group.count for group in groups), [1, 2])
+        with self.assertLogs('core.index_advisor', 'WARNING'):
+            self.assertEqual(index_advisor.load_groups(['not json', '{"sql": "SELECT 1"}']), [])
+
+    def test_proposes_indexes_for_scans_only(self):
+        groups = self.sample(
+            Business.objects.filter(city='City 1').order_by('zip_code'),
+            # Served by core_business_state_idx and the unique reference_id
+            Business.objects.filter(state_code='NC'),
+            Business.objects.filter(reference_id='0000'),
+        )
+        candidates = index_advisor.advise(connection, groups)
+        self.assertEqual([(candidate.model, candidate.fields) for candidate in candidates], [(Business, ['city', 'zip_code'])])
+        self.assertEqual(candidates[0].index().fields, ['city', 'zip_code'])
+        # Verifying builds the index in a transaction that is rolled back
+        index_advisor.advise(connection, groups, verify=True)
+        self.assertFalse(any(
+            columns == ['city', 'zip_code'] for columns, _unique in index_advisor.existing_indexes(connection, 'core_business')
+        ))
+
+    def test_command(self):
+        self.sample(Business.objects.filter(city='City 1').order_by('zip_code'))
+        stdout = io.StringIO()
+        call_command('index_advisor', '--log', self.path, stdout=stdout)
+        self.assertIn('1. core.Business (city, zip_code)', stdout.getvalue())
+        self.assertIn("migrations.AddIndex(", stdout.getvalue())
+        self.assertIn("Add to the models' Meta.indexes:", stdout.getvalue())
+        with self.assertRaisesMessage(CommandError, 'No query samples'):
+            call_command('index_advisor', '--log', self.path + '.missing')
+
+
+def make_order(business, services, **fields):
+    """A compliance request for business with services on its order"""
+    compliance_request = ComplianceRequest.objects.create(business=business, status='PENDING', **fields)
+    pricing.select_services(compliance_request, services)
+    return ComplianceRequest.objects.select_related('business').get(pk=compliance_request.pk)
+
+
+class PricingTests(TestCase):
+    """The cart priced from its order items in one query"""
+
+    PACKAGE = ['OPERATING_AGREEMENT', 'FEDERAL_EIN', 'LABOR_LAW_POSTER_CERT']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.llc = make_business('Quuxly LLC')
+        cls.corp = make_business('Zorbex Corp', business_type='CORP')
+
+    def test_prices_line_items_in_one_query(self):
+        compliance_request = make_order(self.llc, ['FEDERAL_EIN', 'OPERATING_AGREEMENT'])
+        with self.assertNumQueries(1):
+            quote = pricing.quote(compliance_request)
+        self.assertEqual(quote.line_items, (
+            pricing.LineItem('FEDERAL_EIN', 'Federal EIN Application', Decimal('149.95')),
+            pricing.LineItem('OPERATING_AGREEMENT', 'Operating Agreement', Decimal('249.95')),
+        ))
+        self.assertEqual((quote.subtotal, quote.discount, quote.total), (Decimal('399.90'), Decimal('0.00'), Decimal('399.90')))
+        self.assertFalse(quote.show_discount)
+
+    def test_package_discount_for_the_business_type(self):
+        quote = pricing.quote(make_order(self.llc, self.PACKAGE))
+        self.assertEqual((quote.subtotal, quote.discount, quote.total), (Decimal('549.85'), Decimal('49.90'), Decimal('499.95')))
+        # An LLC's package isn't a corporation's
+        quote = pricing.quote(make_order(self.corp, self.PACKAGE))
+        self.assertEqual(quote.discount, Decimal('0.00'))
+        other_corp = make_business('Vantrix Corp', business_type='CORP')
+        quote = pricing.quote(make_order(other_corp, ['CORPORATE_BYLAWS', 'FEDERAL_EIN', 'LABOR_LAW_POSTER_CERT']))
+        self.assertEqual(quote.discount, Decimal('49.90'))
+
+    def test_unlimited_amendments_add_on(self):
+        quote = pricing.quote(make_order(self.llc, ['FEDERAL_EIN'], unlimited_amendments=True))
+        self.assertEqual(quote.add_ons_total, Decimal('39.95'))
+        self.assertEqual(quote.total, Decimal('189.90'))
+
+    def test_items_keep_the_price_they_were_selected_at(self):
+        compliance_request = make_order(self.llc, ['FEDERAL_EIN', 'OPERATING_AGREEMENT'])
+        with mock.patch.object(SERVICES['FEDERAL_EIN'], 'price', Decimal('199.95')):
+            pricing.select_services(compliance_request, ['OPERATING_AGREEMENT', 'FEDERAL_EIN', 'LABOR_LAW_POSTER_CERT'])
+        self.assertEqual(
+            list(compliance_request.items.values_list('service', 'position', 'price')),
+            [('OPERATING_AGREEMENT', 0, Decimal('249.95')), ('FEDERAL_EIN', 1, Decimal('149.95')),
+             ('LABOR_LAW_POSTER_CERT', 2, Decimal('149.95'))],
+        )
+        pricing.select_services(compliance_request, ['LABOR_LAW_POSTER_CERT'])
+        self.assertEqual(list(compliance_request.items.values_list('service', flat=True)), ['LABOR_LAW_POSTER_CERT'])
+
+    def test_unknown_services_are_refused_before_the_order_changes(self):
+        compliance_request = make_order(self.llc, ['FEDERAL_EIN'])
+        with self.assertRaises(pricing.UnknownService):
+            pricing.select_services(compliance_request, ['OPERATING_AGREEMENT', 'ANNUAL_REPORT'])
+        self.assertEqual(list(compliance_request.items.values_list('service', flat=True)), ['FEDERAL_EIN'])
+
+    def test_payment_and_confirmation_pages_show_the_quote(self):
+        compliance_request = make_order(self.llc, self.PACKAGE)
+        response = self.client.get(reverse('core:payment', args=[compliance_request.pk]))
+        self.assertEqual(response.context['total_price'], Decimal('499.95'))
+        self.assertContains(response, '49.90')
+        session = self.client.session
+        session['payment_info'] = {'user_email': 'ada@example.com', 'order_reference': 'ORD-1', 'business_name': 'Quuxly LLC'}
+        session.save()
+        response = self.client.get(reverse('core:payment_confirmation', args=[compliance_request.pk]))
+        self.assertEqual(response.context['amount'], '499.95')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('499.95', mail.outbox[0].alternatives[0][0])
+
+
+class QuoteSnapshotTests(TestCase):
+    """The payment page's quote is stored and read back, not priced again"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business = make_business('Quuxly LLC')
+
+    def setUp(self):
+        self.compliance_request = make_order(self.business, ['FEDERAL_EIN', 'OPERATING_AGREEMENT'])
+
+    def test_payment_page_stores_a_versioned_snapshot(self):
+        self.client.get(reverse('core:payment', args=[self.compliance_request.pk]))
+        self.compliance_request.refresh_from_db()
+        self.assertEqual(self.compliance_request.quote_snapshot['version'], pricing.PRICING_VERSION)
+        self.assertEqual(self.compliance_request.quote_snapshot['total'], '399.90')
+        self.assertIsNotNone(self.compliance_request.quoted_at)
+
+    def test_snapshot_round_trip(self):
+        quote = pricing.quote(self.compliance_request)
+        self.assertEqual(pricing.Quote.from_snapshot(json.loads(json.dumps(quote.snapshot()))), quote)
+
+    def test_first_snapshot_wins(self):
+        stale = ComplianceRequest.objects.select_related('business').get(pk=self.compliance_request.pk)
+        first = pricing.snapshot_quote(self.compliance_request)
+        # A page that loaded the request before it was quoted reads the stored quote back
+        self.compliance_request.items.update(price=Decimal('1.00'))
+        self.assertEqual(pricing.snapshot_quote(stale), first)
+        self.assertEqual(stale.quote_snapshot, self.compliance_request.quote_snapshot)
+
+    def test_changing_the_cart_discards_the_snapshot(self):
+        pricing.snapshot_quote(self.compliance_request)
+        url = reverse('core:compliance_request', args=[self.business.reference_id])
+        self.client.post(url, {'services': ['FEDERAL_EIN']})
+        self.compliance_request.refresh_from_db()
+        self.assertIsNone(self.compliance_request.quote_snapshot)
+        self.assertEqual(pricing.snapshot_quote(self.compliance_request).total, Decimal('149.95'))
+
+    def test_paid_requests_keep_their_snapshot(self):
+        pricing.snapshot_quote(self.compliance_request)
+        self.compliance_request.status = 'PAID'
+        self.assertEqual(pricing.discard_quote(self.compliance_request), [])
+        self.assertIsNotNone(self.compliance_request.quote_snapshot)
+
+    def test_confirmation_reads_the_snapshot(self):
+        self.client.get(reverse('core:payment', args=[self.compliance_request.pk]))
+        self.compliance_request.items.update(price=Decimal('1.00'))
+        with mock.patch.object(SERVICES['FEDERAL_EIN'], 'price', Decimal('1.00')):
+            response = self.client.get(reverse('core:payment_confirmation', args=[self.compliance_request.pk]))
+        self.assertEqual(response.context['amount'], '399.90')
+
+
+class PaidOrderTests(TestCase):
+    """Once paid for, an order's items are what gets fulfilled"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business = make_business('Quuxly LLC')
+
+    def setUp(self):
+        self.compliance_request = make_order(self.business, ['FEDERAL_EIN', 'OPERATING_AGREEMENT'])
+        ComplianceRequest.objects.filter(pk=self.compliance_request.pk).update(status='PAID')
+        self.compliance_request.items.update(status=OrderItem.PAID)
+
+    def test_paid_items_survive_a_resubmission(self):
+        url = reverse('core:compliance_request', args=[self.business.reference_id])
+        response = self.client.post(url, {'services': ['LABOR_LAW_POSTER_CERT'], 'unlimited_amendments': 'on'})
+        self.assertRedirects(
+            response, reverse('core:payment_confirmation', args=[self.compliance_request.pk]),
+            fetch_redirect_response=False,
+        )
+        self.assertEqual(
+            list(self.compliance_request.items.values_list('service', 'status')),
+            [('FEDERAL_EIN', OrderItem.PAID), ('OPERATING_AGREEMENT', OrderItem.PAID)],
+        )
+        self.compliance_request.refresh_from_db()
+        self.assertFalse(self.compliance_request.unlimited_amendments)
+
+    def test_select_services_refuses_paid_requests(self):
+        self.compliance_request.refresh_from_db()
+        with self.assertRaises(pricing.CartLocked):
+            pricing.select_services(self.compliance_request, ['FEDERAL_EIN'])
+        self.assertEqual(self.compliance_request.items.count(), 2)
+
+
+class ServiceChoiceTests(TestCase):
+    """The compliance request form offers, and accepts, only the services the business type can order"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business = make_business('Quuxly LLC')
+        cls.url = reverse('core:compliance_request', args=[cls.business.reference_id])
+
+    def test_offers_the_services_for_the_business_type(self):
+        choices = [code for code, label in self.client.get(self.url).context['form'].fields['services'].choices]
+        self.assertEqual(choices, [code for code, service in SERVICES.items() if service.offered_to('LLC')])
+        self.assertNotIn('CORPORATE_BYLAWS', choices)
+
+    def test_accepts_a_service_without_a_prior_get(self):
+        response = self.client.post(self.url, {'services': ['LABOR_LAW_POSTER_CERT']})
+        self.assertEqual(response.status_code, 302)
+        compliance_request = ComplianceRequest.objects.get(business=self.business)
+        self.assertEqual(list(compliance_request.items.values_list('service', flat=True)), ['LABOR_LAW_POSTER_CERT'])
+
+    def test_unknown_and_unoffered_services_are_form_errors(self):
+        for service in ('ANNUAL_REPORT', 'CORPORATE_BYLAWS'):
+            with self.subTest(service=service):
+                response = self.client.post(self.url, {'services': [service]})
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.context['form'].has_error('services', 'invalid_choice'))
+        self.assertFalse(ComplianceRequest.objects.filter(business=self.business).exists())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(TestCase):
+    """Consecutive gateway failures open the breaker until a trial call succeeds"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = payments.CircuitBreaker(threshold=2, reset_seconds=30, clock=self.clock)
+        patch = mock.patch.object(payments, 'logger')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_opens_after_threshold_failures(self):
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(payments.GatewayUnavailable):
+            self.breaker.before_call()
+
+    def test_success_resets_the_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open)
+
+    def test_half_open_lets_one_trial_through(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 29
+        with self.assertRaises(payments.GatewayUnavailable):
+            self.breaker.before_call()
+        self.clock.now = 30
+        self.breaker.before_call()
+        # Only the one trial while it runs
+        with self.assertRaises(payments.GatewayUnavailable):
+            self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.before_call()
+
+    def test_failed_trial_opens_it_again(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 30
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+        self.clock.now = 59
+        with self.assertRaises(payments.GatewayUnavailable):
+            self.breaker.before_call()
+        self.clock.now = 60
+        self.breaker.before_call()
+
+
+@override_settings(
+    PAYMENT_GATEWAY_CONNECT_TIMEOUT=1.5, PAYMENT_GATEWAY_READ_TIMEOUT=7, PAYMENT_GATEWAY_POOL_SIZE=3,
+    HEARTLAND_SERVICE_URL='https://gateway.example.com',
+)
+class GatewayConfigurationTests(TestCase):
+    """The SDK's requests go through a pool with the configured timeouts and no retries"""
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(payments, '_configured', False),
+            mock.patch.object(gateways, 'HTTP', gateways.HTTP),
+            mock.patch.object(payments.ServicesContainer, 'configure'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_pool_timeouts(self):
+        payments.configure_gateway()
+        pool = gateways.HTTP.connection_from_url('https://gateway.example.com/Hps.Exchange.PosGateway/')
+        self.assertEqual((pool.timeout.connect_timeout, pool.timeout.read_timeout), (1.5, 7))
+        self.assertIs(pool.retries.total, False)
+        self.assertEqual(pool.pool.maxsize, 3)
+        config = payments.ServicesContainer.configure.call_args.args[0]
+        self.assertEqual(config.timeout, 8500)
+
+    def test_sdk_requests_use_the_pool(self):
+        payments.configure_gateway()
+        gateway = gateways.Gateway('text/xml')
+        gateway.service_url = 'https://gateway.example.com'
+        with mock.patch.object(gateways.HTTP, 'urlopen') as urlopen:
+            urlopen.return_value.status = 200
+            gateway.send_request('POST', '/Hps.Exchange.PosGateway/', '<x/>')
+        urlopen.assert_called_once()
+
+    def test_configures_once(self):
+        payments.configure_gateway()
+        pool = gateways.HTTP
+        payments.configure_gateway()
+        self.assertIs(gateways.HTTP, pool)
+        payments.ServicesContainer.configure.assert_called_once()
+
+
+def gateway_error(inner):
+    """Send a request through the gateway's pool and fail with inner, wrapped as the SDK wraps it"""
+    def send(*args, **kwargs):
+        with mock.patch('urllib3.PoolManager.urlopen', side_effect=inner):
+            try:
+                payments.GatewayPool().urlopen('POST', 'https://gateway.example.com/')
+            except Exception as exc:
+                raise GatewayException('Error occurred while communicating with gateway.', inner_exception=exc)
+    return send
+
+
+class PaymentQueueTests(TestCase):
+    """Payments are queued once per order, claimed once and charged once"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.compliance_request = make_order(make_business('Quuxly LLC'), ['FEDERAL_EIN'])
+
+    def setUp(self):
+        patch = mock.patch.object(payments, 'breaker', payments.CircuitBreaker(3, 30))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def submit(self, order_reference='ORD-1', token='supt_1', compliance_request=None):
+        return payments.submit(
+            compliance_request or self.compliance_request, order_reference, Decimal('149.95'), token, '27601',
+        )
+
+    def charge_with(self, **response):
+        approval = mock.Mock(response_code='00', transaction_id='T1', response_message='APPROVAL')
+        return mock.patch.object(payments, 'charge', return_value=mock.Mock(**{**vars(approval), **response}))
+
+    def test_resubmitting_finds_the_queued_payment(self):
+        payment = self.submit()
+        again = self.submit(token='supt_2')
+        self.assertEqual(again.pk, payment.pk)
+        self.assertEqual((again.status, again.token), (Payment.QUEUED, 'supt_1'))
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_declined_payments_are_queued_again(self):
+        payment = self.submit()
+        Payment.objects.filter(pk=payment.pk).update(status=Payment.DECLINED, token='')
+        again = self.submit(token='supt_2')
+        self.assertEqual((again.pk, again.status, again.token), (payment.pk, Payment.QUEUED, 'supt_2'))
+
+    def test_settled_payments_are_not_charged_again(self):
+        for status in (Payment.PAID, Payment.UNCONFIRMED, Payment.PROCESSING):
+            Payment.objects.all().delete()
+            payment = self.submit()
+            Payment.objects.filter(pk=payment.pk).update(status=status)
+            self.assertEqual(self.submit(token='supt_2').status, status)
+            self.assertIsNone(payments.claim_next())
+
+    def test_claims_oldest_first_and_once(self):
+        other = make_order(make_business('Zorbex LLC'), ['FEDERAL_EIN'])
+        first = self.submit()
+        second = self.submit(compliance_request=other)
+        claimed = payments.claim_next()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (first.pk, Payment.PROCESSING, 1))
+        self.assertEqual(payments.claim_next().pk, second.pk)
+        self.assertIsNone(payments.claim_next())
+
+    def test_skips_a_payment_claimed_elsewhere(self):
+        first = self.submit()
+        second = self.submit(order_reference='ORD-2')
+        first_row = QuerySet.first
+        raced = []
+
+        # Another worker claims the oldest between this one reading and claiming it
+        def read_then_lose_the_race(queryset):
+            payment = first_row(queryset)
+            if not raced:
+                raced.append(payment)
+                Payment.objects.filter(pk=payment.pk).update(status=Payment.PROCESSING)
+            return payment
+
+        with mock.patch.object(QuerySet, 'first', autospec=True, side_effect=read_then_lose_the_race):
+            claimed = payments.claim_next()
+        self.assertEqual(raced, [first])
+        self.assertEqual((claimed.pk, claimed.attempts), (second.pk, 1))
+        first.refresh_from_db()
+        self.assertEqual(first.attempts, 0)
+
+    def test_paying_marks_the_request_and_items_paid(self):
+        self.submit()
+        with self.charge_with():
+            payment = payments.process(payments.claim_next())
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.transaction_id, payment.token), (Payment.PAID, 'T1', ''))
+        self.compliance_request.refresh_from_db()
+        self.assertEqual(self.compliance_request.status, 'PAID')
+        self.assertEqual(set(self.compliance_request.items.values_list('status', flat=True)), {OrderItem.PAID})
+
+    def test_declines_leave_the_request_unpaid(self):
+        self.submit()
+        with self.charge_with(response_code='05', response_message='DECLINE'):
+            payment = payments.process(payments.claim_next())
+        self.assertEqual(payment.status, Payment.DECLINED)
+        self.compliance_request.refresh_from_db()
+        self.assertEqual(self.compliance_request.status, 'PENDING')
+
+    def process_raising(self, side_effect):
+        self.submit()
+        card = mock.patch.object(payments, 'CreditCardData')
+        with mock.patch.object(payments, 'configure_gateway'), card as card_data, mock.patch.object(payments, 'logger'):
+            card_data.return_value.charge.side_effect = side_effect
+            return payments.process(payments.claim_next())
+
+    def test_errors_before_sending_fail_the_payment(self):
+        payment = self.process_raising(TypeError('bug'))
+        self.assertEqual(payment.status, Payment.FAILED)
+
+    def test_failing_to_connect_fails_the_payment(self):
+        payment = self.process_raising(gateway_error(urllib3.exceptions.ConnectTimeoutError('timed out')))
+        self.assertEqual(payment.status, Payment.FAILED)
+
+    def test_no_answer_after_sending_is_unconfirmed(self):
+        payment = self.process_raising(gateway_error(urllib3.exceptions.ReadTimeoutError(None, '/', 'timed out')))
+        self.assertEqual((payment.status, payment.token), (Payment.UNCONFIRMED, ''))
+        # Resubmitting doesn't charge it again
+        self.assertEqual(self.submit(token='supt_2').status, Payment.UNCONFIRMED)
+
+    @override_settings(PAYMENT_PROCESSING_TIMEOUT=60)
+    def test_stalled_payments_become_unconfirmed(self):
+        stalled = self.submit()
+        running = self.submit(order_reference='ORD-2')
+        payments.claim_next()
+        payments.claim_next()
+        Payment.objects.filter(pk=stalled.pk).update(updated_at=timezone.now() - datetime.timedelta(seconds=61))
+        with mock.patch.object(payments, 'logger'):
+            self.assertEqual(payments.reap_stalled(), 1)
+        stalled.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual((stalled.status, stalled.token), (Payment.UNCONFIRMED, ''))
+        self.assertEqual(running.status, Payment.PROCESSING)
+
+    def test_process_payments_command(self):
+        self.submit()
+        stdout = io.StringIO()
+        with self.charge_with():
+            call_command('process_payments', '--once', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'ORD-1: Paid\n')
+
+    def test_status_page_redirects_once_paid(self):
+        url = reverse('core:payment_status', args=[self.compliance_request.pk])
+        session = self.client.session
+        session['order_reference'] = 'ORD-1'
+        session.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.submit()
+        self.assertEqual(self.client.get(url).json(), {'status': Payment.QUEUED})
+        with self.charge_with():
+            payments.process(payments.claim_next())
+        self.assertEqual(
+            self.client.get(url).json()['redirect'],
+            reverse('core:payment_confirmation', args=[self.compliance_request.pk]),
+        )
+
+
+class ServiceRegistryTests(TestCase):
+    """SERVICES is the one place services, their prices and their forms are declared"""
+
+    def test_services_can_be_ordered(self):
+        self.assertLessEqual(set(SERVICES), {code for code, label in OrderItem.SERVICE_CHOICES})
+
+    def test_steps_write_only_fields_their_model_has(self):
+        request_fields = {field.name for field in ComplianceRequest._meta.concrete_fields}
+        for code, service in SERVICES.items():
+            for step in service.steps:
+                with self.subTest(code, step=step.name):
+                    get_template(step.template)
+                    model_fields = {field.name for field in step.model._meta.concrete_fields if field.editable}
+                    self.assertTrue(step.fields)
+                    self.assertLessEqual(set(step.fields), set(step.form_class.base_fields) & model_fields)
+                    self.assertNotIn('compliance_request', step.fields)
+                    self.assertLessEqual(set(step.request_fields), request_fields)
+
+    def test_offered_by_business_type(self):
+        offered = {
+            business_type: [code for code, service in SERVICES.items() if service.offered_to(business_type)]
+            for business_type in ('LLC', 'CORP')
+        }
+        self.assertEqual(offered, {
+            'LLC': ['OPERATING_AGREEMENT', 'FEDERAL_EIN', 'LABOR_LAW_POSTER_CERT'],
+            'CORP': ['CORPORATE_BYLAWS', 'FEDERAL_EIN', 'LABOR_LAW_POSTER_CERT'],
+        })
+
+    def test_package_is_every_service_offered(self):
+        for business_type, package in pricing.PACKAGES.items():
+            with self.subTest(business_type):
+                self.assertEqual(package, {code for code, service in SERVICES.items() if service.offered_to(business_type)})
+
+    def test_requests_are_priced_by_their_items(self):
+        compliance_request = make_order(make_business('Quuxly LLC'), ['FEDERAL_EIN'], request_type='FEDERAL_EIN')
+        self.assertIsNone(compliance_request.price)
+        self.assertEqual(compliance_request.items.get().price, SERVICES['FEDERAL_EIN'].price)
+
+    def test_step_save_returns_request_fields_unsaved(self):
+        compliance_request = make_order(make_business('Quuxly LLC'), ['FEDERAL_EIN'])
+        step = SERVICES['FEDERAL_EIN'].steps[0]
+        with CaptureQueriesContext(connection) as captured:
+            saved = step.save(compliance_request, {'applicant_first_name': 'Ada', 'unknown_field': 'x'})
+        self.assertEqual(saved, ['applicant_first_name'])
+        self.assertEqual(compliance_request.applicant_first_name, 'Ada')
+        self.assertFalse([query for query in captured if 'core_compliancerequest' in query['sql'].split('WHERE')[0]])
+        self.assertTrue(FederalEINRequest.objects.filter(compliance_request=compliance_request).exists())
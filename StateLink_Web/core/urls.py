@@ -7,8 +7,14 @@ urlpatterns = [
     path('', views.HomeView.as_view(), name='home'),
     path('search-results/', views.SearchResultsView.as_view(), name='search_results'),
     path('compliance-request/<str:business_id>/', views.ComplianceRequestView.as_view(), name='compliance_request'),
+    # Short landing URL printed on mailed letters
+    path('r/<str:business_id>/', views.ComplianceRequestView.as_view(), name='reference_landing'),
     path('service-form/<int:request_id>/', views.ServiceFormView.as_view(), name='service_form'),
+    path('service-form/<int:request_id>/draft/', views.ServiceDraftView.as_view(), name='service_form_draft'),
+    path('checkout/<int:request_id>/', views.CheckoutView.as_view(), name='checkout'),
     path('payment/<int:request_id>/', views.PaymentView.as_view(), name='payment'),
+    path('payment/<int:request_id>/processing/', views.PaymentProcessingView.as_view(), name='payment_processing'),
+    path('payment/<int:request_id>/status/', views.payment_status, name='payment_status'),
     path('payment-confirmation/<int:request_id>/', views.PaymentConfirmationView.as_view(), name='payment_confirmation'),
     path('insurance-info/', views.InsuranceInfoView.as_view(), name='insurance_info'),
     path('business-search/', views.business_search_autocomplete, name='business_search_autocomplete'),
@@ -1,31 +1,27 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import redirect, get_object_or_404
 from django.contrib import messages
-from django.views.generic import TemplateView, FormView
-from decimal import Decimal
-from .models import Business, ComplianceRequest, FederalEINRequest, OperatingAgreementRequest, CorporateBylawsRequest, LaborLawPosterRequest, CertificateExistenceRequest
+from django.views.generic import TemplateView, FormView, View
+from .models import Business, ComplianceRequest, OrderItem, Payment, normalise_reference_id
 from .forms import (
     BusinessSearchForm,
     ComplianceRequestForm,
-    CorporateBylawsForm,
-    OperatingAgreementForm,
-    FederalEINForm,
-    LaborLawPosterForm,
-    CertificateExistenceForm
 )
-from django.db import models
+from . import fuzzy, payments, prefix_index, pricing
+from .services import SERVICES
+from .search import SearchPage, resolve_reference_id
+from django.db import transaction
 from django.http import JsonResponse
-from django.db.models import Q
 from django import forms
 import time
 from django.conf import settings
 import logging
-from globalpayments.api.builders import Address
-from globalpayments.api.payment_methods import CreditCardData
-from globalpayments.api import PorticoConfig, ServicesContainer
 from django.http import Http404
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.urls import reverse
+from urllib.parse import urlencode
 
 logger = logging.getLogger(__name__)
 
@@ -34,94 +30,130 @@ logger = logging.getLogger(__name__)
 class HomeView(FormView):
     template_name = 'core/home.html'
     form_class = BusinessSearchForm
-    success_url = '/search-results/'
 
     def form_valid(self, form):
+        # Legacy POST searches: the home page now submits straight to the results page by GET
         search_query = form.cleaned_data['search_query']
-        # Store search query in session for results page
-        self.request.session['search_query'] = search_query
-        return super().form_valid(form)
+        # A reference number from a letter goes straight to its business
+        business = resolve_reference_id(search_query)
+        if business:
+            return redirect('core:compliance_request', business_id=business.reference_id)
+        return redirect(f"{reverse('core:search_results')}?{urlencode({'q': search_query})}")
 
 class SearchResultsView(TemplateView):
     template_name = 'core/search_results.html'
+    paginate_by = 20
+    # Seconds a browser may reuse a results page before revalidating. Pages
+    # carry the visitor's session messages, so shared caches mustn't keep them
+    cache_max_age = 60
+
+    def get(self, request, *args, **kwargs):
+        search_query = request.GET.get('q')
+        if search_query is None:
+            # Old bookmarks and in-flight sessions: move the session query into the URL
+            search_query = request.session.get('search_query', '')
+            return redirect(f"{reverse('core:search_results')}?{urlencode({'q': search_query})}")
+        
+        cursor = request.GET.get('cursor')
+        if not cursor:
+            business = resolve_reference_id(search_query)
+            if business:
+                return redirect('core:compliance_request', business_id=business.reference_id)
+        
+        # Search in both reference number and business name, one keyset page at a time
+        self.page = SearchPage(search_query, cursor=cursor, page_size=self.paginate_by)
+        response = get_conditional_response(request, etag=self.page.etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        response.headers['ETag'] = self.page.etag
+        patch_cache_control(response, private=True, max_age=self.cache_max_age)
+        return response
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        search_query = self.request.session.get('search_query', '')
-        
-        # Search in both reference number and business name
-        businesses = Business.objects.filter(
-            models.Q(reference_id__icontains=search_query) |
-            models.Q(name__icontains=search_query)
-        )
-        
-        context['businesses'] = businesses
-        context['search_query'] = search_query
+        result_count = self.page.count
+        context['businesses'] = self.page.businesses
+        context['search_query'] = self.page.query
+        context['next_cursor'] = self.page.next_cursor
+        context['is_first_page'] = self.page.is_first_page
+        context['result_count'] = result_count.count
+        context['result_count_is_estimate'] = result_count.is_estimate
+        context['result_count_is_capped'] = result_count.is_capped
+        # Offer close spellings when nothing matched
+        if not self.page.businesses and self.page.is_first_page:
+            context['suggestions'] = fuzzy.suggest(self.page.query)
         return context
 
+class ComplianceRequestMixin:
+    """For views of one compliance request: looks it up, with its business, once per HTTP request"""
+
+    def get_compliance_request(self):
+        if not hasattr(self, '_compliance_request'):
+            self._compliance_request = get_object_or_404(
+                ComplianceRequest.objects.select_related('business'), id=self.kwargs.get('request_id'),
+            )
+        return self._compliance_request
+
 class ComplianceRequestView(FormView):
     template_name = 'core/compliance_form.html'
     form_class = ComplianceRequestForm
 
+    def get_business(self):
+        """The business the URL names, looked up once per HTTP request"""
+        if not hasattr(self, '_business'):
+            business_id = self.kwargs.get('business_id')
+            self._business = get_object_or_404(Business, reference_id=normalise_reference_id(business_id) or business_id)
+        return self._business
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        business_id = self.kwargs.get('business_id')
-        business = get_object_or_404(Business, reference_id=business_id)
+        business = self.get_business()
         context['business'] = business
-        
-        # Define available services based on business type
-        if business.business_type == 'LLC':
-            available_services = [
-                ('OPERATING_AGREEMENT', 'Operating Agreement ($249.95)'),
-                ('FEDERAL_EIN', 'Federal EIN Application ($149.95)'),
-                ('LABOR_LAW_POSTER_CERT', 'Labor Law Posters & Certificate of Existence ($149.95)'),
-            ]
-        elif business.business_type == 'CORP':
-            available_services = [
-                ('CORPORATE_BYLAWS', 'Corporate Bylaws ($249.95)'),
-                ('FEDERAL_EIN', 'Federal EIN Application ($149.95)'),
-                ('LABOR_LAW_POSTER_CERT', 'Labor Law Posters & Certificate of Existence ($149.95)'),
-            ]
-        else:
-            available_services = [
-                ('FEDERAL_EIN', 'Federal EIN Application ($149.95)'),
-                ('LABOR_LAW_POSTER_CERT', 'Labor Law Posters & Certificate of Existence ($149.95)'),
-            ]
-        
-        # Update form's service choices
-        self.form_class.base_fields['services'].choices = available_services
-        context['form'] = self.get_form()
-        
         return context
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        # Offer the services this business type can order; anything else posted is a form error
+        business_type = self.get_business().business_type
+        kwargs['service_choices'] = [
+            (code, f'{service.name} (${service.price})')
+            for code, service in SERVICES.items() if service.offered_to(business_type)
+        ]
+        return kwargs
+
     def form_valid(self, form):
-        business_id = self.kwargs.get('business_id')
-        business = get_object_or_404(Business, reference_id=business_id)
+        business = self.get_business()
         services = form.cleaned_data.get('services', [])
         
-        # Get or create a single compliance request for this business
-        compliance_request, created = ComplianceRequest.objects.get_or_create(
-            business=business,
-            defaults={'status': 'PENDING'}
-        )
-        
-        # Store the selected services in session
-        self.request.session['selected_services'] = services
-        
-        # If this is a new request, set the first service type
-        if created and services:
-            compliance_request.request_type = services[0]
-            compliance_request.save()
+        try:
+            with transaction.atomic():
+                # Get or create a single compliance request for this business,
+                # a new one typed by its first service. The row stays locked
+                # so a payment can't complete while its items change.
+                compliance_request, created = ComplianceRequest.objects.select_for_update().get_or_create(
+                    business=business,
+                    defaults={'status': 'PENDING', 'request_type': services[0] if services else ''}
+                )
+
+                # The order's items are the selected services
+                pricing.select_services(compliance_request, services)
+
+                # Save the add-on selection
+                compliance_request.unlimited_amendments = form.cleaned_data.get('unlimited_amendments', False)
+                changed = pricing.discard_quote(compliance_request)
+                compliance_request.save(update_fields=['unlimited_amendments', *changed, 'updated_at'])
+        except pricing.CartLocked:
+            # What was paid for is what gets fulfilled
+            messages.error(self.request, 'This order has already been paid for and can no longer be changed.')
+            return redirect('core:payment_confirmation', request_id=compliance_request.id)
         
         # Store the compliance request ID in session
         self.request.session['compliance_request_id'] = compliance_request.id
         
-        # Save the add-on selection
-        compliance_request.unlimited_amendments = form.cleaned_data.get('unlimited_amendments', False)
-        compliance_request.save()
-        
-        # Redirect to the first service form
+        # Redirect to the service forms
         if services:
+            if settings.SINGLE_PAGE_CHECKOUT:
+                return redirect('core:checkout', request_id=compliance_request.id)
             return redirect('core:service_form', request_id=compliance_request.id)
         
         return redirect('core:home')
@@ -130,141 +162,46 @@ class PaymentForm(forms.Form):
     agrees_to_terms_digital_signature = forms.BooleanField(required=True)
     client_signature_text = forms.CharField(max_length=255)
 
-class PaymentView(FormView):
+class PaymentView(ComplianceRequestMixin, FormView):
     template_name = 'core/payment.html'
     form_class = PaymentForm
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
+        compliance_request = self.get_compliance_request()
         context['compliance_request'] = compliance_request
         context['business'] = compliance_request.business
         context['heartland_public_key'] = settings.HEARTLAND_PUBLIC_KEY
         
-        # Generate order reference if not exists
-        if 'order_reference' not in self.request.session:
-            self.request.session['order_reference'] = f"ORD-{compliance_request.business.reference_id}-{int(time.time())}"
-        
-        # Get all related service requests
-        service_requests = []
-        
-        # Check for Federal EIN request
-        has_federal_ein = False
-        try:
-            federal_ein = FederalEINRequest.objects.get(compliance_request=compliance_request)
-            service_requests.append({
-                'name': 'Federal EIN Application',
-                'price': Decimal('149.95')
-            })
-            has_federal_ein = True
-        except FederalEINRequest.DoesNotExist:
-            pass
-
-        # Check for Operating Agreement request
-        has_operating_agreement = False
-        try:
-            operating_agreement = OperatingAgreementRequest.objects.get(compliance_request=compliance_request)
-            service_requests.append({
-                'name': 'Operating Agreement',
-                'price': Decimal('249.95')
-            })
-            has_operating_agreement = True
-        except OperatingAgreementRequest.DoesNotExist:
-            pass
-
-        # Check for Corporate Bylaws request
-        has_corporate_bylaws = False
-        try:
-            corporate_bylaws = CorporateBylawsRequest.objects.get(compliance_request=compliance_request)
-            service_requests.append({
-                'name': 'Corporate Bylaws',
-                'price': Decimal('249.95')
-            })
-            has_corporate_bylaws = True
-        except CorporateBylawsRequest.DoesNotExist:
-            pass
-
-        # Check for Labor Law Poster and Certificate of Existence
-        has_labor_law = False
-        has_certificate = False
-        try:
-            labor_law = LaborLawPosterRequest.objects.get(compliance_request=compliance_request)
-            has_labor_law = True
-        except LaborLawPosterRequest.DoesNotExist:
-            pass
+        order_reference = self.get_order_reference(compliance_request)
 
-        try:
-            certificate = CertificateExistenceRequest.objects.get(compliance_request=compliance_request)
-            has_certificate = True
-        except CertificateExistenceRequest.DoesNotExist:
-            pass
-
-        # If both are present, add as bundled service
-        if has_labor_law and has_certificate:
-            service_requests.append({
-                'name': 'Labor Law Posters & Certificate of Existence',
-                'price': Decimal('149.95')
-            })
-        else:
-            if has_labor_law:
-                service_requests.append({
-                    'name': 'Labor Law Posters',
-                    'price': Decimal('99.95')
-                })
-            if has_certificate:
-                service_requests.append({
-                    'name': 'Certificate of Existence',
-                    'price': Decimal('99.95')
-                })
-
-        # Calculate subtotal
-        subtotal = sum(service['price'] for service in service_requests)
-        
-        # Calculate discount if all services are selected
-        discount = Decimal('49.90')
-        total_price = subtotal
-        show_discount = False
-        
-        # Check if all three services are selected
-        if compliance_request.business.business_type == 'CORP':
-            if has_federal_ein and has_corporate_bylaws and (has_labor_law and has_certificate):
-                total_price = subtotal - discount
-                show_discount = True
-        elif compliance_request.business.business_type == 'LLC':
-            if has_federal_ein and has_operating_agreement and (has_labor_law and has_certificate):
-                total_price = subtotal - discount
-                show_discount = True
-
-        # Add unlimited amendments addon if selected
-        if compliance_request.unlimited_amendments:
-            total_price += Decimal('39.95')
-
-        # Store the calculated prices in the session for later use
-        self.request.session['payment_calculation'] = {
-            'subtotal': str(subtotal),
-            'discount': str(discount) if show_discount else '0',
-            'total_price': str(total_price),
-            'show_discount': show_discount
-        }
+        # Price the cart once; the charge and confirmation read this snapshot back
+        quote = pricing.snapshot_quote(compliance_request)
 
         context.update({
-            'service_requests': service_requests,
-            'subtotal': subtotal,
-            'discount': discount,
-            'total_price': total_price,
-            'show_discount': show_discount,
-            'has_labor_law_poster': has_labor_law,
-            'order_reference': self.request.session.get('order_reference'),
+            'quote': quote,
+            'service_requests': quote.line_items,
+            'subtotal': quote.subtotal,
+            'discount': quote.discount,
+            'total_price': quote.total,
+            'show_discount': quote.show_discount,
+            'has_labor_law_poster': bool({'LABOR_LAW_POSTER_CERT', 'LABOR_LAW_POSTER'} & quote.services),
+            'order_reference': order_reference,
             'unlimited_amendments': compliance_request.unlimited_amendments,
-            'unlimited_amendments_price': Decimal('39.95') if compliance_request.unlimited_amendments else Decimal('0.00')
+            'unlimited_amendments_price': quote.add_ons_total
         })
         
         return context
 
+    def get_order_reference(self, compliance_request):
+        """The session's order reference, made up on first use; payments are keyed by it"""
+        if 'order_reference' not in self.request.session:
+            self.request.session['order_reference'] = f"ORD-{compliance_request.business.reference_id}-{int(time.time())}"
+        return self.request.session['order_reference']
+
     def form_valid(self, form):
         request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
+        compliance_request = self.get_compliance_request()
         
         # Get payment token from form
         payment_token = self.request.POST.get('payment_token')
@@ -272,196 +209,91 @@ class PaymentView(FormView):
             logger.error("Payment token missing from form submission")
             messages.error(self.request, 'Payment processing failed. Please try again.')
             return self.form_invalid(form)
-        
-        try:
-            # Configure GlobalPayments service
-            config = PorticoConfig()
-            config.secret_api_key = settings.HEARTLAND_SECRET_KEY
-            config.developer_id = settings.HEARTLAND_DEVELOPER_ID
-            config.version_number = settings.HEARTLAND_VERSION_NUMBER
-            config.service_url = settings.HEARTLAND_SERVICE_URL
-
-            ServicesContainer.configure(config)
-            
-            # Get payment calculation from session
-            payment_calculation = self.request.session.get('payment_calculation', {})
-            total_price = Decimal(payment_calculation.get('total_price', '0'))
-            
-            # Log payment attempt
-            logger.info(f"Processing payment for compliance request {request_id}")
-            logger.info(f"Amount: ${total_price}")
-            
-            # Create card data from token
-            card = CreditCardData()
-            card.token = payment_token
-            
-            # Create address object
-            address = Address()
-            address.postal_code = self.request.POST.get('billing_zip')
-            
-            # Process payment
-            response = card.charge(amount=str(total_price)) \
-                .with_currency("USD") \
-                .with_address(address) \
-                .execute()
-            
-            # Log payment response
-            print(f"Payment response: {response.response_code} - {response.response_message}")
-            print(f"Transaction ID: {response.transaction_id}")
-            print(f"Amount: ${total_price}")
-            
-            if response.response_code == '00':  # Success
-                # Update compliance request with payment information
-                compliance_request.agrees_to_terms_digital_signature = form.cleaned_data['agrees_to_terms_digital_signature']
-                compliance_request.client_signature_text = form.cleaned_data['client_signature_text']
-                compliance_request.status = 'PAID'
-                compliance_request.price = total_price  # Save the total price
-                compliance_request.order_reference_number = self.request.session.get('order_reference')  # Save the order reference
-                compliance_request.save()
-                
-                # Store payment information in session
-                self.request.session['payment_info'] = {
-                    'user_email': self.request.user.email if self.request.user.is_authenticated else 'guest@example.com',
-                    'order_reference': self.request.session.get('order_reference'),
-                    'amount': str(total_price),
-                    'subtotal': payment_calculation.get('subtotal'),
-                    'discount': payment_calculation.get('discount'),
-                    'show_discount': payment_calculation.get('show_discount'),
-                    'service_type': compliance_request.get_request_type_display(),
-                    'business_name': compliance_request.business.name,
-                    'transaction_id': response.transaction_id,
-                    'payment_status': 'success',
-                    'payment_message': response.response_message
-                }
-                
-                logger.info(f"Payment successful for compliance request {request_id}")
-                return redirect('core:payment_confirmation', request_id=request_id)
-            else:
-                error_message = f"Payment failed: {response.response_message}"
-                logger.error(error_message)
-                messages.error(self.request, error_message)
-                return self.form_invalid(form)
-                
-        except Exception as e:
-            error_message = f"Payment processing error: {str(e)}"
-            logger.error(error_message)
-            messages.error(self.request, error_message)
-            return self.form_invalid(form)
 
-class PaymentConfirmationView(TemplateView):
+        compliance_request.agrees_to_terms_digital_signature = form.cleaned_data['agrees_to_terms_digital_signature']
+        compliance_request.client_signature_text = form.cleaned_data['client_signature_text']
+        compliance_request.save(update_fields=['agrees_to_terms_digital_signature', 'client_signature_text', 'updated_at'])
+
+        # Queue a charge of what the payment page showed; process_payments makes it
+        # and the processing page polls for the outcome
+        payment = payments.submit(
+            compliance_request,
+            self.get_order_reference(compliance_request),
+            pricing.snapshot_quote(compliance_request).total,
+            payment_token,
+            self.request.POST.get('billing_zip'),
+        )
+        logger.info(f"Payment {payment.order_reference} for compliance request {request_id}: {payment.status}")
+        return redirect('core:payment_processing', request_id=request_id)
+
+class PaymentProcessingView(TemplateView):
+    """Waits on the queued charge, polling payment_status until it settles"""
+    template_name = 'core/payment_processing.html'
+
+def payment_status(request, request_id):
+    """
+    Where the session's payment for the request stands, for the processing
+    page to poll. Once it settles, redirect says where to send the browser.
+    """
+    order_reference = request.session.get('order_reference')
+    payment = (
+        Payment.objects.select_related('compliance_request__business')
+        .filter(idempotency_key=payments.idempotency_key(request_id, order_reference))
+        .first()
+    )
+    if payment is None:
+        return JsonResponse({'status': None, 'redirect': reverse('core:payment', args=[request_id])}, status=404)
+
+    data = {'status': payment.status}
+    if payment.status == Payment.PAID:
+        compliance_request = payment.compliance_request
+        request.session['payment_info'] = {
+            'user_email': request.user.email if request.user.is_authenticated else 'guest@example.com',
+            'order_reference': payment.order_reference,
+            'amount': str(payment.amount),
+            'service_type': compliance_request.get_request_type_display(),
+            'business_name': compliance_request.business.name,
+            'transaction_id': payment.transaction_id,
+            'payment_status': 'success',
+            'payment_message': payment.response_message,
+        }
+        data['redirect'] = reverse('core:payment_confirmation', args=[request_id])
+    elif payment.status == Payment.DECLINED:
+        messages.error(request, f"Payment failed: {payment.response_message}")
+        data['redirect'] = reverse('core:payment', args=[request_id])
+    elif payment.status == Payment.FAILED:
+        messages.error(request, 'We could not reach our payment processor. You have not been charged; please try again in a few minutes.')
+        data['redirect'] = reverse('core:payment', args=[request_id])
+    elif payment.status == Payment.UNCONFIRMED:
+        data['message'] = (
+            f"We could not confirm your payment with our payment processor. Please do not pay again; "
+            f"contact us quoting order reference {payment.order_reference} and we will confirm it for you."
+        )
+    return JsonResponse(data)
+
+class PaymentConfirmationView(ComplianceRequestMixin, TemplateView):
     template_name = 'core/payment_confirmation.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
+        compliance_request = self.get_compliance_request()
+        quote = pricing.snapshot_quote(compliance_request)
         
         # Get payment information from session
         payment_info = self.request.session.get('payment_info', {})
-        
-        # Get all related service requests
-        service_requests = []
-        
-        # Check for Federal EIN request
-        try:
-            federal_ein = FederalEINRequest.objects.get(compliance_request=compliance_request)
-            service_requests.append({
-                'name': 'Federal EIN Application',
-                'price': Decimal('149.95')
-            })
-        except FederalEINRequest.DoesNotExist:
-            pass
-
-        # Check for Operating Agreement request
-        try:
-            operating_agreement = OperatingAgreementRequest.objects.get(compliance_request=compliance_request)
-            service_requests.append({
-                'name': 'Operating Agreement',
-                'price': Decimal('249.95')
-            })
-        except OperatingAgreementRequest.DoesNotExist:
-            pass
-
-        # Check for Corporate Bylaws request
-        try:
-            corporate_bylaws = CorporateBylawsRequest.objects.get(compliance_request=compliance_request)
-            service_requests.append({
-                'name': 'Corporate Bylaws',
-                'price': Decimal('249.95')
-            })
-        except CorporateBylawsRequest.DoesNotExist:
-            pass
-
-        # Check for Labor Law Poster and Certificate of Existence
-        has_labor_law = False
-        has_certificate = False
-        try:
-            labor_law = LaborLawPosterRequest.objects.get(compliance_request=compliance_request)
-            has_labor_law = True
-        except LaborLawPosterRequest.DoesNotExist:
-            pass
-
-        try:
-            certificate = CertificateExistenceRequest.objects.get(compliance_request=compliance_request)
-            has_certificate = True
-        except CertificateExistenceRequest.DoesNotExist:
-            pass
-
-        # If both are present, add as bundled service
-        if has_labor_law and has_certificate:
-            service_requests.append({
-                'name': 'Labor Law Posters & Certificate of Existence',
-                'price': Decimal('149.95')
-            })
-        else:
-            if has_labor_law:
-                service_requests.append({
-                    'name': 'Labor Law Posters',
-                    'price': Decimal('99.95')
-                })
-            if has_certificate:
-                service_requests.append({
-                    'name': 'Certificate of Existence',
-                    'price': Decimal('99.95')
-                })
-
-        # Calculate subtotal
-        subtotal = sum(service['price'] for service in service_requests)
-        
-        # Calculate discount if all services are selected
-        discount = Decimal('49.90')
-        total_price = subtotal
-        show_discount = False
-        
-        # Check if all three services are selected
-        if compliance_request.business.business_type == 'CORP':
-            if (any(s['name'] == 'Federal EIN Application' for s in service_requests) and
-                any(s['name'] == 'Corporate Bylaws' for s in service_requests) and
-                any(s['name'] == 'Labor Law Posters & Certificate of Existence' for s in service_requests)):
-                total_price = subtotal - discount
-                show_discount = True
-        elif compliance_request.business.business_type == 'LLC':
-            if (any(s['name'] == 'Federal EIN Application' for s in service_requests) and
-                any(s['name'] == 'Operating Agreement' for s in service_requests) and
-                any(s['name'] == 'Labor Law Posters & Certificate of Existence' for s in service_requests)):
-                total_price = subtotal - discount
-                show_discount = True
-
-        # Add unlimited amendments addon if selected
-        if compliance_request.unlimited_amendments:
-            total_price += Decimal('39.95')
 
         context.update({
             'user_email': payment_info.get('user_email'),
             'order_reference': payment_info.get('order_reference'),
-            'amount': str(total_price),
-            'subtotal': subtotal,
-            'discount': discount,
-            'service_requests': service_requests,
+            'amount': str(quote.total),
+            'quote': quote,
+            'subtotal': quote.subtotal,
+            'discount': quote.discount,
+            'service_requests': quote.line_items,
             'business_name': payment_info.get('business_name'),
             'compliance_request': compliance_request,
             'business': compliance_request.business,
-            'show_discount': show_discount,
+            'show_discount': quote.show_discount,
             'date': timezone.now().strftime('%d-%m-%Y')
         })
 
@@ -470,6 +302,7 @@ class PaymentConfirmationView(TemplateView):
             email_context = {
                 'order_reference': payment_info.get('order_reference'),
                 'business_name': payment_info.get('business_name'),
+                'quote': quote,
                 'date': timezone.now().strftime('%d-%m-%Y')
             }
             
@@ -492,232 +325,201 @@ class PaymentConfirmationView(TemplateView):
         
         return context
 
-class ServiceFormView(FormView):
+class ServiceStepMixin(ComplianceRequestMixin):
+    """For views of the service form the customer is on"""
+
+    def get_current_item(self):
+        """The first item on the order whose service form hasn't been filled in, or None"""
+        if not hasattr(self, '_current_item'):
+            self._current_item = self.get_compliance_request().items.filter(status=OrderItem.PENDING).first()
+        return self._current_item
+
+    def get_current_step(self):
+        """
+        (index, Step) of the current item's service form the customer is on.
+        Services with more than one form keep their place in the session.
+        """
+        if not hasattr(self, '_current_step'):
+            item = self.get_current_item()
+            service = SERVICES.get(item.service)
+            if service is None:
+                raise Http404(f"No form class found for request type: {item.service}")
+            saved = self.request.session.get('service_step')
+            index = saved[1] if saved and saved[0] == item.pk and saved[1] < len(service.steps) else 0
+            self._current_step = (index, service.steps[index])
+        return self._current_step
+
+    def get_step_token(self):
+        """Names the current step, so a page can tell the form it shows is still the one to fill in"""
+        return f'{self.get_current_item().pk}-{self.get_current_step()[0]}'
+
+class ServiceFormView(ServiceStepMixin, FormView):
     template_name = 'core/service_form_base.html'
 
+    def dispatch(self, request, *args, **kwargs):
+        compliance_request = self.get_compliance_request()
+        # Every form is in
+        if self.get_current_item() is None:
+            return redirect('core:payment', request_id=compliance_request.id)
+        return super().dispatch(request, *args, **kwargs)
+
     def get_form_class(self):
-        request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
-        
-        # Map request types to form classes
-        form_map = {
-            'OPERATING_AGREEMENT': OperatingAgreementForm,
-            'CORPORATE_BYLAWS': CorporateBylawsForm,
-            'FEDERAL_EIN': FederalEINForm,
-            'LABOR_LAW_POSTER': LaborLawPosterForm,
-            'CERTIFICATE_EXISTENCE': CertificateExistenceForm,
-            'LABOR_LAW_POSTER_CERT': LaborLawPosterForm,  # Initial form for bundled service
-        }
-        
-        # Check if we're on the second form of the bundled service
-        if compliance_request.request_type == 'LABOR_LAW_POSTER_CERT' and self.request.session.get('showing_certificate_form', False):
-            form_map['LABOR_LAW_POSTER_CERT'] = CertificateExistenceForm
-        
-        form_class = form_map.get(compliance_request.request_type)
-        if not form_class:
-            raise Http404(f"No form class found for request type: {compliance_request.request_type}")
-        
-        return form_class
+        return self.get_current_step()[1].form_class
 
-    def get_template_names(self):
-        request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
-        
-        # Map request types to templates
-        template_map = {
-            'OPERATING_AGREEMENT': 'core/operating_agreement.html',
-            'CORPORATE_BYLAWS': 'core/corporate_bylaws.html',
-            'FEDERAL_EIN': 'core/federal_ein.html',
-            'LABOR_LAW_POSTER': 'core/labor_law_poster.html',
-            'CERTIFICATE_EXISTENCE': 'core/certificate_existence.html',
-            'LABOR_LAW_POSTER_CERT': 'core/labor_law_poster.html',  # Initial template for bundled service
-        }
-        
-        # Check if we're on the second form of the bundled service
-        if compliance_request.request_type == 'LABOR_LAW_POSTER_CERT' and self.request.session.get('showing_certificate_form', False):
-            template_map['LABOR_LAW_POSTER_CERT'] = 'core/certificate_existence.html'
-        
-        template = template_map.get(compliance_request.request_type, 'core/service_form_base.html')
-        return [template]
+    def get_initial(self):
+        # Start from what's been autosaved; a submitted form brings its own data
+        if self.request.method != 'GET':
+            return super().get_initial()
+        return self.get_current_step()[1].initial(self.get_compliance_request())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
+        compliance_request = self.get_compliance_request()
+        item = self.get_current_item()
+        index, step = self.get_current_step()
         context['compliance_request'] = compliance_request
         context['business'] = compliance_request.business
         
-        # Get selected services from session
-        selected_services = self.request.session.get('selected_services', [])
-        current_service_index = selected_services.index(compliance_request.request_type) if compliance_request.request_type in selected_services else -1
-        
-        # Add service name to context
-        service_names = {
-            'OPERATING_AGREEMENT': 'Operating Agreement',
-            'CORPORATE_BYLAWS': 'Corporate Bylaws',
-            'FEDERAL_EIN': 'Federal EIN Application',
-            'LABOR_LAW_POSTER': 'Labor Law Poster',
-            'CERTIFICATE_EXISTENCE': 'Certificate of Existence',
-            'LABOR_LAW_POSTER_CERT': 'Labor Law Posters & Certificate of Existence',
-        }
-        
-        # Adjust service name for bundled service second form
-        if compliance_request.request_type == 'LABOR_LAW_POSTER_CERT':
-            if self.request.session.get('showing_certificate_form', False):
-                service_names['LABOR_LAW_POSTER_CERT'] = 'Certificate of Existence'
-            else:
-                service_names['LABOR_LAW_POSTER_CERT'] = 'Labor Law Poster'
+        selected_services = list(compliance_request.items.values_list('service', flat=True))
+        current_service_index = selected_services.index(item.service)
         
         context.update({
-            'service_name': service_names.get(compliance_request.request_type, 'Service'),
+            'service_name': step.name,
             'current_service_index': current_service_index + 1,
             'total_services': len(selected_services),
             'selected_services': selected_services,
-            'is_bundled_service': compliance_request.request_type == 'LABOR_LAW_POSTER_CERT',
-            'showing_certificate_form': self.request.session.get('showing_certificate_form', False),
+            'is_bundled_service': len(SERVICES[item.service].steps) > 1,
+            'showing_certificate_form': index > 0,
+            'step_template': step.template,
+            'draft_url': reverse('core:service_form_draft', args=[compliance_request.id]) + '?' + urlencode({'step': self.get_step_token()}),
         })
         
         return context
 
     def form_valid(self, form):
-        request_id = self.kwargs.get('request_id')
-        compliance_request = get_object_or_404(ComplianceRequest, id=request_id)
-        
-        # Get the model fields for the specific service request type
-        if compliance_request.request_type == 'FEDERAL_EIN':
-            # First update the parent ComplianceRequest with applicant info
-            applicant_fields = [
-                'applicant_reference_id',
-                'applicant_first_name',
-                'applicant_last_name',
-                'applicant_email',
-                'applicant_phone_number'
-            ]
-            for field in applicant_fields:
-                if field in form.cleaned_data:
-                    setattr(compliance_request, field, form.cleaned_data[field])
-            compliance_request.save()
-
-            # Then save the FederalEINRequest specific fields
-            model_fields = [f.name for f in FederalEINRequest._meta.get_fields()]
-            filtered_data = {k: v for k, v in form.cleaned_data.items() if k in model_fields}
-            service_request, created = FederalEINRequest.objects.get_or_create(
-                compliance_request=compliance_request,
-                defaults=filtered_data
-            )
-            if not created:
-                for field, value in filtered_data.items():
-                    setattr(service_request, field, value)
-                service_request.save()
-        
-        elif compliance_request.request_type == 'OPERATING_AGREEMENT':
-            model_fields = [f.name for f in OperatingAgreementRequest._meta.get_fields()]
-            filtered_data = {k: v for k, v in form.cleaned_data.items() if k in model_fields}
-            service_request, created = OperatingAgreementRequest.objects.get_or_create(
-                compliance_request=compliance_request,
-                defaults=filtered_data
-            )
-            if not created:
-                for field, value in filtered_data.items():
-                    setattr(service_request, field, value)
-                service_request.save()
-        
-        elif compliance_request.request_type == 'CORPORATE_BYLAWS':
-            # Filter only the corporate structure fields
-            filtered_data = {
-                'corporate_officers': form.cleaned_data.get('corporate_officers'),
-                'board_of_directors': form.cleaned_data.get('board_of_directors'),
-                'authorized_shares': form.cleaned_data.get('authorized_shares'),
-                'par_value_per_share': form.cleaned_data.get('par_value_per_share'),
-            }
-            
-            service_request, created = CorporateBylawsRequest.objects.get_or_create(
-                compliance_request=compliance_request,
-                defaults=filtered_data
-            )
-            if not created:
-                for field, value in filtered_data.items():
-                    setattr(service_request, field, value)
-                service_request.save()
-        
-        elif compliance_request.request_type == 'LABOR_LAW_POSTER_CERT':
-            # Handle the bundled service forms
-            if not self.request.session.get('showing_certificate_form', False):
-                # First form (Labor Law Poster)
-                model_fields = [f.name for f in LaborLawPosterRequest._meta.get_fields()]
-                filtered_data = {k: v for k, v in form.cleaned_data.items() if k in model_fields}
-                service_request, created = LaborLawPosterRequest.objects.get_or_create(
-                    compliance_request=compliance_request,
-                    defaults=filtered_data
-                )
-                if not created:
-                    for field, value in filtered_data.items():
-                        setattr(service_request, field, value)
-                    service_request.save()
-                
-                # Set flag to show certificate form next
-                self.request.session['showing_certificate_form'] = True
-                return redirect('core:service_form', request_id=compliance_request.id)
-            else:
-                # Second form (Certificate of Existence)
-                model_fields = [f.name for f in CertificateExistenceRequest._meta.get_fields()]
-                filtered_data = {k: v for k, v in form.cleaned_data.items() if k in model_fields}
-                service_request, created = CertificateExistenceRequest.objects.get_or_create(
-                    compliance_request=compliance_request,
-                    defaults=filtered_data
-                )
-                if not created:
-                    for field, value in filtered_data.items():
-                        setattr(service_request, field, value)
-                    service_request.save()
-                
-                # Clear the flag
-                self.request.session['showing_certificate_form'] = False
-        
-        elif compliance_request.request_type == 'LABOR_LAW_POSTER':
-            model_fields = [f.name for f in LaborLawPosterRequest._meta.get_fields()]
-            filtered_data = {k: v for k, v in form.cleaned_data.items() if k in model_fields}
-            service_request, created = LaborLawPosterRequest.objects.get_or_create(
-                compliance_request=compliance_request,
-                defaults=filtered_data
-            )
-            if not created:
-                for field, value in filtered_data.items():
-                    setattr(service_request, field, value)
-                service_request.save()
-        
-        elif compliance_request.request_type == 'CERTIFICATE_EXISTENCE':
-            model_fields = [f.name for f in CertificateExistenceRequest._meta.get_fields()]
-            filtered_data = {k: v for k, v in form.cleaned_data.items() if k in model_fields}
-            service_request, created = CertificateExistenceRequest.objects.get_or_create(
-                compliance_request=compliance_request,
-                defaults=filtered_data
-            )
-            if not created:
-                for field, value in filtered_data.items():
-                    setattr(service_request, field, value)
-                service_request.save()
-        
-        # Update the compliance request status
-        compliance_request.status = 'IN_PROGRESS'
-        compliance_request.save()
-        
-        # Get remaining services from session
-        selected_services = self.request.session.get('selected_services', [])
-        current_service_index = selected_services.index(compliance_request.request_type)
+        compliance_request = self.get_compliance_request()
+        item = self.get_current_item()
+        index, step = self.get_current_step()
+        last_step = index + 1 == len(SERVICES[item.service].steps)
+
+        # One transaction per step, updating each row at most once and only
+        # in the columns the step changes
+        with transaction.atomic():
+            request_fields = step.save(compliance_request, form.cleaned_data)
+            if last_step:
+                # This service's form is in
+                item.status = OrderItem.SUBMITTED
+                item.save(update_fields=['status', 'updated_at'])
+                compliance_request.status = 'IN_PROGRESS'
+                request_fields += ['status', *pricing.discard_quote(compliance_request)]
+            if request_fields:
+                compliance_request.save(update_fields=[*request_fields, 'updated_at'])
+
+        if not last_step:
+            # On to this service's next form
+            self.request.session['service_step'] = [item.pk, index + 1]
+            return redirect('core:service_form', request_id=compliance_request.id)
+        self.request.session.pop('service_step', None)
         
-        if current_service_index < len(selected_services) - 1:
-            # Set the next service type
-            next_service = selected_services[current_service_index + 1]
-            compliance_request.request_type = next_service
-            compliance_request.save()
-            
-            # Redirect to the same form view with updated request type
+        if compliance_request.items.filter(status=OrderItem.PENDING).exists():
+            # On to the next service's form
             return redirect('core:service_form', request_id=compliance_request.id)
         else:
             # All forms completed, proceed to payment
             return redirect('core:payment', request_id=compliance_request.id)
 
+class ServiceDraftView(ServiceStepMixin, View):
+    """
+    Autosave for the service form. The page posts just the fields changed
+    since it last saved; each is validated on its own and the valid ones
+    are written to the step's row, so the form is as the customer left it
+    when they come back. Whole-form checks and moving on to the next form
+    are left to ServiceFormView.
+    """
+
+    def post(self, request, *args, **kwargs):
+        # The page is showing a form that's already been submitted
+        if self.get_current_item() is None or request.GET.get('step') != self.get_step_token():
+            return JsonResponse({'stale': True}, status=409)
+        step = self.get_current_step()[1]
+        values, errors = step.clean_fields(request.POST, [name for name in request.POST if name != 'csrfmiddlewaretoken'])
+        saved = step.save_draft(self.get_compliance_request(), values)
+        return JsonResponse({'saved': saved, 'errors': errors})
+
+class CheckoutView(ComplianceRequestMixin, TemplateView):
+    """
+    Every service form still to fill in on one page, shown a step at a time
+    in the browser and submitted together: the forms are validated as one
+    and saved in a single transaction, with nothing kept in the session
+    between them. The single-page alternative to ServiceFormView.
+    """
+    template_name = 'core/checkout.html'
+
+    def get_items(self):
+        """The order's items whose service forms haven't been filled in"""
+        if not hasattr(self, '_items'):
+            self._items = list(self.get_compliance_request().items.filter(status=OrderItem.PENDING))
+        return self._items
+
+    def get_sections(self, data=None, files=None):
+        """
+        (item, Step, form) for each form to fill in, in order. Each form's
+        fields are prefixed with its item and step, as the bundle's forms
+        share field names; unbound forms start from what's been saved.
+        """
+        compliance_request = self.get_compliance_request()
+        sections = []
+        for item in self.get_items():
+            service = SERVICES.get(item.service)
+            if service is None:
+                raise Http404(f"No form class found for request type: {item.service}")
+            for index, step in enumerate(service.steps):
+                prefix = f'{item.pk}-{index}'
+                if data is None:
+                    form = step.form_class(prefix=prefix, initial=step.initial(compliance_request))
+                else:
+                    form = step.form_class(data, files, prefix=prefix)
+                sections.append((item, step, form))
+        return sections
+
+    def dispatch(self, request, *args, **kwargs):
+        # Every form is in
+        if not self.get_items():
+            return redirect('core:payment', request_id=self.get_compliance_request().id)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        if 'sections' not in kwargs:
+            kwargs['sections'] = self.get_sections()
+        context = super().get_context_data(**kwargs)
+        compliance_request = self.get_compliance_request()
+        context['compliance_request'] = compliance_request
+        context['business'] = compliance_request.business
+        return context
+
+    def post(self, request, *args, **kwargs):
+        compliance_request = self.get_compliance_request()
+        sections = self.get_sections(request.POST, request.FILES)
+        # Validate every form, so the page shows all that needs fixing
+        if not all([form.is_valid() for item, step, form in sections]):
+            return self.render_to_response(self.get_context_data(sections=sections))
+
+        # One transaction for the whole order, updating each row at most once
+        with transaction.atomic():
+            request_fields = []
+            for item, step, form in sections:
+                request_fields += step.save(compliance_request, form.cleaned_data)
+            OrderItem.objects.filter(pk__in=[item.pk for item in self.get_items()]).update(
+                status=OrderItem.SUBMITTED, updated_at=timezone.now(),
+            )
+            compliance_request.status = 'IN_PROGRESS'
+            request_fields += ['status', *pricing.discard_quote(compliance_request)]
+            compliance_request.save(update_fields=[*dict.fromkeys(request_fields), 'updated_at'])
+
+        # In case the customer had started on the form-per-page wizard
+        request.session.pop('service_step', None)
+        return redirect('core:payment', request_id=compliance_request.id)
+
 class InsuranceInfoView(TemplateView):
     template_name = 'core/insurance_info.html'
 
@@ -731,13 +533,26 @@ def business_search_autocomplete(request):
     if len(query) < 2:
         return JsonResponse({'results': []})
     
-    businesses = Business.objects.filter(
-        Q(name__icontains=query) | Q(reference_id__icontains=query)
-    ).values('id', 'name', 'reference_id', 'state_code')[:10]
+    # Answer from the in-process prefix index; fall back to the ranked database
+    # search for mid-word matches or when the index is unavailable
+    businesses = prefix_index.lookup(query, limit=10)
+    if not businesses:
+        businesses = [
+            (business.reference_id, business.name, business.state_code)
+            for business in SearchPage(query, page_size=10).businesses
+        ]
     
     results = [{
-        'id': business['id'],
-        'text': f"{business['name']} ({business['reference_id']}) - {business['state_code']}"
-    } for business in businesses]
+        'id': reference_id,
+        'text': f"{name} ({reference_id}) - {state_code}"
+    } for reference_id, name, state_code in businesses]
+    
+    # Nothing matched as typed; return close spellings flagged as suggestions
+    if not results:
+        results = [{
+            'id': reference_id,
+            'text': f"Did you mean {name} ({reference_id}) - {state_code}?",
+            'suggestion': True
+        } for reference_id, name, state_code in fuzzy.suggest(query)]
     
     return JsonResponse({'results': results})
@@ -6,5 +6,19 @@ python manage.py collectstatic --noinput
 # Apply database migrations
 python manage.py migrate
 
+# Charge queued payments in the background, restarting the worker if it exits
+while true; do
+    python manage.py process_payments
+    echo "process_payments exited with status $?; restarting in 5 seconds" >&2
+    sleep 5
+done &
+
+# Recompute the date-derived business flags (is_new, missing_filing) now and
+# then daily; set FLAG_RECOMPUTE_INTERVAL to change how often, in seconds
+while true; do
+    python manage.py recompute_business_flags
+    sleep "${FLAG_RECOMPUTE_INTERVAL:-86400}"
+done &
+
 # Start Gunicorn
 gunicorn StateLink_Web.wsgi:application --bind=0.0.0.0:8000 --workers=4